@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Micro-benchmark dei generatori PDF: tempo di rendering per documento.
+
+Genera ripetutamente la scheda impianto e la cartella paziente (per sezione e
+completa) con dati di esempio e stampa media e mediana in millisecondi.
+Non usa il database: serve solo a confrontare le prestazioni dei generatori.
+
+Uso: python benchmark_pdf.py [-n 50]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import server  # noqa: E402
+
+PATIENT = {
+    "id": "bench-patient", "nome": "Mario", "cognome": "Rossi", "tipo": "PICC_MED",
+    "codice_fiscale": "RSSMRA60A01H501U", "data_nascita": "1960-01-01", "sesso": "M",
+    "telefono": "3331234567", "email": "mario.rossi@example.com", "medico_base": "Dr. Bianchi",
+    "status": "in_cura", "anamnesi": "Ipertensione arteriosa, diabete mellito tipo 2",
+    "terapia_in_atto": "Metformina 500mg, Ramipril 5mg", "allergie": "Nessuna nota",
+}
+
+SCHEDA_IMPIANTO = {
+    "id": "bench-impianto", "patient_id": "bench-patient", "ambulatorio": "pta_centro",
+    "scheda_type": "completa", "data_impianto": "2026-01-15", "presidio_ospedaliero": "PTA Centro",
+    "unita_operativa": "Ambulatorio", "tipo_catetere": "picc", "braccio": "dx", "vena": "basilica",
+    "exit_site_cm": "2", "diametro_vena_mm": "4", "profondita_cm": "1", "lunghezza_totale_cm": "50",
+    "lunghezza_impiantata_cm": "42", "french": "4", "lumi": "1", "valutazione_sito": True,
+    "ecoguidato": True, "igiene_mani": True, "precauzioni_barriera": True,
+    "disinfezione": ["clorexidina_2"], "sutureless_device": True, "medicazione_trasparente": True,
+    "medicazione_occlusiva": False, "controllo_rx": False, "ecg_intracavitario": True,
+    "modalita": "elezione", "motivazione": ["chemioterapia"], "operatore": "Domenico",
+    "note": "Impianto senza complicanze",
+}
+
+SCHEDE_MED = [
+    {
+        "id": f"bench-med-{i}", "data_compilazione": f"2026-02-{i + 1:02d}",
+        "fondo": ["granuleggiante"], "margini": ["regolari"], "cute_perilesionale": ["integra"],
+        "essudato_quantita": "scarso", "essudato_tipo": ["sieroso"],
+        "medicazione": "Idrocolloide", "prossimo_cambio": f"2026-02-{i + 4:02d}", "firma": "Domenico",
+    }
+    for i in range(8)
+]
+
+SCHEDE_GESTIONE = [
+    {
+        "id": f"bench-gestione-{m}", "mese": f"2026-0{m}",
+        "giorni": {
+            f"2026-0{m}-{d:02d}": {"lavaggio_mani": "SI", "ispezione_sito": "SI", "exit_site_cm": "2", "sigla_operatore": "DM"}
+            for d in range(1, 29, 2)
+        },
+        "note": "Nessuna complicanza",
+    }
+    for m in (1, 2)
+]
+
+
+def measure(fn, n: int) -> tuple:
+    fn()  # riscaldamento: import pigri e font
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.mean(times), statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=50, help="documenti generati per caso")
+    args = parser.parse_args()
+
+    cases = [
+        ("scheda impianto", lambda: server.generate_scheda_impianto_pdf(SCHEDA_IMPIANTO, PATIENT)),
+        ("cartella: anagrafica", lambda: server.generate_patient_pdf_section(PATIENT, [], [], [], "anagrafica")),
+        ("cartella: sezione all", lambda: server.generate_patient_pdf_section(PATIENT, SCHEDE_MED, [SCHEDA_IMPIANTO], SCHEDE_GESTIONE, "all")),
+        ("cartella completa", lambda: server.generate_patient_pdf(PATIENT, SCHEDE_MED, [SCHEDA_IMPIANTO], SCHEDE_GESTIONE, [])),
+    ]
+    print(f"{'documento':<24}{'media ms':>10}{'mediana ms':>12}")
+    for name, fn in cases:
+        mean, median = measure(fn, args.n)
+        print(f"{name:<24}{mean:>10.2f}{median:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,18 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Response, Request, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ReturnDocument, UpdateOne, UpdateMany, ReplaceOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure
+from gridfs.errors import FileExists
+from bson import ObjectId
 import os
+import asyncio
 import logging
 from pathlib import Path
+from urllib.parse import quote, parse_qsl, urlencode
 from pydantic import BaseModel, Field, ConfigDict, field_validator
 from typing import List, Optional, Dict, Any, Union
 import uuid
@@ -15,14 +21,31 @@ import jwt
 import bcrypt
 from enum import Enum
 import base64
+import json
+import hashlib
+import hmac
+import time
+import unicodedata
 import io
+import tempfile
 import zipfile
+import mimetypes
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image as PILImage, ImageOps
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import cm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image as RLImage
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak, Image as RLImage
 from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
+from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+from reportlab.graphics.shapes import Drawing
+from reportlab.graphics.charts.barcharts import VerticalBarChart
+from reportlab.graphics.charts.piecharts import Pie
+from reportlab.graphics.charts.legends import Legend
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -46,6 +69,7 @@ JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 # Create the main app
 app = FastAPI(title="Ambulatorio Infermieristico API")
@@ -54,7 +78,7 @@ app = FastAPI(title="Ambulatorio Infermieristico API")
 @app.get("/health")
 async def health_check():
     """Health check endpoint for Kubernetes liveness/readiness probes"""
-    return {"status": "healthy"}
+    return {"status": "healthy", "render_queue": render_queue_depth()}
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -142,6 +166,117 @@ def generate_patient_code(nome: str, cognome: str) -> str:
     suffix = random.choice(string.ascii_lowercase)
     return f"{prefix}{digits}{suffix}"
 
+# L'unicità dei codici è garantita dall'indice unique "codice_paziente_unique":
+# il codice viene assegnato direttamente in scrittura e rigenerato solo in caso
+# di collisione, senza query di verifica preventive. Finché ensure_indexes non
+# ha confermato l'indice (avvio in corso, codici duplicati da correggere) si torna
+# alla verifica preventiva del codice.
+PATIENT_CODE_MAX_ATTEMPTS = 20
+_patient_code_index_ready = False
+
+def is_patient_code_conflict(error: dict) -> bool:
+    """True se l'errore di scrittura è una chiave duplicata su codice_paziente"""
+    if error.get("code") != 11000:
+        return False
+    key_pattern = error.get("keyPattern") or error.get("keyValue") or {}
+    return "codice_paziente" in key_pattern or "codice_paziente" in error.get("errmsg", "")
+
+async def insert_patient_with_code(doc: dict) -> dict:
+    """Inserisce un paziente assegnandogli un codice univoco"""
+    with_search_fields(doc)
+    for _ in range(PATIENT_CODE_MAX_ATTEMPTS):
+        doc["codice_paziente"] = generate_patient_code(doc.get("nome") or "X", doc.get("cognome", ""))
+        if not _patient_code_index_ready and await db.patients.find_one({"codice_paziente": doc["codice_paziente"]}, {"_id": 1}):
+            continue
+        try:
+            await db.patients.insert_one(doc)
+            invalidate_patient_directory(doc.get("ambulatorio"))
+            return doc
+        except DuplicateKeyError as e:
+            if not is_patient_code_conflict(e.details or {}):
+                raise
+    raise HTTPException(status_code=503, detail="Impossibile generare un codice paziente univoco")
+
+async def insert_patients_with_codes(docs: List[dict]) -> Dict[int, str]:
+    """Inserisce un gruppo di pazienti con un insert_many, assegnando i codici.
+
+    Solo i documenti in collisione sul codice ricevono un nuovo codice e vengono
+    reinseriti. Restituisce indice -> messaggio per i documenti non inseriti.
+    """
+    failed: Dict[int, str] = {}
+    if not _patient_code_index_ready:
+        # Senza l'indice unique le collisioni non emergono in scrittura
+        for i, doc in enumerate(docs):
+            try:
+                await insert_patient_with_code(doc)
+            except HTTPException as e:
+                failed[i] = e.detail
+        return failed
+    pending = list(range(len(docs)))
+    for doc in docs:
+        with_search_fields(doc)
+    for _ in range(PATIENT_CODE_MAX_ATTEMPTS):
+        if not pending:
+            break
+        for i in pending:
+            docs[i]["codice_paziente"] = generate_patient_code(docs[i].get("nome") or "X", docs[i].get("cognome", ""))
+        try:
+            await db.patients.insert_many([docs[i] for i in pending], ordered=False)
+            pending = []
+        except BulkWriteError as e:
+            retry = []
+            for error in e.details.get("writeErrors", []):
+                i = pending[error["index"]]
+                if is_patient_code_conflict(error):
+                    retry.append(i)
+                else:
+                    failed[i] = error.get("errmsg", "Errore di scrittura")
+            pending = retry
+    for i in pending:
+        failed[i] = "Impossibile generare un codice paziente univoco"
+    for ambulatorio in {doc.get("ambulatorio") for doc in docs}:
+        invalidate_patient_directory(ambulatorio)
+    return failed
+
+async def next_sequence(collection: str, query: dict, field: str, projection: Optional[dict] = None) -> Optional[dict]:
+    """Incrementa atomicamente il contatore `field` del documento indicato.
+
+    Restituisce il documento aggiornato (con il nuovo valore del contatore),
+    oppure None se nessun documento corrisponde a `query`.
+    """
+    return await db[collection].find_one_and_update(
+        query,
+        {"$inc": {field: 1}},
+        projection={"_id": 0, **(projection or {})},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def next_patient_sequence(patient_id: str, field: str) -> Optional[dict]:
+    """Prossimo numero di una numerazione per paziente (es. scheda_med_counter)"""
+    return await next_sequence("patients", {"id": patient_id}, field)
+
+async def assign_patient_code(patient: dict) -> str:
+    """Assegna un codice a un paziente esistente che ne è privo e lo restituisce"""
+    for _ in range(PATIENT_CODE_MAX_ATTEMPTS):
+        codice_paziente = generate_patient_code(patient.get("nome") or "X", patient.get("cognome", ""))
+        try:
+            result = await db.patients.update_one(
+                {"id": patient["id"], "codice_paziente": {"$not": {"$gt": ""}}},
+                {"$set": {"codice_paziente": codice_paziente}}
+            )
+            invalidate_patient_directory(patient.get("ambulatorio"))
+        except DuplicateKeyError as e:
+            if not is_patient_code_conflict(e.details or {}):
+                raise
+            continue
+        if result.modified_count:
+            return codice_paziente
+        # Codice già assegnato da una richiesta concorrente
+        current = await db.patients.find_one({"id": patient["id"]}, {"_id": 0, "codice_paziente": 1})
+        if current and current.get("codice_paziente"):
+            return current["codice_paziente"]
+    raise HTTPException(status_code=503, detail="Impossibile generare un codice paziente univoco")
+
 class Patient(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -399,7 +534,10 @@ class Photo(BaseModel):
     tipo: str
     descrizione: Optional[str] = None
     data: str
-    image_data: str  # Base64
+    image_data: Optional[str] = None  # Base64 (solo foto legacy non ancora migrate)
+    blob_id: Optional[str] = None  # SHA-256 del contenuto nel blob store
+    size: Optional[int] = None
+    variants: Optional[Dict[str, str]] = None  # {"thumb": blob_id, "medium": blob_id}
     file_type: Optional[str] = "image"  # image, pdf, word, excel
     original_name: Optional[str] = None
     mime_type: Optional[str] = None
@@ -513,6 +651,43 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security))
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Token non valido")
 
+# <img src> e i link di download non possono inviare l'header Authorization: le
+# URL dei file portano una firma valida solo per quella risorsa e fino a expires.
+# La scadenza è arrotondata a FILE_URL_WINDOW secondi, così l'URL resta la stessa
+# all'interno della finestra e la cache del browser continua a funzionare.
+FILE_URL_WINDOW = 3600
+
+def file_url_signature(path: str, params: List[tuple], expires: int) -> str:
+    """Firma di percorso, parametri della query (in forma canonica) e scadenza"""
+    query = urlencode(sorted((k, v) for k, v in params if k not in ("expires", "signature")))
+    return hmac.new(JWT_SECRET.encode(), f"{path}|{query}|{expires}".encode(), hashlib.sha256).hexdigest()
+
+def sign_file_url(path: str, query: str = "") -> str:
+    """URL (relativa all'API) di un file, firmata per 1-2 finestre FILE_URL_WINDOW"""
+    expires = (int(time.time()) // FILE_URL_WINDOW + 2) * FILE_URL_WINDOW
+    signature = file_url_signature(path, parse_qsl(query, keep_blank_values=True), expires)
+    return f"{path}?{query + '&' if query else ''}expires={expires}&signature={signature}"
+
+def verify_token_or_signature(
+    request: Request,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    expires: Optional[int] = Query(None),
+    signature: Optional[str] = Query(None)
+) -> dict:
+    """Come verify_token, ma accetta anche una URL firmata con sign_file_url.
+    Con la firma il payload ha signed=True e nessun ambulatorio: la firma vale
+    solo per il percorso e i parametri richiesti ed è emessa a chi vi aveva già accesso."""
+    if credentials:
+        return verify_token(credentials)
+    if expires is None or not signature:
+        raise HTTPException(status_code=401, detail="Token mancante")
+    path = request.url.path.removeprefix(api_router.prefix)
+    if not hmac.compare_digest(signature, file_url_signature(path, request.query_params.multi_items(), expires)):
+        raise HTTPException(status_code=401, detail="Firma non valida")
+    if expires < time.time():
+        raise HTTPException(status_code=401, detail="Link scaduto")
+    return {"sub": None, "ambulatori": [], "signed": True}
+
 # ============== AUTH ROUTES ==============
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(data: UserLogin):
@@ -542,6 +717,330 @@ async def get_current_user(payload: dict = Depends(verify_token)):
         ambulatori=user["ambulatori"]
     )
 
+# ============== PAGINATION ==============
+# Paginazione keyset comune agli endpoint di elenco. Il cursore è opaco: contiene
+# i valori delle chiavi di ordinamento dell'ultimo elemento restituito, così ogni
+# pagina è una query sull'indice che non dipende da quante righe la precedono.
+# Senza limit/cursor gli endpoint restituiscono la lista come in passato (fino al
+# loro limite predefinito); se il risultato è troncato lo segnalano gli header
+# X-Has-More e X-Next-Cursor invece di tagliarlo in silenzio.
+PAGE_MAX_LIMIT = 1000
+
+class PageParams:
+    """Parametri di paginazione condivisi: limit, cursor e fields=campo1,campo2"""
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=PAGE_MAX_LIMIT),
+        cursor: Optional[str] = None,
+        fields: Optional[str] = None,
+    ):
+        self.limit = limit
+        self.cursor = cursor
+        self.fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    
+    @property
+    def paginated(self) -> bool:
+        return self.limit is not None or self.cursor is not None
+
+def encode_cursor(doc: dict, sort: List[tuple]) -> str:
+    # Gli ObjectId (ordinamento su _id) mantengono il tipo: come stringa non
+    # sarebbero confrontabili con i valori salvati
+    values = [{"$oid": str(v)} if isinstance(v, ObjectId) else v for v in (doc.get(key) for key, _ in sort)]
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+def decode_cursor(cursor: str, sort: List[tuple]) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(values, list):
+            values = [ObjectId(v["$oid"]) if isinstance(v, dict) and set(v) == {"$oid"} else v for v in values]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+    return values
+
+def keyset_filter(sort: List[tuple], values: list) -> dict:
+    """Condizione "dopo il cursore" per un ordinamento su più chiavi.
+
+    I valori mancanti (null) seguono l'ordinamento di MongoDB: vengono prima di
+    tutto in ordine crescente e per ultimi in ordine decrescente.
+    """
+    branches = []
+    for i, (key, direction) in enumerate(sort):
+        value = values[i]
+        if value is None:
+            if direction < 0:
+                continue
+            condition = {"$ne": None}
+        elif direction > 0:
+            condition = {"$gt": value}
+        else:
+            condition = {"$not": {"$gte": value}}
+        branch = {prev_key: values[j] for j, (prev_key, _) in enumerate(sort[:i])}
+        branch[key] = condition
+        branches.append(branch)
+    # Nessun elemento può seguire il cursore: filtro sempre falso
+    return {"$or": branches} if branches else {"_id": {"$exists": False}}
+
+def page_projection(page: PageParams, sort: List[tuple], projection: dict, required: tuple = ()) -> dict:
+    """Proiezione ridotta ai campi richiesti con fields= (più id, chiavi di ordinamento
+    e i campi `required` che l'endpoint usa per costruire la risposta)"""
+    if not page.fields:
+        return projection
+    included = {k for k, v in projection.items() if v and k != "_id"}
+    excluded = {k for k, v in projection.items() if not v}
+    always = {*(key for key, _ in sort), *required}
+    wanted = {"id", *page.fields, *always}
+    if included:
+        wanted &= included | always
+    reduced = {f: 1 for f in wanted - excluded}
+    reduced["_id"] = projection.get("_id", 0)
+    return reduced
+
+async def fetch_page(
+    collection,
+    query: dict,
+    sort: List[tuple],
+    page: PageParams,
+    projection: Optional[dict] = None,
+    default_limit: int = 1000,
+    required: tuple = ()
+) -> dict:
+    """Legge una pagina ordinata secondo `sort` (l'ultima chiave deve essere univoca).
+
+    Restituisce {"items", "next_cursor", "has_more"}; legge un elemento in più del
+    limite per sapere se esiste una pagina successiva.
+    """
+    if page.cursor:
+        query = {"$and": [query, keyset_filter(sort, decode_cursor(page.cursor, sort))]}
+    projection = page_projection(page, sort, projection or {"_id": 0}, required)
+    size = page.limit or default_limit
+    items = await collection.find(query, projection).sort(sort).to_list(size + 1)
+    has_more = len(items) > size
+    items = items[:size]
+    return {
+        "items": items,
+        "next_cursor": encode_cursor(items[-1], sort) if has_more else None,
+        "has_more": has_more,
+    }
+
+def page_response(result: dict, page: PageParams, response: Response, model=None):
+    """Risposta di un endpoint paginato.
+
+    Con limit/cursor restituisce {"items", "next_cursor", "has_more"}, altrimenti la
+    sola lista. Gli elementi sono validati con `model` (che scarta i campi interni)
+    salvo quando fields= ne chiede solo una parte.
+    """
+    items = result["items"]
+    if page.fields:
+        keep = {"id", *page.fields}
+        items = [{k: v for k, v in item.items() if k in keep} for item in items]
+    elif model is not None:
+        items = [model.model_validate(item) for item in items]
+    
+    if page.paginated:
+        return {"items": items, "next_cursor": result["next_cursor"], "has_more": result["has_more"]}
+    if result["has_more"]:
+        response.headers["X-Has-More"] = "true"
+        response.headers["X-Next-Cursor"] = result["next_cursor"]
+    return items
+
+# ============== PATIENT SEARCH ==============
+# Ogni paziente salva chiavi di ricerca normalizzate (minuscolo, senza accenti):
+# - search_keys: "cognome nome" e "nome cognome", per il ranking
+# - search_tokens: le singole parole, indicizzate per la ricerca per prefisso
+# - search_trigrams: i trigrammi delle parole, indicizzati per la ricerca fuzzy
+PATIENT_SEARCH_FIELDS = ("search_keys", "search_tokens", "search_trigrams")
+PATIENT_SEARCH_MIN_SIMILARITY = 0.4
+PATIENT_SEARCH_MAX_EXACT_RANK = 4  # rank oltre il quale il match è solo fuzzy
+PATIENT_SEARCH_CANDIDATES = 200  # candidati minimi da classificare (almeno 4 volte il limit)
+
+def normalize_search_text(text: Optional[str]) -> str:
+    """Minuscolo, senza accenti e con i soli caratteri alfanumerici separati da spazio"""
+    folded = unicodedata.normalize("NFKD", text or "")
+    folded = "".join(c for c in folded if not unicodedata.combining(c)).lower()
+    return " ".join("".join(c if c.isalnum() else " " for c in folded).split())
+
+def search_trigrams(tokens: List[str]) -> List[str]:
+    trigrams = set()
+    for token in tokens:
+        padded = f" {token} "
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return sorted(trigrams)
+
+def patient_search_fields(nome: Optional[str], cognome: Optional[str]) -> dict:
+    nome_norm = normalize_search_text(nome)
+    cognome_norm = normalize_search_text(cognome)
+    tokens = sorted(set(f"{cognome_norm} {nome_norm}".split()))
+    return {
+        "search_keys": list(dict.fromkeys(k for k in (f"{cognome_norm} {nome_norm}".strip(), f"{nome_norm} {cognome_norm}".strip()) if k)),
+        "search_tokens": tokens,
+        "search_trigrams": search_trigrams(tokens),
+    }
+
+def with_search_fields(doc: dict) -> dict:
+    """Aggiunge (o aggiorna) le chiavi di ricerca al documento paziente"""
+    doc.update(patient_search_fields(doc.get("nome"), doc.get("cognome")))
+    return doc
+
+def trigram_similarity(query_tokens: List[str], name_tokens: List[str]) -> float:
+    """Media, sulle parole cercate, della miglior similarità (Jaccard sui trigrammi) con una parola del nome"""
+    if not query_tokens or not name_tokens:
+        return 0.0
+    name_sets = [set(search_trigrams([t])) for t in name_tokens]
+    total = 0.0
+    for token in query_tokens:
+        q = set(search_trigrams([token]))
+        total += max(len(q & n) / len(q | n) for n in name_sets)
+    return total / len(query_tokens)
+
+def rank_patient_match(patient: dict, query: str) -> tuple:
+    """Chiave di ordinamento: match esatto, prefisso del nome completo, parole esatte, prefissi, fuzzy"""
+    keys = patient.get("search_keys") or patient_search_fields(patient.get("nome"), patient.get("cognome"))["search_keys"]
+    tokens = normalize_search_text(f"{patient.get('cognome', '')} {patient.get('nome', '')}").split()
+    query_tokens = query.split()
+    exact_words = all(q in tokens for q in query_tokens)
+    key_prefix = any(k.startswith(query) for k in keys)
+    if query in keys:
+        rank = 0
+    elif key_prefix and exact_words:
+        rank = 1
+    elif key_prefix:
+        rank = 2
+    elif exact_words:
+        rank = 3
+    elif all(any(t.startswith(q) for t in tokens) for q in query_tokens):
+        rank = 4
+    else:
+        rank = 5
+    similarity = 1.0 if rank < 5 else trigram_similarity(query_tokens, tokens)
+    return (rank, -similarity, normalize_search_text(patient.get("cognome")), normalize_search_text(patient.get("nome")))
+
+async def search_patients(base_query: dict, text: str, limit: int = 50, projection: Optional[dict] = None) -> List[dict]:
+    """Ricerca pazienti per nome con ranking dei risultati.
+
+    Prima cerca per prefisso di parola sull'indice search_tokens; se i risultati non
+    bastano completa con una ricerca fuzzy sui trigrammi (errori di battitura).
+    I match esatti sono sempre inclusi, anche oltre il numero massimo di candidati.
+    """
+    query = normalize_search_text(text)
+    if not query:
+        return []
+    query_tokens = query.split()
+    if projection:
+        projection = {"_id": 0, **projection, "id": 1, "nome": 1, "cognome": 1, "search_keys": 1}
+        fuzzy_projection = projection
+    else:
+        projection = {"_id": 0}
+        fuzzy_projection = {"_id": 0, "_overlap": 0}
+
+    max_candidates = max(PATIENT_SEARCH_CANDIDATES, limit * 4)
+    prefix_query = {**base_query, "$and": [
+        {"search_tokens": {"$regex": f"^{re.escape(token)}"}} for token in query_tokens
+    ]}
+    exact, candidates = await asyncio.gather(
+        db.patients.find({**prefix_query, "search_keys": query}, projection).to_list(None),
+        db.patients.find(prefix_query, projection).sort(PATIENT_LIST_SORT).to_list(max_candidates),
+    )
+    found = {c["id"] for c in candidates}
+    candidates += [p for p in exact if p["id"] not in found]
+
+    if len(candidates) < limit and len(query) >= 3:
+        found = [c["id"] for c in candidates]
+        fuzzy = await db.patients.aggregate([
+            {"$match": {**base_query, "id": {"$nin": found}, "search_trigrams": {"$in": search_trigrams(query_tokens)}}},
+            {"$addFields": {"_overlap": {"$size": {"$filter": {
+                "input": "$search_trigrams", "cond": {"$in": ["$$this", search_trigrams(query_tokens)]}
+            }}}}},
+            {"$sort": {"_overlap": -1, "id": 1}},
+            {"$limit": max_candidates},
+            {"$project": fuzzy_projection},
+        ]).to_list(None)
+        candidates += [
+            p for p in fuzzy
+            if trigram_similarity(query_tokens, normalize_search_text(f"{p.get('cognome', '')} {p.get('nome', '')}").split()) >= PATIENT_SEARCH_MIN_SIMILARITY
+        ]
+
+    candidates.sort(key=lambda p: rank_patient_match(p, query))
+    return [{k: v for k, v in p.items() if k not in PATIENT_SEARCH_FIELDS} for p in candidates[:limit]]
+
+async def backfill_patient_search_fields() -> int:
+    """Calcola le chiavi di ricerca dei pazienti che ne sono privi (dati legacy)"""
+    missing = await db.patients.find(
+        {"search_tokens": {"$exists": False}}, {"_id": 0, "id": 1, "nome": 1, "cognome": 1}
+    ).to_list(None)
+    if missing:
+        await db.patients.bulk_write([
+            UpdateOne({"id": p["id"]}, {"$set": patient_search_fields(p.get("nome"), p.get("cognome"))})
+            for p in missing
+        ], ordered=False)
+    return len(missing)
+
+# ============== PATIENT DIRECTORY CACHE ==============
+# Elenco compatto dei pazienti di ogni ambulatorio tenuto in memoria e condiviso da
+# agenda, sincronizzazioni e assistente AI. Ogni route che modifica i pazienti lo
+# invalida; se MongoDB supporta i change stream (replica set) anche le modifiche
+# fatte da altri processi lo invalidano subito, altrimenti vale il TTL.
+PATIENT_DIRECTORY_PROJECTION = {"_id": 0, "id": 1, "cognome": 1, "nome": 1, "tipo": 1, "status": 1, "codice_paziente": 1}
+PATIENT_DIRECTORY_TTL = 60  # secondi, usato solo senza change stream
+
+_patient_directory: Dict[str, dict] = {}
+_patient_directory_generation: Dict[str, int] = {}
+_patient_directory_watching = False
+
+def invalidate_patient_directory(ambulatorio: Optional[str] = None) -> None:
+    """Scarta la directory di un ambulatorio (o di tutti se None)"""
+    targets = [ambulatorio] if ambulatorio else list(set(_patient_directory) | set(_patient_directory_generation))
+    for amb in targets:
+        _patient_directory.pop(amb, None)
+        _patient_directory_generation[amb] = _patient_directory_generation.get(amb, 0) + 1
+
+async def get_patient_directory(ambulatorio: str) -> List[dict]:
+    """Pazienti dell'ambulatorio (id, cognome, nome, tipo, status, codice_paziente) ordinati per cognome"""
+    entry = _patient_directory.get(ambulatorio)
+    now = datetime.now(timezone.utc).timestamp()
+    if entry and (_patient_directory_watching or now - entry["loaded_at"] < PATIENT_DIRECTORY_TTL):
+        return [dict(p) for p in entry["patients"]]
+    
+    generation = _patient_directory_generation.get(ambulatorio, 0)
+    patients = await db.patients.find(
+        {"ambulatorio": ambulatorio}, PATIENT_DIRECTORY_PROJECTION
+    ).sort([("cognome", 1), ("nome", 1)]).to_list(None)
+    # Se nel frattempo è arrivata un'invalidazione il risultato potrebbe essere vecchio: non salvarlo
+    if _patient_directory_generation.get(ambulatorio, 0) == generation:
+        _patient_directory[ambulatorio] = {"loaded_at": now, "patients": patients}
+    return [dict(p) for p in patients]
+
+async def watch_patient_changes() -> None:
+    """Invalida la directory a ogni modifica della collection patients (change stream).
+    Se il database non è raggiungibile o lo stream si interrompe riprova; se i change
+    stream non sono supportati si ferma e la directory usa solo il TTL."""
+    global _patient_directory_watching
+    attempt = 0
+    while True:
+        try:
+            async with db.patients.watch(full_document="updateLookup") as stream:
+                _patient_directory_watching = True
+                attempt = 0
+                invalidate_patient_directory()
+                logger.info("Directory pazienti: change stream attivo")
+                async for change in stream:
+                    invalidate_patient_directory((change.get("fullDocument") or {}).get("ambulatorio"))
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            # Change stream non disponibili (es. MongoDB standalone): si usa il TTL
+            logger.info(f"Directory pazienti senza change stream, invalidazione locale e TTL: {e}")
+            return
+        except Exception as e:
+            logger.warning(f"Change stream pazienti interrotto: {e}")
+        finally:
+            _patient_directory_watching = False
+        # Le modifiche perse nel frattempo non vanno servite dalla cache
+        invalidate_patient_directory()
+        await asyncio.sleep(STARTUP_RETRY_DELAYS[min(attempt, len(STARTUP_RETRY_DELAYS) - 1)])
+        attempt += 1
+
 # ============== PATIENTS ROUTES ==============
 @api_router.post("/patients", response_model=Patient, status_code=201)
 async def create_patient(data: PatientCreate, payload: dict = Depends(verify_token)):
@@ -553,44 +1052,135 @@ async def create_patient(data: PatientCreate, payload: dict = Depends(verify_tok
     if data.ambulatorio == Ambulatorio.VILLA_GINESTRE and data.tipo != PatientType.PICC:
         raise HTTPException(status_code=400, detail="Villa delle Ginestre gestisce solo pazienti PICC")
     
-    # Generate unique patient code
-    codice_paziente = generate_patient_code(data.nome, data.cognome)
-    # Ensure uniqueness
-    while await db.patients.find_one({"codice_paziente": codice_paziente}):
-        codice_paziente = generate_patient_code(data.nome, data.cognome)
-    
     patient_data = data.model_dump()
-    patient_data["codice_paziente"] = codice_paziente
     patient_data["scheda_med_counter"] = 0
     patient = Patient(**patient_data)
-    doc = patient.model_dump()
-    await db.patients.insert_one(doc)
+    # Insert with a unique patient code
+    doc = await insert_patient_with_code(patient.model_dump())
+    patient.codice_paziente = doc["codice_paziente"]
     return patient
 
-@api_router.get("/patients", response_model=List[Patient])
+# Vista raggruppata per stato (PazientiPage): solo i campi mostrati nell'elenco
+PATIENT_LIST_PROJECTION = {
+    "_id": 0, "id": 1, "codice_paziente": 1, "nome": 1, "cognome": 1, "tipo": 1, "status": 1,
+    "discharge_reason": 1, "data_dimissione": 1, "created_at": 1,
+}
+
+class PatientListItem(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    codice_paziente: str = ""
+    nome: str = ""
+    cognome: str = ""
+    tipo: Optional[str] = None
+    status: Optional[str] = None
+    discharge_reason: Optional[str] = None
+    data_dimissione: Optional[str] = None
+    created_at: Optional[str] = None
+
+class PatientBucket(BaseModel):
+    patients: List[PatientListItem]
+    count: int
+    per_tipo: Dict[str, int] = {}
+    offset: int
+    has_more: bool
+
+class GroupedPatients(BaseModel):
+    buckets: Dict[str, PatientBucket]
+
+async def get_patients_grouped(query: dict, statuses: List[str], limit: int, offset: int) -> GroupedPatients:
+    """Pazienti suddivisi per stato con conteggi, in un'unica aggregazione $facet"""
+    facets = {
+        status: [
+            {"$match": {"status": status}},
+            {"$sort": {"cognome": 1, "nome": 1, "id": 1}},
+            {"$skip": offset},
+            {"$limit": limit},
+            {"$project": PATIENT_LIST_PROJECTION},
+        ]
+        for status in statuses
+    }
+    facets["_counts"] = [{"$group": {"_id": {"status": "$status", "tipo": "$tipo"}, "count": {"$sum": 1}}}]
+    result = (await db.patients.aggregate([
+        {"$match": {**query, "status": {"$in": statuses}}},
+        {"$facet": facets},
+    ]).to_list(1))[0]
+    
+    per_tipo = {status: {} for status in statuses}
+    for r in result["_counts"]:
+        counts = per_tipo.get(r["_id"].get("status"))
+        if counts is not None:
+            counts[r["_id"].get("tipo") or "non_specificato"] = r["count"]
+    
+    buckets = {}
+    for status in statuses:
+        count = sum(per_tipo[status].values())
+        buckets[status] = PatientBucket(
+            patients=result[status],
+            count=count,
+            per_tipo=per_tipo[status],
+            offset=offset,
+            has_more=offset + len(result[status]) < count,
+        )
+    return GroupedPatients(buckets=buckets)
+
+PATIENT_LIST_SORT = [("cognome", 1), ("nome", 1), ("id", 1)]
+
+@api_router.get("/patients")
 async def get_patients(
+    response: Response,
     ambulatorio: Ambulatorio,
     status: Optional[PatientStatus] = None,
     tipo: Optional[PatientType] = None,
     search: Optional[str] = None,
+    grouped: bool = False,
+    offset: int = Query(0, ge=0),
+    page: PageParams = Depends(),
     payload: dict = Depends(verify_token)
 ):
+    """Elenco pazienti, paginato con limit/cursor (vedi PAGINATION).
+
+    Con grouped=true restituisce i pazienti suddivisi per stato (in_cura, dimesso,
+    sospeso), ognuno con conteggio totale e paginazione indipendente tramite
+    limit/offset; con `status` si pagina un solo gruppo. La ricerca testuale è
+    ordinata per pertinenza e restituisce al massimo `limit` risultati senza cursore.
+    """
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     query = {"ambulatorio": ambulatorio.value}
-    if status:
-        query["status"] = status.value
     if tipo:
         query["tipo"] = tipo.value
+    if grouped:
+        statuses = [status.value] if status else [s.value for s in PatientStatus]
+        return await get_patients_grouped(query, statuses, page.limit or 500, offset)
+    if status:
+        query["status"] = status.value
     if search:
-        query["$or"] = [
-            {"nome": {"$regex": search, "$options": "i"}},
-            {"cognome": {"$regex": search, "$options": "i"}}
-        ]
+        # Risultati ordinati per pertinenza
+        results = await search_patients(query, search, limit=page.limit or PAGE_MAX_LIMIT)
+        return page_response({"items": results, "next_cursor": None, "has_more": False}, page, response, Patient)
     
-    patients = await db.patients.find(query, {"_id": 0}).sort("cognome", 1).to_list(1000)
-    return patients
+    projection = {"_id": 0, **{f: 0 for f in PATIENT_SEARCH_FIELDS}}
+    result = await fetch_page(db.patients, query, PATIENT_LIST_SORT, page, projection)
+    return page_response(result, page, response, Patient)
+
+@api_router.get("/patients/directory")
+async def get_patients_directory(
+    ambulatorio: Ambulatorio,
+    status: Optional[PatientStatus] = None,
+    tipo: Optional[PatientType] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Elenco compatto dei pazienti, servito dalla cache in memoria"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    patients = await get_patient_directory(ambulatorio.value)
+    return [
+        p for p in patients
+        if (not status or p.get("status") == status.value) and (not tipo or p.get("tipo") == tipo.value)
+    ]
 
 @api_router.get("/patients/{patient_id}", response_model=Patient)
 async def get_patient(patient_id: str, payload: dict = Depends(verify_token)):
@@ -615,12 +1205,20 @@ async def update_patient(patient_id: str, data: PatientUpdate, payload: dict = D
     # Se viene modificato nome o cognome, segnala come modificato manualmente
     # Così la sincronizzazione NON sovrascriverà le modifiche
     if "nome" in update_data or "cognome" in update_data:
+        update_data.update(patient_search_fields(
+            update_data.get("nome", patient.get("nome")), update_data.get("cognome", patient.get("cognome"))
+        ))
         update_data["manually_modified"] = True
         update_data["manually_modified_at"] = datetime.now(timezone.utc).isoformat()
         logger.info(f"Paziente {patient_id} marcato come modificato manualmente (nome/cognome)")
     
     await db.patients.update_one({"id": patient_id}, {"$set": update_data})
+    invalidate_patient_directory(patient["ambulatorio"])
     updated = await db.patients.find_one({"id": patient_id}, {"_id": 0})
+    
+    # Propaga il nuovo nome agli appuntamenti (nome denormalizzato)
+    if (updated.get("nome"), updated.get("cognome")) != (patient.get("nome"), patient.get("cognome")):
+        await propagate_patient_name(patient_id, updated.get("nome", ""), updated.get("cognome", ""))
     return updated
 
 @api_router.delete("/patients/{patient_id}")
@@ -631,8 +1229,12 @@ async def delete_patient(patient_id: str, payload: dict = Depends(verify_token))
     if patient["ambulatorio"] not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
+    statistics_days = await get_patient_statistics_days([patient_id])
+    
     # Delete patient
     await db.patients.delete_one({"id": patient_id})
+    invalidate_patient_directory(patient["ambulatorio"])
+    await invalidate_render_cache([patient_id])
     
     # Delete all related records
     await db.schede_impianto_picc.delete_many({"patient_id": patient_id})
@@ -640,7 +1242,10 @@ async def delete_patient(patient_id: str, payload: dict = Depends(verify_token))
     await db.schede_medicazione_med.delete_many({"patient_id": patient_id})
     await db.appointments.delete_many({"patient_id": patient_id})
     await db.prescrizioni.delete_many({"patient_id": patient_id})
-    await db.photos.delete_many({"patient_id": patient_id})
+    await delete_photos({"patient_id": patient_id})
+    
+    await refresh_slot_occupancy_days(statistics_days)
+    await refresh_statistics_rollup_days(statistics_days)
     
     return {"message": "Paziente e tutte le schede correlate eliminati"}
 
@@ -687,6 +1292,7 @@ async def change_patient_type(patient_id: str, data: PatientTypeChange, payload:
             "tipo_changed_from": old_tipo
         }}
     )
+    invalidate_patient_directory(patient["ambulatorio"])
     
     updated = await db.patients.find_one({"id": patient_id}, {"_id": 0})
     logger.info(f"Paziente {patient_id} tipo cambiato: {old_tipo} -> {new_tipo}")
@@ -711,69 +1317,95 @@ class BatchStatusChange(BaseModel):
 class BatchDelete(BaseModel):
     patient_ids: List[str]
 
+def bulk_write_failed_indexes(error: BulkWriteError) -> Dict[int, str]:
+    """Indice del documento -> messaggio, per gli errori di un insert_many(ordered=False)"""
+    return {e["index"]: e.get("errmsg", "Errore di scrittura") for e in error.details.get("writeErrors", [])}
+
 @api_router.post("/patients/batch", status_code=201)
 async def create_patients_batch(data: BatchPatientCreate, payload: dict = Depends(verify_token)):
     """Create multiple patients at once"""
-    created = []
     errors = []
-    impianti_created = 0
+    valid = []
     
     for patient_data in data.patients:
+        if patient_data.ambulatorio.value not in payload["ambulatori"]:
+            errors.append({"patient": f"{patient_data.cognome} {patient_data.nome}", "error": "Non hai accesso a questo ambulatorio"})
+            continue
+        
+        # Villa Ginestre only allows PICC
+        if patient_data.ambulatorio == Ambulatorio.VILLA_GINESTRE and patient_data.tipo != PatientType.PICC:
+            errors.append({"patient": f"{patient_data.cognome} {patient_data.nome}", "error": "Villa delle Ginestre gestisce solo pazienti PICC"})
+            continue
+        
+        valid.append(patient_data)
+    
+    patients = []
+    schede_impianto = []
+    for patient_data in valid:
+        patient_dict = patient_data.model_dump()
+        # Rimuovi i campi impianto dal paziente (sono per la scheda impianto)
+        tipo_impianto = patient_dict.pop("tipo_impianto", None)
+        data_inserimento_impianto = patient_dict.pop("data_inserimento_impianto", None)
+        patient_dict["scheda_med_counter"] = 0
+        patient = Patient(**patient_dict)
+        
+        # Se è un paziente PICC e ha dati dell'impianto, crea la scheda impianto
+        scheda_impianto = None
+        if (patient_data.tipo in [PatientType.PICC, PatientType.PICC_MED] 
+            and tipo_impianto and data_inserimento_impianto):
+            scheda_impianto = {
+                "id": str(uuid.uuid4()),
+                "patient_id": patient.id,
+                "ambulatorio": patient_data.ambulatorio.value,
+                "scheda_type": "semplificata",
+                "tipo_catetere": tipo_impianto,  # picc, picc_port, midline
+                "data_posizionamento": data_inserimento_impianto,
+                "data_impianto": data_inserimento_impianto,
+                "braccio": "",
+                "vena": "",
+                "exit_site_cm": "",
+                "operatore": payload.get("sub", ""),  # Nome dell'operatore corrente
+                "motivazione": [],
+                "disinfezione": [],
+                "allegati": [],
+                "created_at": datetime.now(timezone.utc).isoformat()
+            }
+        patients.append(patient)
+        schede_impianto.append(scheda_impianto)
+    
+    # Insert all patients with unique codes, collecting per-item failures
+    docs = [p.model_dump() for p in patients]
+    failed = await insert_patients_with_codes(docs)
+    
+    created = []
+    schede_to_insert = []
+    schede_patients = []
+    for i, patient in enumerate(patients):
+        if i in failed:
+            errors.append({"patient": f"{patient.cognome} {patient.nome}", "error": failed[i]})
+            continue
+        patient.codice_paziente = docs[i]["codice_paziente"]
+        created.append(patient)
+        if schede_impianto[i]:
+            schede_to_insert.append(schede_impianto[i])
+            schede_patients.append(patient)
+    
+    impianti_created = 0
+    if schede_to_insert:
         try:
-            if patient_data.ambulatorio.value not in payload["ambulatori"]:
-                errors.append({"patient": f"{patient_data.cognome} {patient_data.nome}", "error": "Non hai accesso a questo ambulatorio"})
-                continue
-            
-            # Villa Ginestre only allows PICC
-            if patient_data.ambulatorio == Ambulatorio.VILLA_GINESTRE and patient_data.tipo != PatientType.PICC:
-                errors.append({"patient": f"{patient_data.cognome} {patient_data.nome}", "error": "Villa delle Ginestre gestisce solo pazienti PICC"})
-                continue
-            
-            # Generate unique patient code
-            codice_paziente = generate_patient_code(patient_data.nome, patient_data.cognome)
-            while await db.patients.find_one({"codice_paziente": codice_paziente}):
-                codice_paziente = generate_patient_code(patient_data.nome, patient_data.cognome)
-            
-            # Estrai i dati dell'impianto prima di creare il paziente
-            tipo_impianto = patient_data.tipo_impianto
-            data_inserimento_impianto = patient_data.data_inserimento_impianto
-            
-            patient_dict = patient_data.model_dump()
-            # Rimuovi i campi impianto dal paziente (sono per la scheda impianto)
-            patient_dict.pop("tipo_impianto", None)
-            patient_dict.pop("data_inserimento_impianto", None)
-            patient_dict["codice_paziente"] = codice_paziente
-            patient_dict["scheda_med_counter"] = 0
-            patient = Patient(**patient_dict)
-            doc = patient.model_dump()
-            await db.patients.insert_one(doc)
-            created.append(patient)
-            
-            # Se è un paziente PICC e ha dati dell'impianto, crea la scheda impianto
-            if (patient_data.tipo in [PatientType.PICC, PatientType.PICC_MED] 
-                and tipo_impianto and data_inserimento_impianto):
-                scheda_impianto = {
-                    "id": str(uuid.uuid4()),
-                    "patient_id": patient.id,
-                    "ambulatorio": patient_data.ambulatorio.value,
-                    "scheda_type": "semplificata",
-                    "tipo_catetere": tipo_impianto,  # picc, picc_port, midline
-                    "data_posizionamento": data_inserimento_impianto,
-                    "data_impianto": data_inserimento_impianto,
-                    "braccio": "",
-                    "vena": "",
-                    "exit_site_cm": "",
-                    "operatore": payload.get("sub", ""),  # Nome dell'operatore corrente
-                    "motivazione": [],
-                    "disinfezione": [],
-                    "allegati": [],
-                    "created_at": datetime.now(timezone.utc).isoformat()
-                }
-                await db.schede_impianto_picc.insert_one(scheda_impianto)
-                impianti_created += 1
-                
-        except Exception as e:
-            errors.append({"patient": f"{patient_data.cognome} {patient_data.nome}", "error": str(e)})
+            await db.schede_impianto_picc.insert_many(schede_to_insert, ordered=False)
+            impianti_created = len(schede_to_insert)
+        except BulkWriteError as e:
+            failed_schede = bulk_write_failed_indexes(e)
+            impianti_created = len(schede_to_insert) - len(failed_schede)
+            for i, message in failed_schede.items():
+                patient = schede_patients[i]
+                errors.append({"patient": f"{patient.cognome} {patient.nome}", "error": f"Scheda impianto: {message}"})
+        
+        dates_by_ambulatorio = {}
+        for scheda in schede_to_insert:
+            dates_by_ambulatorio.setdefault(scheda["ambulatorio"], set()).add(scheda["data_impianto"])
+        await refresh_statistics_rollup_days(dates_by_ambulatorio)
     
     return {
         "created": len(created),
@@ -783,39 +1415,55 @@ async def create_patients_batch(data: BatchPatientCreate, payload: dict = Depend
         "error_details": errors
     }
 
+async def resolve_batch_patients(patient_ids: List[str], payload: dict) -> tuple:
+    """Carica con una query i pazienti di un batch.
+
+    Restituisce (pazienti accessibili nell'ordine richiesto, errori per gli id
+    non trovati o di ambulatori non accessibili).
+    """
+    found = await db.patients.find(
+        {"id": {"$in": patient_ids}},
+        {"_id": 0, "id": 1, "nome": 1, "cognome": 1, "ambulatorio": 1}
+    ).to_list(None)
+    by_id = {p["id"]: p for p in found}
+    
+    allowed = []
+    errors = []
+    for patient_id in dict.fromkeys(patient_ids):
+        patient = by_id.get(patient_id)
+        if not patient:
+            errors.append({"patient_id": patient_id, "error": "Paziente non trovato"})
+        elif patient["ambulatorio"] not in payload["ambulatori"]:
+            errors.append({"patient_id": patient_id, "error": "Non hai accesso a questo ambulatorio"})
+        else:
+            allowed.append(patient)
+    return allowed, errors
+
 @api_router.put("/patients/batch/status")
 async def update_patients_status_batch(data: BatchStatusChange, payload: dict = Depends(verify_token)):
     """Change status of multiple patients at once"""
+    patients, errors = await resolve_batch_patients(data.patient_ids, payload)
     updated = []
-    errors = []
     
-    for patient_id in data.patient_ids:
+    update_data = {
+        "status": data.status.value,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    if data.status == PatientStatus.DIMESSO:
+        update_data["discharge_reason"] = data.discharge_reason
+        update_data["discharge_notes"] = data.discharge_notes
+        update_data["data_dimissione"] = datetime.now().strftime("%Y-%m-%d")
+    elif data.status == PatientStatus.SOSPESO:
+        update_data["suspend_notes"] = data.suspend_notes
+    
+    if patients:
         try:
-            patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
-            if not patient:
-                errors.append({"patient_id": patient_id, "error": "Paziente non trovato"})
-                continue
-            
-            if patient["ambulatorio"] not in payload["ambulatori"]:
-                errors.append({"patient_id": patient_id, "error": "Non hai accesso a questo ambulatorio"})
-                continue
-            
-            update_data = {
-                "status": data.status.value,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-            
-            if data.status == PatientStatus.DIMESSO:
-                update_data["discharge_reason"] = data.discharge_reason
-                update_data["discharge_notes"] = data.discharge_notes
-                update_data["data_dimissione"] = datetime.now().strftime("%Y-%m-%d")
-            elif data.status == PatientStatus.SOSPESO:
-                update_data["suspend_notes"] = data.suspend_notes
-            
-            await db.patients.update_one({"id": patient_id}, {"$set": update_data})
-            updated.append({"id": patient_id, "nome": f"{patient['cognome']} {patient['nome']}"})
+            await db.patients.update_many({"id": {"$in": [p["id"] for p in patients]}}, {"$set": update_data})
+            invalidate_patient_directory()
+            updated = [{"id": p["id"], "nome": f"{p['cognome']} {p['nome']}"} for p in patients]
         except Exception as e:
-            errors.append({"patient_id": patient_id, "error": str(e)})
+            errors += [{"patient_id": p["id"], "error": str(e)} for p in patients]
     
     return {
         "updated": len(updated),
@@ -827,32 +1475,34 @@ async def update_patients_status_batch(data: BatchStatusChange, payload: dict =
 @api_router.post("/patients/batch/delete")
 async def delete_patients_batch(data: BatchDelete, payload: dict = Depends(verify_token)):
     """Delete multiple patients at once"""
+    patients, errors = await resolve_batch_patients(data.patient_ids, payload)
     deleted = []
-    errors = []
     
-    for patient_id in data.patient_ids:
+    if patients:
+        ids = [p["id"] for p in patients]
+        related = {"patient_id": {"$in": ids}}
         try:
-            patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
-            if not patient:
-                errors.append({"patient_id": patient_id, "error": "Paziente non trovato"})
-                continue
-            
-            if patient["ambulatorio"] not in payload["ambulatori"]:
-                errors.append({"patient_id": patient_id, "error": "Non hai accesso a questo ambulatorio"})
-                continue
+            statistics_days = await get_patient_statistics_days(ids)
+            
+            # Delete patients and all related records, one write per collection
+            await asyncio.gather(
+                db.patients.delete_many({"id": {"$in": ids}}),
+                db.schede_impianto_picc.delete_many(related),
+                db.schede_gestione_picc.delete_many(related),
+                db.schede_medicazione_med.delete_many(related),
+                db.appointments.delete_many(related),
+                db.prescrizioni.delete_many(related),
+                delete_photos(related)
+            )
+            invalidate_patient_directory()
+            await invalidate_render_cache(ids)
             
-            # Delete patient and all related records
-            await db.patients.delete_one({"id": patient_id})
-            await db.schede_impianto_picc.delete_many({"patient_id": patient_id})
-            await db.schede_gestione_picc.delete_many({"patient_id": patient_id})
-            await db.schede_medicazione_med.delete_many({"patient_id": patient_id})
-            await db.appointments.delete_many({"patient_id": patient_id})
-            await db.prescrizioni.delete_many({"patient_id": patient_id})
-            await db.photos.delete_many({"patient_id": patient_id})
+            await refresh_slot_occupancy_days(statistics_days)
+            await refresh_statistics_rollup_days(statistics_days)
             
-            deleted.append({"id": patient_id, "nome": f"{patient['cognome']} {patient['nome']}"})
+            deleted = [{"id": p["id"], "nome": f"{p['cognome']} {p['nome']}"} for p in patients]
         except Exception as e:
-            errors.append({"patient_id": patient_id, "error": str(e)})
+            errors += [{"patient_id": p["id"], "error": str(e)} for p in patients]
     
     return {
         "deleted": len(deleted),
@@ -914,6 +1564,7 @@ async def create_implants_batch(data: BatchImplantCreate, payload: dict = Depend
                 "created_at": datetime.now(timezone.utc).isoformat()
             }
             await db.schede_impianto_picc.insert_one(scheda_impianto)
+            await refresh_statistics_rollup(scheda_impianto["ambulatorio"], [data_inserimento])
             created.append({
                 "id": scheda_impianto["id"],
                 "patient_id": patient_id,
@@ -948,15 +1599,136 @@ async def search_picc_patients(q: str = "", ambulatorio: str = "", payload: dict
     else:
         query["ambulatorio"] = {"$in": payload["ambulatori"]}
     
+    projection = {"_id": 0, "id": 1, "nome": 1, "cognome": 1, "tipo": 1}
     if q:
-        query["$or"] = [
-            {"nome": {"$regex": q, "$options": "i"}},
-            {"cognome": {"$regex": q, "$options": "i"}}
-        ]
+        patients = await search_patients(query, q, limit=50, projection=projection)
+        return [{k: p.get(k) for k in ("id", "nome", "cognome", "tipo")} for p in patients]
     
-    patients = await db.patients.find(query, {"_id": 0, "id": 1, "nome": 1, "cognome": 1, "tipo": 1}).to_list(50)
+    patients = await db.patients.find(query, projection).to_list(50)
     return patients
 
+# ============== SLOT OCCUPANCY ==============
+# Un documento per (ambulatorio, data, ora, tipo) nella collection slot_occupancy con
+# gli appuntamenti registrati (confirmed), le prenotazioni in corso (pending: posto
+# occupato, appuntamento non ancora scritto) e lo stato di chiusura dello slot.
+# La prenotazione è un'update condizionata, quindi capienza e chiusura sono verificate
+# in un'unica operazione atomica. I documenti sono creati alla prima prenotazione a
+# partire dai dati reali; le operazioni massive (sync, eliminazioni, ripristini) li
+# ricalcolano sul posto. Il ricalcolo è un compare-and-set su version, incrementata
+# a ogni variazione di confirmed, e non tocca le prenotazioni in corso.
+SLOT_CAPACITY = 2
+# Prenotazioni mai confermate né annullate (processo terminato nel frattempo)
+SLOT_PENDING_TIMEOUT = timedelta(minutes=5)
+
+def slot_key(ambulatorio: str, data: str, ora: Optional[str], tipo: Optional[str]) -> dict:
+    return {"ambulatorio": ambulatorio, "data": data, "ora": ora, "tipo": tipo}
+
+def slot_is_closed(closures: List[dict], ora: Optional[str], tipo: Optional[str]) -> bool:
+    """True se una delle chiusure del giorno copre lo slot (ora/tipo None = tutti)"""
+    return any(c.get("ora") in (None, ora) and c.get("tipo") in (None, tipo) for c in closures)
+
+def slot_pending_cutoff() -> str:
+    return (datetime.now(timezone.utc) - SLOT_PENDING_TIMEOUT).isoformat()
+
+async def recount_slot_occupancy(ambulatorio: str, data: str, ora: str, tipo: str) -> None:
+    """Ricalcola appuntamenti e chiusura di uno slot dai dati reali (creandolo se manca)"""
+    key = slot_key(ambulatorio, data, ora, tipo)
+    closures = await db.closed_slots.find(
+        {"ambulatorio": ambulatorio, "data": data}, {"_id": 0, "ora": 1, "tipo": 1}
+    ).to_list(None)
+    closed = slot_is_closed(closures, ora, tipo)
+    while True:
+        slot = await db.slot_occupancy.find_one(key, {"_id": 0, "version": 1})
+        count = await db.appointments.count_documents(key)
+        if slot is None:
+            try:
+                await db.slot_occupancy.insert_one({**key, "confirmed": count, "pending": [], "closed": closed, "version": 0})
+                return
+            except DuplicateKeyError:
+                # Creato nel frattempo da una richiesta concorrente
+                continue
+        # Se version è cambiata un appuntamento è stato confermato o liberato durante il conteggio
+        result = await db.slot_occupancy.update_one(
+            {**key, "version": slot.get("version")},
+            {
+                "$set": {"confirmed": count, "closed": closed},
+                "$inc": {"version": 1},
+                "$pull": {"pending": {"at": {"$lt": slot_pending_cutoff()}}},
+                "$unset": {"count": ""},
+            }
+        )
+        if result.matched_count:
+            return
+
+async def reserve_slot(ambulatorio: str, data: str, ora: str, tipo: str) -> str:
+    """Occupa un posto nello slot e restituisce l'id della prenotazione, da confermare
+    con confirm_slot dopo aver scritto l'appuntamento (o da annullare con cancel_slot).
+    Solleva 400 se lo slot è pieno o chiuso."""
+    key = slot_key(ambulatorio, data, ora, tipo)
+    reservation = {"id": str(uuid.uuid4()), "at": datetime.now(timezone.utc).isoformat()}
+    initialized = False
+    while True:
+        result = await db.slot_occupancy.update_one(
+            {
+                **key, "confirmed": {"$exists": True}, "closed": {"$ne": True},
+                "$expr": {"$lt": [{"$add": ["$confirmed", {"$size": {"$ifNull": ["$pending", []]}}]}, SLOT_CAPACITY]},
+            },
+            {"$push": {"pending": reservation}}
+        )
+        if result.modified_count:
+            return reservation["id"]
+        slot = await db.slot_occupancy.find_one(key, {"_id": 0, "closed": 1, "confirmed": 1, "pending": 1})
+        if (slot is None or "confirmed" not in slot) and not initialized:
+            await recount_slot_occupancy(ambulatorio, data, ora, tipo)
+            initialized = True
+            continue
+        if slot and slot.get("closed"):
+            raise HTTPException(status_code=400, detail="Slot chiuso")
+        cutoff = slot_pending_cutoff()
+        if slot and any(r.get("at", "") < cutoff for r in slot.get("pending") or []):
+            await db.slot_occupancy.update_one(key, {"$pull": {"pending": {"at": {"$lt": cutoff}}}})
+            continue
+        raise HTTPException(status_code=400, detail=f"Slot pieno (max {SLOT_CAPACITY} pazienti)")
+
+async def confirm_slot(ambulatorio: str, data: str, ora: str, tipo: str, reservation_id: str) -> None:
+    """Trasforma la prenotazione in un appuntamento registrato"""
+    key = slot_key(ambulatorio, data, ora, tipo)
+    result = await db.slot_occupancy.update_one(
+        {**key, "pending.id": reservation_id},
+        {"$pull": {"pending": {"id": reservation_id}}, "$inc": {"confirmed": 1, "version": 1}}
+    )
+    if not result.modified_count:
+        # Prenotazione scaduta o slot ricalcolato nel frattempo: si riparte dai dati reali
+        await recount_slot_occupancy(ambulatorio, data, ora, tipo)
+
+async def cancel_slot(ambulatorio: str, data: str, ora: str, tipo: str, reservation_id: str) -> None:
+    """Annulla una prenotazione il cui appuntamento non è stato scritto"""
+    await db.slot_occupancy.update_one(
+        slot_key(ambulatorio, data, ora, tipo), {"$pull": {"pending": {"id": reservation_id}}}
+    )
+
+async def release_slot(ambulatorio: str, data: str, ora: str, tipo: str) -> None:
+    """Libera il posto di un appuntamento eliminato (se il documento di occupazione esiste)"""
+    await db.slot_occupancy.update_one(
+        {**slot_key(ambulatorio, data, ora, tipo), "confirmed": {"$gt": 0}},
+        {"$inc": {"confirmed": -1, "version": 1}}
+    )
+
+async def refresh_slot_occupancy(ambulatorio: str, dates) -> None:
+    """Ricalcola sul posto l'occupazione degli slot dei giorni indicati"""
+    days = sorted({d[:10] for d in dates if d})
+    if not ambulatorio or not days:
+        return
+    slots = await db.slot_occupancy.find(
+        {"ambulatorio": ambulatorio, "data": {"$in": days}}, {"_id": 0, "data": 1, "ora": 1, "tipo": 1}
+    ).to_list(None)
+    for slot in slots:
+        await recount_slot_occupancy(ambulatorio, slot["data"], slot.get("ora"), slot.get("tipo"))
+
+async def refresh_slot_occupancy_days(days: Dict[str, set]) -> None:
+    for ambulatorio, dates in days.items():
+        await refresh_slot_occupancy(ambulatorio, dates)
+
 # ============== APPOINTMENTS ROUTES ==============
 @api_router.post("/appointments", response_model=Appointment)
 async def create_appointment(data: AppointmentCreate, payload: dict = Depends(verify_token)):
@@ -968,15 +1740,8 @@ async def create_appointment(data: AppointmentCreate, payload: dict = Depends(ve
     if not patient:
         raise HTTPException(status_code=404, detail="Paziente non trovato")
     
-    # Check slot availability (max 2 per type per slot)
-    existing = await db.appointments.count_documents({
-        "ambulatorio": data.ambulatorio.value,
-        "data": data.data,
-        "ora": data.ora,
-        "tipo": data.tipo
-    })
-    if existing >= 2:
-        raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
+    # Reserve a place in the slot (max 2 per type per slot, closed slots rejected)
+    reservation = await reserve_slot(data.ambulatorio.value, data.data, data.ora, data.tipo)
     
     appointment = Appointment(
         **data.model_dump(),
@@ -984,16 +1749,24 @@ async def create_appointment(data: AppointmentCreate, payload: dict = Depends(ve
         patient_cognome=patient["cognome"]
     )
     doc = appointment.model_dump()
-    await db.appointments.insert_one(doc)
+    try:
+        await db.appointments.insert_one(doc)
+    except Exception:
+        await cancel_slot(data.ambulatorio.value, data.data, data.ora, data.tipo, reservation)
+        raise
+    await confirm_slot(data.ambulatorio.value, data.data, data.ora, data.tipo, reservation)
+    await refresh_statistics_rollup(doc["ambulatorio"], [doc["data"]])
     return appointment
 
-@api_router.get("/appointments", response_model=List[Appointment])
+@api_router.get("/appointments")
 async def get_appointments(
+    response: Response,
     ambulatorio: Ambulatorio,
     data: Optional[str] = None,
     data_from: Optional[str] = None,
     data_to: Optional[str] = None,
     tipo: Optional[str] = None,
+    page: PageParams = Depends(),
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
@@ -1007,22 +1780,44 @@ async def get_appointments(
     if tipo:
         query["tipo"] = tipo
     
-    appointments = await db.appointments.find(query, {"_id": 0}).sort([("data", 1), ("ora", 1)]).to_list(1000)
-    
-    # Ensure patient names are populated (for old appointments without this data)
-    for apt in appointments:
-        if not apt.get("patient_nome") or not apt.get("patient_cognome"):
-            patient = await db.patients.find_one({"id": apt.get("patient_id")}, {"_id": 0})
-            if patient:
-                apt["patient_nome"] = patient.get("nome", "")
-                apt["patient_cognome"] = patient.get("cognome", "")
-                # Update the appointment in DB for future queries
-                await db.appointments.update_one(
-                    {"id": apt["id"]},
-                    {"$set": {"patient_nome": apt["patient_nome"], "patient_cognome": apt["patient_cognome"]}}
-                )
+    result = await fetch_page(db.appointments, query, [("data", 1), ("ora", 1), ("id", 1)], page)
+    return page_response(result, page, response, Appointment)
+
+async def propagate_patient_name(patient_id: str, nome: str, cognome: str) -> None:
+    """Aggiorna il nome denormalizzato del paziente in tutti i suoi appuntamenti"""
+    await db.appointments.update_many(
+        {"patient_id": patient_id},
+        {"$set": {"patient_nome": nome, "patient_cognome": cognome}}
+    )
+
+async def backfill_appointment_patient_names(ambulatori: Optional[List[str]] = None) -> Dict[str, int]:
+    """Copia nome e cognome del paziente negli appuntamenti che ne sono privi (dati legacy).
+    Eseguita una volta all'avvio; senza ambulatori considera tutti gli ambulatori."""
+    query = {"$or": [{"patient_nome": {"$in": [None, ""]}}, {"patient_cognome": {"$in": [None, ""]}}]}
+    if ambulatori is not None:
+        query["ambulatorio"] = {"$in": ambulatori}
+    patient_ids = await db.appointments.distinct("patient_id", query)
+    patients = await get_patients_by_ids(patient_ids)
+    
+    updated = 0
+    if patients:
+        result = await db.appointments.bulk_write([
+            UpdateMany(
+                {**query, "patient_id": patient["id"]},
+                {"$set": {"patient_nome": patient.get("nome", ""), "patient_cognome": patient.get("cognome", "")}}
+            )
+            for patient in patients.values()
+        ], ordered=False)
+        updated = result.modified_count
     
-    return appointments
+    orphans = await db.appointments.count_documents(query)
+    logger.info(f"Migrazione nomi appuntamenti: {updated} aggiornati, {orphans} senza paziente")
+    return {"updated": updated, "patients": len(patients), "without_patient": orphans}
+
+@api_router.post("/appointments/migrate-patient-names")
+async def migrate_appointment_patient_names(payload: dict = Depends(verify_token)):
+    """Ripete la migrazione dei nomi negli appuntamenti degli ambulatori dell'utente"""
+    return await backfill_appointment_patient_names(payload["ambulatori"])
 
 # ============== CONTEGGI GIORNALIERI PICC/MED ==============
 @api_router.get("/appointments/daily-counts")
@@ -1036,6 +1831,10 @@ async def get_daily_counts(
     if ambulatorio not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
+    return {"counts": await compute_daily_counts(ambulatorio, start_date, end_date)}
+
+async def compute_daily_counts(ambulatorio: str, start_date: str, end_date: str) -> Dict[str, dict]:
+    """Conteggi PICC/MED per giorno nell'intervallo [start_date, end_date]"""
     pipeline = [
         {
             "$match": {
@@ -1063,7 +1862,7 @@ async def get_daily_counts(
         counts_by_date[data][tipo] = r["count"]
         counts_by_date[data]["total"] += r["count"]
     
-    return {"counts": counts_by_date}
+    return counts_by_date
 
 # ============== SISTEMA DI REVISIONE MANUALE ==============
 class RevisionScope(str, Enum):
@@ -1204,7 +2003,10 @@ async def check_revisions(
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     date_list = [d.strip() for d in dates.split(",")]
-    
+    return {"revised_dates": await find_revised_dates(ambulatorio, date_list)}
+
+async def find_revised_dates(ambulatorio: str, date_list: List[str]) -> Dict[str, List[dict]]:
+    """Mappa data -> revisioni attive che coprono quella data"""
     # Trova tutte le revisioni che coprono queste date
     revisions = await db.revisions.find({
         "ambulatorio": ambulatorio,
@@ -1240,7 +2042,7 @@ async def check_revisions(
                 })
             current += timedelta(days=1)
     
-    return {"revised_dates": revised_dates}
+    return revised_dates
 
 @api_router.put("/appointments/{appointment_id}", response_model=Appointment)
 async def update_appointment(appointment_id: str, data: dict, payload: dict = Depends(verify_token)):
@@ -1284,10 +2086,24 @@ async def update_appointment(appointment_id: str, data: dict, payload: dict = De
             )
             logger.info(f"Modifica manuale salvata per appuntamento {appointment_id}")
     
+    # Spostamento in un altro slot: il posto di destinazione va occupato prima di scrivere
+    source = (appointment.get("data"), appointment.get("ora"), appointment.get("tipo"))
+    target = tuple(data.get(k, appointment.get(k)) for k in ("data", "ora", "tipo"))
+    reservation = await reserve_slot(appointment["ambulatorio"], *target) if target != source else None
+    
     logger.info(f"Updating appointment {appointment_id} with data: {data}")
-    await db.appointments.update_one({"id": appointment_id}, {"$set": data})
+    try:
+        await db.appointments.update_one({"id": appointment_id}, {"$set": data})
+    except Exception:
+        if reservation:
+            await cancel_slot(appointment["ambulatorio"], *target, reservation)
+        raise
+    if reservation:
+        await confirm_slot(appointment["ambulatorio"], *target, reservation)
+        await release_slot(appointment["ambulatorio"], *source)
     updated = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
     logger.info(f"Updated appointment {appointment_id}, manually_modified: {updated.get('manually_modified', 'NOT_SET')}")
+    await refresh_statistics_rollup(appointment["ambulatorio"], [appointment.get("data"), updated.get("data")])
     return updated
 
 @api_router.delete("/appointments/{appointment_id}")
@@ -1299,6 +2115,8 @@ async def delete_appointment(appointment_id: str, payload: dict = Depends(verify
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.appointments.delete_one({"id": appointment_id})
+    await release_slot(appointment["ambulatorio"], appointment.get("data"), appointment.get("ora"), appointment.get("tipo"))
+    await refresh_statistics_rollup(appointment["ambulatorio"], [appointment.get("data")])
     return {"message": "Appuntamento eliminato"}
 
 # ============== SLOT CHIUSI (CHIUDI AGENDA) ==============
@@ -1345,14 +2163,18 @@ async def create_closed_slots(data: ClosedSlotCreate, payload: dict = Depends(ve
             # Restituisci senza _id
             created_slots.append({k: v for k, v in closed_slot.items() if k != "_id"})
     
+    if created_slots:
+        await refresh_slot_occupancy(data.ambulatorio.value, [data.data])
     return {"created": len(created_slots), "slots": created_slots}
 
 @api_router.get("/closed-slots")
 async def get_closed_slots(
+    response: Response,
     ambulatorio: str,
     data: Optional[str] = None,
     data_from: Optional[str] = None,
     data_to: Optional[str] = None,
+    page: PageParams = Depends(),
     payload: dict = Depends(verify_token)
 ):
     """Ottiene gli slot chiusi per un ambulatorio"""
@@ -1365,8 +2187,8 @@ async def get_closed_slots(
     elif data_from and data_to:
         query["data"] = {"$gte": data_from, "$lte": data_to}
     
-    closed_slots = await db.closed_slots.find(query, {"_id": 0}).to_list(1000)
-    return closed_slots
+    result = await fetch_page(db.closed_slots, query, [("data", 1), ("ora", 1), ("id", 1)], page)
+    return page_response(result, page, response)
 
 @api_router.delete("/closed-slots/{slot_id}")
 async def delete_closed_slot(slot_id: str, payload: dict = Depends(verify_token)):
@@ -1378,6 +2200,7 @@ async def delete_closed_slot(slot_id: str, payload: dict = Depends(verify_token)
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.closed_slots.delete_one({"id": slot_id})
+    await refresh_slot_occupancy(closed_slot["ambulatorio"], [closed_slot.get("data")])
     return {"message": "Slot riaperto"}
 
 @api_router.post("/closed-slots/reopen-day")
@@ -1393,6 +2216,7 @@ async def reopen_day(data: dict, payload: dict = Depends(verify_token)):
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     result = await db.closed_slots.delete_many({"ambulatorio": ambulatorio, "data": data_str})
+    await refresh_slot_occupancy(ambulatorio, [data_str])
     return {"message": f"{result.deleted_count} slot riaperti", "deleted_count": result.deleted_count}
 
 # ============== SCHEDE MEDICAZIONE MED ==============
@@ -1401,23 +2225,17 @@ async def create_scheda_medicazione_med(data: SchedaMedicazioneMEDCreate, payloa
     if data.ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Get patient to use their code
-    patient = await db.patients.find_one({"id": data.patient_id}, {"_id": 0})
+    # Get next scheda number for this patient, together with the patient code
+    patient = await next_patient_sequence(data.patient_id, "scheda_med_counter")
     if not patient:
         raise HTTPException(status_code=404, detail="Paziente non trovato")
+    counter = patient["scheda_med_counter"]
     
     # Get or generate patient code
     codice_paziente = patient.get("codice_paziente")
     if not codice_paziente:
         # Generate code for existing patient without one
-        codice_paziente = generate_patient_code(patient.get("nome", ""), patient.get("cognome", ""))
-        while await db.patients.find_one({"codice_paziente": codice_paziente, "id": {"$ne": data.patient_id}}):
-            codice_paziente = generate_patient_code(patient.get("nome", ""), patient.get("cognome", ""))
-        await db.patients.update_one({"id": data.patient_id}, {"$set": {"codice_paziente": codice_paziente}})
-    
-    # Get next scheda number for this patient
-    counter = patient.get("scheda_med_counter", 0) + 1
-    await db.patients.update_one({"id": data.patient_id}, {"$set": {"scheda_med_counter": counter}})
+        codice_paziente = await assign_patient_code(patient)
     
     # Generate scheda code: codice_paziente-numero (es. m234h-1)
     codice = f"{codice_paziente}-{counter}"
@@ -1429,20 +2247,24 @@ async def create_scheda_medicazione_med(data: SchedaMedicazioneMEDCreate, payloa
     await db.schede_medicazione_med.insert_one(doc)
     return scheda
 
-@api_router.get("/schede-medicazione-med", response_model=List[SchedaMedicazioneMED])
+@api_router.get("/schede-medicazione-med")
 async def get_schede_medicazione_med(
+    response: Response,
     patient_id: str,
     ambulatorio: Ambulatorio,
+    page: PageParams = Depends(),
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    schede = await db.schede_medicazione_med.find(
+    result = await fetch_page(
+        db.schede_medicazione_med,
         {"patient_id": patient_id, "ambulatorio": ambulatorio.value},
-        {"_id": 0}
-    ).sort("data_compilazione", -1).to_list(1000)
-    return schede
+        [("data_compilazione", -1), ("id", -1)],
+        page
+    )
+    return page_response(result, page, response, SchedaMedicazioneMED)
 
 @api_router.get("/schede-medicazione-med/{scheda_id}", response_model=SchedaMedicazioneMED)
 async def get_scheda_medicazione_med(scheda_id: str, payload: dict = Depends(verify_token)):
@@ -1465,6 +2287,114 @@ async def update_scheda_medicazione_med(scheda_id: str, data: dict, payload: dic
     updated = await db.schede_medicazione_med.find_one({"id": scheda_id}, {"_id": 0})
     return updated
 
+# ============== PDF TOOLKIT ==============
+# Stili, template di tabella e impaginazione condivisi dai generatori PDF.
+# Vengono costruiti una sola volta all'import del modulo (quindi una volta per
+# processo del pool di rendering) invece che a ogni documento: ParagraphStyle e
+# TableStyle non vengono modificati da Paragraph/Table e si possono riusare.
+# Se cambia l'aspetto dei documenti va incrementato PDF_TEMPLATE_VERSION, che fa
+# parte della chiave della cache di rendering.
+PDF_TEMPLATE_VERSION = 2
+
+_pdf_sample_styles = getSampleStyleSheet()
+
+PDF_STYLES = {
+    # Cartella paziente
+    "folder_title": ParagraphStyle('CustomTitle', parent=_pdf_sample_styles['Heading1'], fontSize=18, spaceAfter=30, alignment=TA_CENTER),
+    "folder_heading": ParagraphStyle('CustomHeading', parent=_pdf_sample_styles['Heading2'], fontSize=14, spaceAfter=12, textColor=colors.HexColor('#1e40af')),
+    "folder_normal": ParagraphStyle('CustomNormal', parent=_pdf_sample_styles['Normal'], fontSize=11, spaceAfter=6),
+    # Scheda impianto (modulo ufficiale, caratteri piccoli)
+    "scheda_title": ParagraphStyle('SchedaTitle', fontSize=11, alignment=TA_CENTER, fontName='Helvetica-Bold', spaceAfter=3),
+    "scheda_section": ParagraphStyle('SchedaSection', fontSize=9, fontName='Helvetica-Bold', alignment=TA_CENTER,
+                                     backColor=colors.HexColor('#e5e7eb'), spaceBefore=6, spaceAfter=3),
+    "scheda_normal": ParagraphStyle('SchedaNormal', fontSize=7, spaceAfter=2, fontName='Helvetica'),
+    "scheda_small": ParagraphStyle('SchedaSmall', fontSize=6.5, spaceAfter=1, fontName='Helvetica'),
+    "scheda_italic": ParagraphStyle('SchedaItalic', fontSize=6, fontName='Helvetica-Oblique', textColor=colors.grey),
+    "scheda_right": ParagraphStyle('SchedaRight', fontSize=7, alignment=TA_RIGHT),
+}
+
+def _boxed_table_style(font_size: float, padding: int) -> TableStyle:
+    return TableStyle([
+        ('FONTSIZE', (0, 0), (-1, -1), font_size),
+        ('BOX', (0, 0), (-1, -1), 1, colors.black),
+        ('INNERGRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('TOPPADDING', (0, 0), (-1, -1), padding),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), padding),
+    ])
+
+PDF_TABLE_STYLES = {
+    # Coppie etichetta/valore (dati anagrafici)
+    "label_value": TableStyle([
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+        ('TOPPADDING', (0, 0), (-1, -1), 6),
+    ]),
+    # Griglia giornaliera delle schede gestione PICC
+    "gestione_grid": TableStyle([
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 1), (0, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 6),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#166534')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+        ('TOPPADDING', (0, 0), (-1, -1), 2),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f0f0f0')]),
+    ]),
+    # Tabelle dei report statistici: intestazione colorata, numeri allineati a destra
+    "report_grid": TableStyle([
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1e40af')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+        ('TOPPADDING', (0, 0), (-1, -1), 4),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f0f4ff')]),
+    ]),
+    # Riquadri della scheda impianto
+    "scheda_header": _boxed_table_style(6.5, 2),
+    "scheda_footer": _boxed_table_style(7, 4),
+}
+
+# Margini per tipo di documento: la scheda impianto riproduce il modulo ufficiale
+# e occupa quasi tutta la pagina
+PDF_PAGE_LAYOUTS = {
+    "folder": {"topMargin": 2*cm, "bottomMargin": 2*cm, "leftMargin": 2*cm, "rightMargin": 2*cm},
+    "scheda": {"topMargin": 0.5*cm, "bottomMargin": 0.5*cm, "leftMargin": 0.8*cm, "rightMargin": 0.8*cm},
+}
+
+def pdf_page_footer(canvas, doc):
+    """Piè di pagina delle cartelle: titolo del documento e numero di pagina"""
+    canvas.saveState()
+    canvas.setFont('Helvetica', 8)
+    canvas.setFillColor(colors.grey)
+    y = doc.bottomMargin / 2
+    if doc.title:
+        canvas.drawString(doc.leftMargin, y, doc.title)
+    canvas.drawRightString(doc.pagesize[0] - doc.rightMargin, y, f"Pagina {doc.page}")
+    canvas.restoreState()
+
+PDF_PAGE_CALLBACKS = {
+    "folder": pdf_page_footer,
+    "scheda": None,
+}
+
+def build_pdf(story: list, layout: str, title: str = "") -> bytes:
+    """Impagina la story su A4 con margini e piè di pagina del layout indicato"""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, title=title, **PDF_PAGE_LAYOUTS[layout])
+    on_page = PDF_PAGE_CALLBACKS[layout]
+    if on_page:
+        doc.build(story, onFirstPage=on_page, onLaterPages=on_page)
+    else:
+        doc.build(story)
+    return buffer.getvalue()
+
 # ============== SCHEDE IMPIANTO PICC ==============
 @api_router.post("/schede-impianto-picc", response_model=SchedaImpiantoPICC)
 async def create_scheda_impianto_picc(data: SchedaImpiantoPICCCreate, payload: dict = Depends(verify_token)):
@@ -1474,22 +2404,27 @@ async def create_scheda_impianto_picc(data: SchedaImpiantoPICCCreate, payload: d
     scheda = SchedaImpiantoPICC(**data.model_dump())
     doc = scheda.model_dump()
     await db.schede_impianto_picc.insert_one(doc)
+    await refresh_statistics_rollup(doc["ambulatorio"], [doc.get("data_impianto")])
     return scheda
 
-@api_router.get("/schede-impianto-picc", response_model=List[SchedaImpiantoPICC])
+@api_router.get("/schede-impianto-picc")
 async def get_schede_impianto_picc(
+    response: Response,
     patient_id: str,
     ambulatorio: Ambulatorio,
+    page: PageParams = Depends(),
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    schede = await db.schede_impianto_picc.find(
+    result = await fetch_page(
+        db.schede_impianto_picc,
         {"patient_id": patient_id, "ambulatorio": ambulatorio.value},
-        {"_id": 0}
-    ).sort("data_impianto", -1).to_list(1000)
-    return schede
+        [("data_impianto", -1), ("id", -1)],
+        page
+    )
+    return page_response(result, page, response, SchedaImpiantoPICC)
 
 @api_router.put("/schede-impianto-picc/{scheda_id}", response_model=SchedaImpiantoPICC)
 async def update_scheda_impianto_picc(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
@@ -1501,9 +2436,65 @@ async def update_scheda_impianto_picc(scheda_id: str, data: dict, payload: dict
     
     await db.schede_impianto_picc.update_one({"id": scheda_id}, {"$set": data})
     updated = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
+    await refresh_statistics_rollup(scheda["ambulatorio"], [scheda.get("data_impianto"), updated.get("data_impianto")])
     return updated
 
 # ============== IMPIANTI LIST ENDPOINT ==============
+IMPIANTO_DATE_FIELDS = ["data_posizionamento", "data_impianto"]
+
+def parse_data_impianto(value: str) -> Optional[str]:
+    """Normalizza una data d'impianto (dd/mm/yy, dd/mm/yyyy o YYYY-MM-DD) in YYYY-MM-DD"""
+    if not value:
+        return None
+    try:
+        if "/" in value:
+            parts = value.split("/")
+            if len(parts) != 3:
+                return None
+            if len(parts[2]) == 2:
+                parts[2] = "20" + parts[2]
+            value = f"{parts[2]}-{parts[1].zfill(2)}-{parts[0].zfill(2)}"
+        datetime.strptime(value, "%Y-%m-%d")
+        return value
+    except ValueError:
+        return None
+
+def build_impianto_date_filter(anno: int = None, mese: int = None) -> Optional[dict]:
+    """Filtro MongoDB per anno/mese sui campi data delle schede impianto.
+
+    Le date possono essere salvate in formato ISO o dd/mm/yy(yy): per ogni campo
+    si combinano un range ISO e una regex ancorata sul formato con le barre.
+    """
+    if not anno and not mese:
+        return None
+
+    if anno and mese:
+        iso_start = f"{anno}-{mese:02d}-01"
+        iso_end = f"{anno + 1}-01-01" if mese == 12 else f"{anno}-{mese + 1:02d}-01"
+        iso_cond = {"$gte": iso_start, "$lt": iso_end}
+        slash_regex = rf"^\d{{1,2}}/0?{mese}/({anno}|{anno % 100:02d})$"
+    elif anno:
+        iso_cond = {"$gte": f"{anno}-01-01", "$lt": f"{anno + 1}-01-01"}
+        slash_regex = rf"^\d{{1,2}}/\d{{1,2}}/({anno}|{anno % 100:02d})$"
+    else:
+        iso_cond = {"$regex": rf"^\d{{4}}-{mese:02d}-"}
+        slash_regex = rf"^\d{{1,2}}/0?{mese}/\d{{2,4}}$"
+
+    conditions = []
+    for field in IMPIANTO_DATE_FIELDS:
+        conditions.append({field: iso_cond})
+        conditions.append({field: {"$regex": slash_regex}})
+    return {"$or": conditions}
+
+async def get_patients_by_ids(patient_ids, projection: dict = None) -> Dict[str, dict]:
+    """Carica in una sola query i pazienti indicati, indicizzati per id"""
+    ids = list({pid for pid in patient_ids if pid})
+    if not ids:
+        return {}
+    projection = projection or {"_id": 0, "id": 1, "nome": 1, "cognome": 1}
+    patients = await db.patients.find({"id": {"$in": ids}}, projection).to_list(None)
+    return {p["id"]: p for p in patients}
+
 @api_router.get("/impianti")
 async def get_impianti_list(
     ambulatorio: str,
@@ -1523,8 +2514,17 @@ async def get_impianti_list(
     if tipo_impianto and tipo_impianto != "tutti":
         query["tipo_catetere"] = tipo_impianto
     
-    # Get all schede that match the query
-    schede = await db.schede_impianto_picc.find(query, {"_id": 0}).to_list(10000)
+    # Filter by anno/mese directly in the query
+    date_filter = build_impianto_date_filter(anno, mese)
+    if date_filter:
+        query.update(date_filter)
+    
+    projection = {"_id": 0, "id": 1, "patient_id": 1, "tipo_catetere": 1,
+                  "data_posizionamento": 1, "data_impianto": 1}
+    schede = await db.schede_impianto_picc.find(query, projection).to_list(None)
+    
+    # Get all patients with a single query
+    patients = await get_patients_by_ids(s.get("patient_id") for s in schede)
     
     # Build result with patient info
     result = []
@@ -1533,35 +2533,18 @@ async def get_impianti_list(
         data_impianto = scheda.get("data_posizionamento") or scheda.get("data_impianto")
         if not data_impianto:
             continue
-            
-        # Parse date for filtering
-        try:
-            # Handle different date formats
-            if "/" in data_impianto:
-                parts = data_impianto.split("/")
-                if len(parts) == 3:
-                    if len(parts[2]) == 2:
-                        parts[2] = "20" + parts[2]
-                    parsed_date = f"{parts[2]}-{parts[1].zfill(2)}-{parts[0].zfill(2)}"
-            else:
-                parsed_date = data_impianto
-                
-            date_obj = datetime.strptime(parsed_date, "%Y-%m-%d")
-            
-            # Filter by anno
-            if anno and date_obj.year != anno:
+        
+        parsed_date = parse_data_impianto(data_impianto)
+        if anno or mese:
+            # La query può includere schede in cui solo il campo secondario corrisponde
+            if not parsed_date:
                 continue
-            # Filter by mese
-            if mese and date_obj.month != mese:
+            if anno and int(parsed_date[:4]) != anno:
                 continue
-                
-        except (ValueError, IndexError):
-            # Skip entries with invalid dates if filtering is active
-            if anno or mese:
+            if mese and int(parsed_date[5:7]) != mese:
                 continue
         
-        # Get patient info
-        patient = await db.patients.find_one({"id": scheda["patient_id"]}, {"_id": 0})
+        patient = patients.get(scheda.get("patient_id"))
         if not patient:
             continue
         
@@ -1571,26 +2554,13 @@ async def get_impianti_list(
             "patient_nome": patient.get("nome", ""),
             "patient_cognome": patient.get("cognome", ""),
             "data_impianto": data_impianto,
-            "data_impianto_parsed": parsed_date if 'parsed_date' in dir() else data_impianto,
+            "data_impianto_parsed": parsed_date or data_impianto,
             "tipo_impianto": scheda.get("tipo_catetere", "N/D"),
             "ambulatorio": ambulatorio
         })
     
-    # Sort by date (most recent first within each month)
-    def parse_date_for_sort(item):
-        try:
-            d = item.get("data_impianto_parsed") or item.get("data_impianto")
-            if "/" in d:
-                parts = d.split("/")
-                if len(parts) == 3:
-                    if len(parts[2]) == 2:
-                        parts[2] = "20" + parts[2]
-                    return f"{parts[2]}-{parts[1].zfill(2)}-{parts[0].zfill(2)}"
-            return d
-        except:
-            return "0000-00-00"
-    
-    result.sort(key=lambda x: parse_date_for_sort(x), reverse=False)
+    # Sort by date (oldest first)
+    result.sort(key=lambda x: parse_data_impianto(x["data_impianto"]) or "0000-00-00")
     
     return {
         "impianti": result,
@@ -1638,7 +2608,12 @@ async def get_espianti_list(
         "prestazioni": {"$in": espianto_types}
     }
     
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(10000)
+    projection = {"_id": 0, "id": 1, "patient_id": 1, "data": 1, "prestazioni": 1,
+                  "patient_nome": 1, "patient_cognome": 1}
+    appointments = await db.appointments.find(query, projection).sort("data", 1).to_list(None)
+    
+    # Get all patients with a single query
+    patients = await get_patients_by_ids(apt.get("patient_id") for apt in appointments)
     
     # Build result
     result = []
@@ -1646,17 +2621,11 @@ async def get_espianti_list(
         prestazioni = apt.get("prestazioni", [])
         
         # Find which espianto type
-        espianto_tipo = None
-        for et in espianto_types:
-            if et in prestazioni:
-                espianto_tipo = et
-                break
-        
+        espianto_tipo = next((et for et in espianto_types if et in prestazioni), None)
         if not espianto_tipo:
             continue
         
-        # Get patient info
-        patient = await db.patients.find_one({"id": apt.get("patient_id")}, {"_id": 0})
+        patient = patients.get(apt.get("patient_id"))
         
         result.append({
             "appointment_id": apt.get("id"),
@@ -1668,9 +2637,6 @@ async def get_espianti_list(
             "ambulatorio": ambulatorio
         })
     
-    # Sort by date
-    result.sort(key=lambda x: x.get("data_espianto", ""), reverse=False)
-    
     return {
         "espianti": result,
         "count": len(result),
@@ -1694,7 +2660,7 @@ async def download_scheda_impianto_pdf(scheda_id: str, payload: dict = Depends(v
     patient = await db.patients.find_one({"id": scheda["patient_id"]}, {"_id": 0})
     
     # Generate PDF
-    pdf_bytes = generate_scheda_impianto_pdf(scheda, patient)
+    pdf_bytes = await render_in_pool(generate_scheda_impianto_pdf, scheda, patient)
     
     # Use data_posizionamento or data_impianto for filename
     data_file = scheda.get('data_posizionamento') or scheda.get('data_impianto') or 'nd'
@@ -1707,18 +2673,14 @@ async def download_scheda_impianto_pdf(scheda_id: str, payload: dict = Depends(v
 
 def generate_scheda_impianto_pdf(scheda: dict, patient: dict) -> bytes:
     """Generate PDF for Scheda Impianto PICC - EXACT format as per official form"""
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=0.5*cm, bottomMargin=0.5*cm, leftMargin=0.8*cm, rightMargin=0.8*cm)
     story = []
     
     # Styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle('Title', fontSize=11, alignment=1, fontName='Helvetica-Bold', spaceAfter=3)
-    section_header = ParagraphStyle('SectionHeader', fontSize=9, fontName='Helvetica-Bold', alignment=1, 
-                                    backColor=colors.HexColor('#e5e7eb'), spaceBefore=6, spaceAfter=3)
-    normal_style = ParagraphStyle('Normal', fontSize=7, spaceAfter=2, fontName='Helvetica')
-    small_style = ParagraphStyle('Small', fontSize=6.5, spaceAfter=1, fontName='Helvetica')
-    italic_small = ParagraphStyle('ItalicSmall', fontSize=6, fontName='Helvetica-Oblique', textColor=colors.grey)
+    title_style = PDF_STYLES["scheda_title"]
+    section_header = PDF_STYLES["scheda_section"]
+    normal_style = PDF_STYLES["scheda_normal"]
+    small_style = PDF_STYLES["scheda_small"]
+    italic_small = PDF_STYLES["scheda_italic"]
     
     def cb(checked):
         """Checkbox helper - simple text representation"""
@@ -1741,7 +2703,7 @@ def generate_scheda_impianto_pdf(scheda: dict, patient: dict) -> bytes:
     
     # === HEADER ===
     story.append(Paragraph("SCHEDA IMPIANTO e GESTIONE ACCESSI VENOSI", title_style))
-    story.append(Paragraph("Allegato n. 2", ParagraphStyle('Right', fontSize=7, alignment=2)))
+    story.append(Paragraph("Allegato n. 2", PDF_STYLES["scheda_right"]))
     story.append(Spacer(1, 5))
     
     # Patient Info Box - Header info
@@ -1771,14 +2733,7 @@ def generate_scheda_impianto_pdf(scheda: dict, patient: dict) -> bytes:
          get_val('cartella_clinica'), "", ""],
     ]
     t = Table(header_data, colWidths=[4.5*cm, 4*cm, 2.5*cm, 2.5*cm, 1.5*cm, 3.5*cm])
-    t.setStyle(TableStyle([
-        ('FONTSIZE', (0, 0), (-1, -1), 6.5),
-        ('BOX', (0, 0), (-1, -1), 1, colors.black),
-        ('INNERGRID', (0, 0), (-1, -1), 0.5, colors.grey),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('TOPPADDING', (0, 0), (-1, -1), 2),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-    ]))
+    t.setStyle(PDF_TABLE_STYLES["scheda_header"])
     story.append(t)
     story.append(Spacer(1, 8))
     
@@ -1906,14 +2861,7 @@ def generate_scheda_impianto_pdf(scheda: dict, patient: dict) -> bytes:
         [Paragraph("<b>2° OPERATORE:</b>", small_style), get_val('secondo_operatore'), Paragraph("<b>FIRMA:</b>", small_style), "________________"],
     ]
     ft = Table(footer_data, colWidths=[4*cm, 6*cm, 2*cm, 6.5*cm])
-    ft.setStyle(TableStyle([
-        ('FONTSIZE', (0, 0), (-1, -1), 7),
-        ('BOX', (0, 0), (-1, -1), 1, colors.black),
-        ('INNERGRID', (0, 0), (-1, -1), 0.5, colors.grey),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('TOPPADDING', (0, 0), (-1, -1), 4),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-    ]))
+    ft.setStyle(PDF_TABLE_STYLES["scheda_footer"])
     story.append(ft)
     
     # Note se presenti
@@ -1921,9 +2869,7 @@ def generate_scheda_impianto_pdf(scheda: dict, patient: dict) -> bytes:
         story.append(Spacer(1, 8))
         story.append(Paragraph(f"<b>NOTE:</b> {get_val('note')}", normal_style))
     
-    doc.build(story)
-    buffer.seek(0)
-    return buffer.getvalue()
+    return build_pdf(story, "scheda", title=f"Scheda impianto - {patient_name}".strip(" -"))
 
 
 # ============== SCHEDE GESTIONE PICC (MENSILE) ==============
@@ -1946,11 +2892,13 @@ async def create_scheda_gestione_picc(data: SchedaGestionePICCCreate, payload: d
     await db.schede_gestione_picc.insert_one(doc)
     return scheda
 
-@api_router.get("/schede-gestione-picc", response_model=List[SchedaGestionePICC])
+@api_router.get("/schede-gestione-picc")
 async def get_schede_gestione_picc(
+    response: Response,
     patient_id: str,
     ambulatorio: Ambulatorio,
     mese: Optional[str] = None,
+    page: PageParams = Depends(),
     payload: dict = Depends(verify_token)
 ):
     if ambulatorio.value not in payload["ambulatori"]:
@@ -1960,8 +2908,8 @@ async def get_schede_gestione_picc(
     if mese:
         query["mese"] = mese
     
-    schede = await db.schede_gestione_picc.find(query, {"_id": 0}).sort("mese", -1).to_list(100)
-    return schede
+    result = await fetch_page(db.schede_gestione_picc, query, [("mese", -1), ("id", -1)], page, default_limit=100)
+    return page_response(result, page, response, SchedaGestionePICC)
 
 @api_router.put("/schede-gestione-picc/{scheda_id}", response_model=SchedaGestionePICC)
 async def update_scheda_gestione_picc(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
@@ -1976,6 +2924,180 @@ async def update_scheda_gestione_picc(scheda_id: str, data: dict, payload: dict
     updated = await db.schede_gestione_picc.find_one({"id": scheda_id}, {"_id": 0})
     return updated
 
+# ============== BLOB STORAGE ==============
+# I contenuti binari (foto e allegati) sono salvati in GridFS, indirizzati per SHA-256:
+# lo stesso file caricato più volte occupa spazio una sola volta.
+# Un blob condiviso può essere eliminato (release_blobs) mentre una nuova foto lo
+# referenzia: l'eliminazione registra un marcatore in blob_deletions prima di contare
+# i riferimenti, e chi scrive un riferimento a un blob appena salvato chiama poi
+# recheck_blobs, che attende le eliminazioni in corso e ricarica il contenuto se serve.
+blob_bucket = AsyncIOMotorGridFSBucket(db, bucket_name="blobs")
+BLOB_DELETION_TIMEOUT = timedelta(minutes=1)  # oltre, il marcatore è di un processo terminato
+
+async def store_blob(contents: bytes, mime_type: Optional[str] = None, stored: Optional[dict] = None) -> str:
+    """Salva un contenuto nel blob store e ne restituisce l'id (SHA-256 esadecimale).
+    Se indicato, stored raccoglie i blob salvati da passare poi a recheck_blobs."""
+    blob_id = hashlib.sha256(contents).hexdigest()
+    if stored is not None:
+        stored[blob_id] = (contents, mime_type)
+    if await db["blobs.files"].find_one({"_id": blob_id}, {"_id": 1}):
+        return blob_id
+    try:
+        await blob_bucket.upload_from_stream_with_id(
+            blob_id, blob_id, contents,
+            metadata={"mime_type": mime_type, "size": len(contents)}
+        )
+    except DuplicateKeyError:
+        # Caricato in parallelo da un'altra richiesta: il contenuto è identico
+        pass
+    return blob_id
+
+async def recheck_blobs(stored: dict) -> None:
+    """Da chiamare dopo aver scritto i riferimenti ai blob salvati con store_blob: se
+    un'eliminazione concorrente li ha rimossi (o li sta rimuovendo) li ricarica"""
+    loop = asyncio.get_running_loop()
+    for blob_id, (contents, mime_type) in stored.items():
+        deadline = loop.time() + BLOB_DELETION_TIMEOUT.total_seconds()
+        while loop.time() < deadline:
+            cutoff = (datetime.now(timezone.utc) - BLOB_DELETION_TIMEOUT).isoformat()
+            if not await db.blob_deletions.find_one({"_id": blob_id, "started_at": {"$gte": cutoff}}, {"_id": 1}):
+                break
+            await asyncio.sleep(0.1)
+        if not await db["blobs.files"].find_one({"_id": blob_id}, {"_id": 1}):
+            logger.info(f"Blob {blob_id} eliminato durante la scrittura del riferimento: ricaricato")
+            await store_blob(contents, mime_type)
+
+async def read_blob(blob_id: str) -> bytes:
+    stream = await blob_bucket.open_download_stream(blob_id)
+    return await stream.read()
+
+def photo_blob_ids(photo: dict) -> List[str]:
+    """Tutti i blob referenziati da una foto (originale e varianti)"""
+    return [photo.get("blob_id")] + list((photo.get("variants") or {}).values())
+
+async def release_blobs(blob_ids) -> int:
+    """Elimina i blob non più referenziati da nessuna foto"""
+    removed = 0
+    for blob_id in {b for b in blob_ids if b}:
+        now = datetime.now(timezone.utc)
+        # Marcatore prima del conteggio: un riferimento scritto dopo il conteggio lo vede
+        await db.blob_deletions.delete_one({"_id": blob_id, "started_at": {"$lt": (now - BLOB_DELETION_TIMEOUT).isoformat()}})
+        try:
+            await db.blob_deletions.insert_one({"_id": blob_id, "started_at": now.isoformat()})
+        except DuplicateKeyError:
+            continue  # già in eliminazione
+        try:
+            references = [{"blob_id": blob_id}] + [{f"variants.{v}": blob_id} for v in PHOTO_VARIANTS]
+            if await db.photos.count_documents({"$or": references}, limit=1):
+                continue
+            await blob_bucket.delete(blob_id)
+            removed += 1
+        except Exception as e:
+            logger.warning(f"Impossibile eliminare il blob {blob_id}: {e}")
+        finally:
+            await db.blob_deletions.delete_one({"_id": blob_id})
+    return removed
+
+async def delete_photos(query: dict) -> int:
+    """Elimina le foto che corrispondono alla query insieme ai blob rimasti orfani"""
+    photos = await db.photos.find(query, {"_id": 0, "blob_id": 1, "variants": 1}).to_list(None)
+    blob_ids = [b for photo in photos for b in photo_blob_ids(photo)]
+    result = await db.photos.delete_many(query)
+    await release_blobs(blob_ids)
+    return result.deleted_count
+
+async def with_image_data(photo: dict) -> dict:
+    """Aggiunge image_data (base64) a una foto salvata nel blob store"""
+    if photo.get("blob_id") and not photo.get("image_data"):
+        photo["image_data"] = base64.b64encode(await read_blob(photo["blob_id"])).decode('utf-8')
+    return photo
+
+def decode_legacy_image_data(image_data: str) -> bytes:
+    if image_data.startswith("data:") and "," in image_data:
+        image_data = image_data.split(",", 1)[1]
+    return base64.b64decode(image_data)
+
+# ============== PHOTO VARIANTS ==============
+# Miniature e versioni ridotte generate al caricamento: la galleria scarica pochi KB
+# invece degli originali da 3-6 MB delle fotocamere dei telefoni.
+PHOTO_VARIANTS = {
+    "thumb": {"max_size": 320, "quality": 75},
+    "medium": {"max_size": 1280, "quality": 82},
+}
+
+# Pillow rilascia il GIL durante decodifica, resize e codifica JPEG
+photo_variant_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="photo-variants")
+
+def render_photo_variants(contents: bytes) -> Dict[str, bytes]:
+    """Genera le varianti JPEG di un'immagine (eseguita nel pool di worker)"""
+    variants = {}
+    with PILImage.open(io.BytesIO(contents)) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        for name, spec in PHOTO_VARIANTS.items():
+            variant = img.copy()
+            variant.thumbnail((spec["max_size"], spec["max_size"]), PILImage.LANCZOS)
+            out = io.BytesIO()
+            variant.save(out, format="JPEG", quality=spec["quality"], optimize=True, progressive=True)
+            variants[name] = out.getvalue()
+    return variants
+
+async def create_photo_variants(contents: bytes, mime_type: Optional[str], stored: Optional[dict] = None) -> Optional[Dict[str, str]]:
+    """Genera e salva nel blob store le varianti di un'immagine; None se non è un'immagine leggibile"""
+    if not mime_type or not mime_type.startswith("image/"):
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        rendered = await loop.run_in_executor(photo_variant_executor, render_photo_variants, contents)
+    except Exception as e:
+        logger.warning(f"Impossibile generare le varianti della foto ({mime_type}): {e}")
+        return None
+    return {name: await store_blob(data, "image/jpeg", stored) for name, data in rendered.items()}
+
+def photo_urls(photo: dict) -> Dict[str, str]:
+    """URL firmate (relative all'API) dell'originale e delle varianti disponibili"""
+    base = f"/photos/{photo['id']}/raw"
+    urls = {"original": sign_file_url(base)}
+    for name in (photo.get("variants") or {}):
+        urls[name] = sign_file_url(base, f"variant={name}")
+    return urls
+
+@api_router.post("/photos/migrate-blobs")
+async def migrate_photos_to_blobs(payload: dict = Depends(verify_token)):
+    """Migrazione una tantum: sposta il base64 delle foto esistenti nel blob store
+    e genera le varianti mancanti delle immagini"""
+    query = {
+        "ambulatorio": {"$in": payload["ambulatori"]},
+        "$or": [
+            {"image_data": {"$nin": [None, ""]}, "blob_id": None},
+            {"blob_id": {"$ne": None}, "mime_type": {"$regex": "^image/"}, "variants": None}
+        ]
+    }
+    migrated = 0
+    errors = []
+    cursor = db.photos.find(query, {"_id": 0, "id": 1, "image_data": 1, "blob_id": 1, "mime_type": 1}).batch_size(20)
+    async for photo in cursor:
+        try:
+            update = {"$set": {}}
+            stored = {}
+            if photo.get("blob_id"):
+                contents = await read_blob(photo["blob_id"])
+            else:
+                contents = decode_legacy_image_data(photo["image_data"])
+                update["$set"].update({"blob_id": await store_blob(contents, photo.get("mime_type"), stored), "size": len(contents)})
+                update["$unset"] = {"image_data": ""}
+            # Se le varianti non si possono generare si salva un dizionario vuoto per non riprovare
+            update["$set"]["variants"] = await create_photo_variants(contents, photo.get("mime_type"), stored) or {}
+            await db.photos.update_one({"id": photo["id"]}, update)
+            await recheck_blobs(stored)
+            migrated += 1
+        except Exception as e:
+            errors.append({"photo_id": photo["id"], "error": str(e)})
+    
+    logger.info(f"Migrazione foto nel blob store: {migrated} migrate, {len(errors)} errori")
+    return {"migrated": migrated, "errors": len(errors), "error_details": errors}
+
 # ============== PHOTOS / ATTACHMENTS ==============
 @api_router.post("/photos")
 async def upload_photo(
@@ -1994,7 +3116,6 @@ async def upload_photo(
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     contents = await file.read()
-    image_data = base64.b64encode(contents).decode('utf-8')
     
     # Determine file type from content type if not provided
     mime_type = file.content_type
@@ -2014,33 +3135,57 @@ async def upload_photo(
         tipo=tipo,
         descrizione=descrizione,
         data=data,
-        image_data=image_data,
         file_type=file_type,
         original_name=original_name or file.filename,
         mime_type=mime_type,
         scheda_med_id=scheda_med_id if scheda_med_id != "pending" else None
     )
-    doc = photo.model_dump()
+    stored = {}
+    photo.blob_id = await store_blob(contents, mime_type, stored)
+    photo.size = len(contents)
+    photo.variants = await create_photo_variants(contents, mime_type, stored)
+    doc = photo.model_dump(exclude={"image_data"})
     await db.photos.insert_one(doc)
+    await recheck_blobs(stored)
     
-    return {"id": photo.id, "message": "File caricato"}
+    return {"id": photo.id, "urls": photo_urls(doc), "message": "File caricato"}
+
+PHOTO_SORT = [("data", -1), ("id", -1)]
 
 @api_router.get("/photos")
 async def get_photos(
+    response: Response,
     patient_id: str,
     ambulatorio: Ambulatorio,
     tipo: Optional[str] = None,
+    include_data: bool = False,
+    page: PageParams = Depends(),
     payload: dict = Depends(verify_token)
 ):
+    """Elenco foto/allegati del paziente, ordinati per data (più recenti prima).
+
+    Di default restituisce solo i metadati (senza image_data) e gli URL per scaricare
+    originale e varianti; include_data=true aggiunge il base64.
+    """
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     query = {"patient_id": patient_id, "ambulatorio": ambulatorio.value}
     if tipo:
         query["tipo"] = tipo
+    if include_data and page.fields:
+        page.fields.append("image_data")
     
-    photos = await db.photos.find(query, {"_id": 0}).sort("data", -1).to_list(100)
-    return photos
+    result = await fetch_page(
+        db.photos, query, PHOTO_SORT, page,
+        projection={"_id": 0} if include_data else {"_id": 0, "image_data": 0},
+        required=("blob_id", "variants")
+    )
+    for p in result["items"]:
+        p["urls"] = photo_urls(p)
+        if include_data:
+            await with_image_data(p)
+    return page_response(result, page, response)
 
 @api_router.get("/photos/{photo_id}")
 async def get_photo(photo_id: str, payload: dict = Depends(verify_token)):
@@ -2049,7 +3194,116 @@ async def get_photo(photo_id: str, payload: dict = Depends(verify_token)):
         raise HTTPException(status_code=404, detail="Foto non trovata")
     if photo["ambulatorio"] not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    return photo
+    return await with_image_data(photo)
+
+PHOTO_CACHE_CONTROL = "private, max-age=31536000, immutable"
+BLOB_STREAM_CHUNK_SIZE = 256 * 1024
+
+def parse_range_header(range_header: str, size: int) -> Optional[tuple]:
+    """Interpreta un header Range a intervallo singolo ("bytes=start-end").
+
+    Restituisce (start, end) inclusivi, None se l'header va ignorato, oppure
+    solleva 416 se l'intervallo non è soddisfacibile.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_str, _, end_str = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+        elif end_str:
+            # Suffix range: ultimi N byte
+            start = max(size - int(end_str), 0)
+            end = size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Intervallo richiesto non valido",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+@api_router.get("/photos/{photo_id}/raw")
+async def download_photo_raw(
+    photo_id: str,
+    request: Request,
+    variant: Optional[str] = None,
+    payload: dict = Depends(verify_token_or_signature)
+):
+    """Contenuto binario della foto/allegato (o di una sua variante), con supporto a Range ed ETag"""
+    photo = await db.photos.find_one({"id": photo_id}, {"_id": 0})
+    if not photo:
+        raise HTTPException(status_code=404, detail="Foto non trovata")
+    if not payload.get("signed") and photo["ambulatorio"] not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    if variant and variant not in PHOTO_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"Variante non valida: {variant}")
+    
+    # Se la variante non è disponibile si restituisce l'originale
+    variant_id = (photo.get("variants") or {}).get(variant) if variant else None
+    if variant_id:
+        photo["mime_type"] = "image/jpeg"
+    blob_id = variant_id or photo.get("blob_id")
+    legacy_contents = None
+    if not blob_id:
+        # Foto legacy non ancora migrata nel blob store
+        if not photo.get("image_data"):
+            raise HTTPException(status_code=404, detail="Contenuto non disponibile")
+        legacy_contents = decode_legacy_image_data(photo["image_data"])
+        blob_id = hashlib.sha256(legacy_contents).hexdigest()
+    
+    etag = f'"{blob_id}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": PHOTO_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    if legacy_contents is not None:
+        size = len(legacy_contents)
+    else:
+        stream = await blob_bucket.open_download_stream(blob_id)
+        size = stream.length
+    
+    media_type = photo.get("mime_type") or "application/octet-stream"
+    filename = quote(photo.get("original_name") or photo_id)
+    headers["Content-Disposition"] = f"inline; filename*=UTF-8''{filename}"
+    
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if not if_range or if_range.strip() == etag:
+        byte_range = parse_range_header(request.headers.get("range"), size)
+    start, end = byte_range if byte_range else (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    status_code = 200
+    if byte_range:
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    if legacy_contents is not None:
+        return Response(content=legacy_contents[start:end + 1], status_code=status_code, media_type=media_type, headers=headers)
+    
+    async def iter_blob():
+        stream.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await stream.read(min(BLOB_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    
+    return StreamingResponse(iter_blob(), status_code=status_code, media_type=media_type, headers=headers)
 
 @api_router.delete("/photos/{photo_id}")
 async def delete_photo(photo_id: str, payload: dict = Depends(verify_token)):
@@ -2060,6 +3314,7 @@ async def delete_photo(photo_id: str, payload: dict = Depends(verify_token)):
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.photos.delete_one({"id": photo_id})
+    await release_blobs(photo_blob_ids(photo))
     return {"message": "Foto eliminata"}
 
 # ============== DOCUMENTS ==============
@@ -2083,6 +3338,235 @@ async def get_documents(
     
     return docs
 
+# ============== STATISTICS ROLLUP ==============
+# Contatori pre-aggregati per (ambulatorio, giorno, tipo) nella collection statistics_daily.
+# Ogni scrittura su appuntamenti o schede impianto ricalcola i giorni toccati, così le
+# statistiche leggono un documento per giorno invece di tutti gli appuntamenti.
+# updated_at è l'istante in cui è iniziato il calcolo e fa da versione: un documento
+# viene sostituito solo da un calcolo iniziato dopo, così ricalcoli concorrenti
+# (o una ricostruzione completa) non riscrivono dati più vecchi.
+ESPIANTO_TYPES = ["espianto_picc", "espianto_picc_port", "espianto_midline"]
+IMPIANTI_ROLLUP_TIPO = "PICC"  # gli impianti sono contati sul documento PICC del giorno
+
+_statistics_rollup_lock = asyncio.Lock()
+
+def statistics_date_range(anno: int, mese: Optional[int] = None) -> tuple:
+    """Restituisce (start_date, end_date) in formato YYYY-MM-DD, fine esclusa"""
+    if mese:
+        start_date = f"{anno}-{mese:02d}-01"
+        end_date = f"{anno + 1}-01-01" if mese == 12 else f"{anno}-{mese + 1:02d}-01"
+    else:
+        start_date = f"{anno}-01-01"
+        end_date = f"{anno + 1}-01-01"
+    return start_date, end_date
+
+async def compute_statistics_rollup(ambulatorio: str, version: str, day: Optional[str] = None) -> List[dict]:
+    """Calcola i documenti di rollup di un ambulatorio (o di un solo giorno) dai dati grezzi.
+    version è l'istante di inizio del calcolo, da prendere prima di leggere i dati."""
+    apt_match = {"ambulatorio": ambulatorio}
+    imp_match = {"ambulatorio": ambulatorio}
+    if day:
+        apt_match["data"] = day
+        imp_match["data_impianto"] = {"$regex": f"^{re.escape(day)}"}
+    else:
+        imp_match["data_impianto"] = {"$regex": r"^\d{4}-\d{2}-\d{2}"}
+
+    key = {"data": "$data", "tipo": "$tipo"}
+    valid = {"$match": {"stato": {"$ne": "non_presentato"}}}
+    pipeline = [
+        {"$match": apt_match},
+        {"$project": {"_id": 0, "data": 1, "tipo": 1, "stato": 1, "patient_id": 1, "prestazioni": 1}},
+        {"$facet": {
+            "accessi": [
+                valid,
+                {"$group": {"_id": key, "accessi": {"$sum": 1}, "pazienti": {"$addToSet": "$patient_id"}}}
+            ],
+            "prestazioni": [
+                valid,
+                {"$unwind": "$prestazioni"},
+                {"$group": {"_id": {"data": "$data", "tipo": "$tipo", "p": "$prestazioni"}, "count": {"$sum": 1}}}
+            ],
+            # Gli espianti sono contati anche per i non presentati (come /statistics/espianti)
+            "espianti": [
+                {"$match": {"prestazioni": {"$in": ESPIANTO_TYPES}}},
+                {"$unwind": "$prestazioni"},
+                {"$match": {"prestazioni": {"$in": ESPIANTO_TYPES}}},
+                {"$group": {"_id": {"data": "$data", "tipo": "$tipo", "p": "$prestazioni"}, "count": {"$sum": 1}}}
+            ]
+        }}
+    ]
+    result = (await db.appointments.aggregate(pipeline).to_list(1))[0]
+
+    impianti = await db.schede_impianto_picc.aggregate([
+        {"$match": imp_match},
+        {"$group": {
+            "_id": {"data": {"$substr": ["$data_impianto", 0, 10]}, "p": {"$ifNull": ["$tipo_catetere", "altro"]}},
+            "count": {"$sum": 1}
+        }}
+    ]).to_list(None)
+
+    docs = {}
+    def rollup_doc(data: str, tipo: str) -> dict:
+        if (data, tipo) not in docs:
+            docs[(data, tipo)] = {
+                "ambulatorio": ambulatorio, "data": data, "tipo": tipo,
+                "accessi": 0, "pazienti": [], "prestazioni": {}, "espianti": {}, "impianti": {}
+            }
+        return docs[(data, tipo)]
+
+    for r in result["accessi"]:
+        doc = rollup_doc(r["_id"]["data"], r["_id"].get("tipo"))
+        doc["accessi"] = r["accessi"]
+        doc["pazienti"] = sorted(pid for pid in r["pazienti"] if pid)
+    for r in result["prestazioni"]:
+        rollup_doc(r["_id"]["data"], r["_id"].get("tipo"))["prestazioni"][r["_id"]["p"]] = r["count"]
+    for r in result["espianti"]:
+        rollup_doc(r["_id"]["data"], r["_id"].get("tipo"))["espianti"][r["_id"]["p"]] = r["count"]
+    for r in impianti:
+        rollup_doc(r["_id"]["data"], IMPIANTI_ROLLUP_TIPO)["impianti"][r["_id"]["p"]] = r["count"]
+
+    for doc in docs.values():
+        doc["updated_at"] = version
+    return [doc for doc in docs.values() if doc["data"]]
+
+async def store_statistics_rollup(ambulatorio: str, docs: List[dict], version: str, day: Optional[str] = None) -> None:
+    """Scrive i documenti calcolati alla versione indicata (compare-and-set su updated_at)
+    ed elimina quelli più vecchi non più presenti nel calcolo (dell'ambulatorio o del giorno)"""
+    if docs:
+        try:
+            await db.statistics_daily.bulk_write([
+                ReplaceOne(
+                    {"ambulatorio": ambulatorio, "data": doc["data"], "tipo": doc["tipo"], "updated_at": {"$lt": version}},
+                    doc, upsert=True
+                )
+                for doc in docs
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Chiave duplicata: il documento c'è già in una versione più recente
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+    # Dopo la scrittura i documenti ancora più vecchi di version sono quelli scomparsi
+    stale = {"ambulatorio": ambulatorio, "updated_at": {"$lt": version}}
+    if day:
+        stale["data"] = day
+    await db.statistics_daily.delete_many(stale)
+
+async def rebuild_statistics_rollup(ambulatorio: str) -> int:
+    """Ricostruisce da zero il rollup di un ambulatorio (backfill); i documenti vengono
+    sostituiti uno per uno, senza svuotare prima il rollup letto dalle statistiche"""
+    version = datetime.now(timezone.utc).isoformat()
+    docs = await compute_statistics_rollup(ambulatorio, version)
+    await store_statistics_rollup(ambulatorio, docs, version)
+    await db.statistics_rollup_state.update_one(
+        {"ambulatorio": ambulatorio},
+        {"$set": {"ambulatorio": ambulatorio, "built_at": datetime.now(timezone.utc).isoformat(), "giorni": len(docs)}},
+        upsert=True
+    )
+    logger.info(f"Rollup statistiche ricostruito per {ambulatorio}: {len(docs)} documenti")
+    return len(docs)
+
+async def ensure_statistics_rollup(ambulatorio: str):
+    """Costruisce il rollup alla prima lettura se non è mai stato generato"""
+    if await db.statistics_rollup_state.find_one({"ambulatorio": ambulatorio}):
+        return
+    async with _statistics_rollup_lock:
+        if not await db.statistics_rollup_state.find_one({"ambulatorio": ambulatorio}):
+            await rebuild_statistics_rollup(ambulatorio)
+
+async def refresh_statistics_rollup(ambulatorio: str, dates) -> None:
+    """Ricalcola il rollup dei giorni indicati dopo una modifica ai dati.
+
+    Se il rollup dell'ambulatorio non è ancora stato costruito non fa nulla:
+    verrà generato per intero alla prima lettura.
+    """
+    days = {d[:10] for d in dates if d}
+    if not ambulatorio or not days:
+        return
+    try:
+        if not await db.statistics_rollup_state.find_one({"ambulatorio": ambulatorio}):
+            return
+        for day in days:
+            version = datetime.now(timezone.utc).isoformat()
+            docs = await compute_statistics_rollup(ambulatorio, version, day)
+            await store_statistics_rollup(ambulatorio, docs, version, day)
+    except Exception as e:
+        logger.error(f"Aggiornamento rollup statistiche non riuscito ({ambulatorio}, {sorted(days)}): {e}")
+
+async def get_patient_statistics_days(patient_ids) -> Dict[str, set]:
+    """Giorni (per ambulatorio) in cui i pazienti hanno appuntamenti o impianti.
+
+    Da chiamare prima di eliminare i dati dei pazienti, per poi ricalcolare quei giorni.
+    """
+    ids = list(patient_ids)
+    days: Dict[str, set] = {}
+    apts = await db.appointments.find(
+        {"patient_id": {"$in": ids}}, {"_id": 0, "ambulatorio": 1, "data": 1}
+    ).to_list(None)
+    for apt in apts:
+        days.setdefault(apt.get("ambulatorio"), set()).add(apt.get("data"))
+    schede = await db.schede_impianto_picc.find(
+        {"patient_id": {"$in": ids}}, {"_id": 0, "ambulatorio": 1, "data_impianto": 1}
+    ).to_list(None)
+    for scheda in schede:
+        days.setdefault(scheda.get("ambulatorio"), set()).add(scheda.get("data_impianto"))
+    return days
+
+async def refresh_statistics_rollup_days(days: Dict[str, set]) -> None:
+    for ambulatorio, dates in days.items():
+        await refresh_statistics_rollup(ambulatorio, dates)
+
+async def load_statistics_rollup(ambulatorio: str, start_date: str, end_date: str, tipo: Optional[str] = None) -> List[dict]:
+    """Legge i documenti di rollup nel periodo [start_date, end_date)"""
+    await ensure_statistics_rollup(ambulatorio)
+    query = {"ambulatorio": ambulatorio, "data": {"$gte": start_date, "$lt": end_date}}
+    if tipo:
+        query["tipo"] = tipo
+    return await db.statistics_daily.find(query, {"_id": 0}).to_list(None)
+
+def summarize_appointment_rollup(docs: List[dict]):
+    """Restituisce (totale_accessi, pazienti_unici, prestazioni, dettaglio_mensile) dai rollup giornalieri"""
+    total_accessi = 0
+    pazienti = set()
+    prestazioni_count = {}
+    monthly = {}
+    for doc in sorted(docs, key=lambda d: d["data"]):
+        if not doc.get("accessi"):
+            continue
+        month = doc["data"][:7]  # YYYY-MM
+        m = monthly.setdefault(month, {"accessi": 0, "prestazioni": {}, "pazienti": set()})
+        total_accessi += doc["accessi"]
+        m["accessi"] += doc["accessi"]
+        pazienti.update(doc.get("pazienti", []))
+        m["pazienti"].update(doc.get("pazienti", []))
+        for prest, count in doc.get("prestazioni", {}).items():
+            prestazioni_count[prest] = prestazioni_count.get(prest, 0) + count
+            m["prestazioni"][prest] = m["prestazioni"].get(prest, 0) + count
+
+    monthly_stats = {}
+    for month, m in monthly.items():
+        monthly_stats[month] = {"accessi": m["accessi"], "prestazioni": m["prestazioni"], "pazienti_unici": len(m["pazienti"])}
+    return total_accessi, len(pazienti), prestazioni_count, monthly_stats
+
+def summarize_counter_rollup(docs: List[dict], field: str):
+    """Somma un contatore per tipo ("impianti" o "espianti"): (per_tipo, dettaglio_mensile)"""
+    per_tipo = {}
+    monthly = {}
+    for doc in sorted(docs, key=lambda d: d["data"]):
+        for key, count in doc.get(field, {}).items():
+            per_tipo[key] = per_tipo.get(key, 0) + count
+            month = monthly.setdefault(doc["data"][:7], {})
+            month[key] = month.get(key, 0) + count
+    return per_tipo, monthly
+
+@api_router.post("/statistics/rollup/rebuild")
+async def rebuild_statistics_rollup_endpoint(ambulatorio: Ambulatorio, payload: dict = Depends(verify_token)):
+    """Ricostruisce il rollup delle statistiche dai dati grezzi"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    giorni = await rebuild_statistics_rollup(ambulatorio.value)
+    return {"success": True, "documenti": giorni}
+
 # ============== STATISTICS ==============
 @api_router.get("/statistics")
 async def get_statistics(
@@ -2095,63 +3579,26 @@ async def get_statistics(
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
+    _, stats = await load_prestazioni_statistics(ambulatorio, anno, mese, tipo)
+    return stats
+
+async def load_prestazioni_statistics(ambulatorio: Ambulatorio, anno: int, mese: Optional[int], tipo: Optional[str]) -> tuple:
+    """Restituisce (documenti di rollup, statistiche del periodo) per /statistics e il report PDF"""
     # Villa Ginestre only shows PICC stats
     if ambulatorio == Ambulatorio.VILLA_GINESTRE and tipo == "MED":
         raise HTTPException(status_code=400, detail="Villa delle Ginestre non ha statistiche MED")
     
-    # Build date range
-    if mese:
-        start_date = f"{anno}-{mese:02d}-01"
-        if mese == 12:
-            end_date = f"{anno + 1}-01-01"
-        else:
-            end_date = f"{anno}-{mese + 1:02d}-01"
-    else:
-        start_date = f"{anno}-01-01"
-        end_date = f"{anno + 1}-01-01"
+    start_date, end_date = statistics_date_range(anno, mese)
     
-    query = {
-        "ambulatorio": ambulatorio.value,
-        "data": {"$gte": start_date, "$lt": end_date}
-    }
-    if tipo:
-        query["tipo"] = tipo
-    elif ambulatorio == Ambulatorio.VILLA_GINESTRE:
-        query["tipo"] = "PICC"
-    
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(10000)
-    
-    # IMPORTANTE: Escludere i pazienti "non_presentato" dalle statistiche
-    # Le prestazioni dei pazienti segnati in rosso (non presentati) non vengono contate
-    appointments_validi = [app for app in appointments if app.get("stato") != "non_presentato"]
+    tipo_filter = tipo
+    if not tipo and ambulatorio == Ambulatorio.VILLA_GINESTRE:
+        tipo_filter = "PICC"
     
-    # Calculate statistics (solo appuntamenti effettuati o da_fare, escludendo non_presentato)
-    total_accessi = len(appointments_validi)
-    unique_patients = len(set(a["patient_id"] for a in appointments_validi))
+    # I rollup escludono già i pazienti "non_presentato": le loro prestazioni non vengono contate
+    docs = await load_statistics_rollup(ambulatorio.value, start_date, end_date, tipo_filter)
+    total_accessi, unique_patients, prestazioni_count, monthly_stats = summarize_appointment_rollup(docs)
     
-    # Prestazioni count (solo per appuntamenti validi)
-    prestazioni_count = {}
-    for app in appointments_validi:
-        for prest in app.get("prestazioni", []):
-            prestazioni_count[prest] = prestazioni_count.get(prest, 0) + 1
-    
-    # Monthly breakdown (solo per appuntamenti validi)
-    monthly_stats = {}
-    for app in appointments_validi:
-        month = app["data"][:7]  # YYYY-MM
-        if month not in monthly_stats:
-            monthly_stats[month] = {"accessi": 0, "pazienti": set(), "prestazioni": {}}
-        monthly_stats[month]["accessi"] += 1
-        monthly_stats[month]["pazienti"].add(app["patient_id"])
-        for prest in app.get("prestazioni", []):
-            monthly_stats[month]["prestazioni"][prest] = monthly_stats[month]["prestazioni"].get(prest, 0) + 1
-    
-    # Convert sets to counts
-    for month in monthly_stats:
-        monthly_stats[month]["pazienti_unici"] = len(monthly_stats[month]["pazienti"])
-        del monthly_stats[month]["pazienti"]
-    
-    return {
+    return docs, {
         "anno": anno,
         "mese": mese,
         "ambulatorio": ambulatorio.value,
@@ -2175,9 +3622,11 @@ async def compare_statistics(
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Get stats for both periods
-    stats1 = await get_statistics(ambulatorio, periodo1_anno, periodo1_mese, tipo, payload)
-    stats2 = await get_statistics(ambulatorio, periodo2_anno or periodo1_anno, periodo2_mese, tipo, payload)
+    # Get stats for both periods (in parallel)
+    stats1, stats2 = await asyncio.gather(
+        get_statistics(ambulatorio, periodo1_anno, periodo1_mese, tipo, payload),
+        get_statistics(ambulatorio, periodo2_anno or periodo1_anno, periodo2_mese, tipo, payload)
+    )
     
     # Calculate differences
     diff = {
@@ -2229,6 +3678,66 @@ async def get_time_slots():
         "tutti": morning_slots + afternoon_slots
     }
 
+# ============== AGENDA ==============
+AGENDA_MAX_DAYS = 62
+
+@api_router.get("/agenda")
+async def get_agenda(
+    request: Request,
+    ambulatorio: Ambulatorio,
+    data_from: str,
+    data_to: Optional[str] = None,
+    version: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Dati dell'agenda per un intervallo di date in una sola risposta.
+
+    Restituisce appuntamenti, slot chiusi, festività, revisioni attive e conteggi
+    PICC/MED per giorno. Se `version` (o If-None-Match) coincide con la versione
+    attuale dei dati risponde 304 senza corpo.
+    """
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    data_to = data_to or data_from
+    try:
+        start = datetime.strptime(data_from, "%Y-%m-%d").date()
+        end = datetime.strptime(data_to, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Date non valide (formato YYYY-MM-DD)")
+    if end < start or (end - start).days >= AGENDA_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Intervallo di date non valido (max {AGENDA_MAX_DAYS} giorni)")
+    
+    date_list = [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+    date_query = {"ambulatorio": ambulatorio.value, "data": {"$gte": data_from, "$lte": data_to}}
+    appointments, closed_slots, daily_counts, revised_dates = await asyncio.gather(
+        db.appointments.find(date_query, {"_id": 0}).sort([("data", 1), ("ora", 1)]).to_list(None),
+        db.closed_slots.find(date_query, {"_id": 0}).to_list(None),
+        compute_daily_counts(ambulatorio.value, data_from, data_to),
+        find_revised_dates(ambulatorio.value, date_list)
+    )
+    holidays = sorted({h for anno in range(start.year, end.year + 1) for h in get_holidays(anno)})
+    
+    body = {
+        "data_from": data_from,
+        "data_to": data_to,
+        "appointments": appointments,
+        "closed_slots": closed_slots,
+        "holidays": holidays,
+        "revised_dates": revised_dates,
+        "daily_counts": daily_counts,
+    }
+    current_version = hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()[:32]
+    etag = f'"{current_version}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    
+    if_none_match = request.headers.get("if-none-match")
+    if version == current_version or (if_none_match and etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    body["version"] = current_version
+    return Response(content=json.dumps(body, default=str), media_type="application/json", headers=headers)
+
 # ============== DELETE ENDPOINTS ==============
 
 @api_router.delete("/schede-impianto-picc/{scheda_id}")
@@ -2240,6 +3749,7 @@ async def delete_scheda_impianto(scheda_id: str, payload: dict = Depends(verify_
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     await db.schede_impianto_picc.delete_one({"id": scheda_id})
+    await refresh_statistics_rollup(scheda["ambulatorio"], [scheda.get("data_impianto")])
     return {"message": "Scheda impianto eliminata"}
 
 @api_router.delete("/schede-gestione-picc/{scheda_id}")
@@ -2275,6 +3785,7 @@ async def update_scheda_impianto(scheda_id: str, data: dict, payload: dict = Dep
     data["updated_at"] = datetime.now(timezone.utc).isoformat()
     await db.schede_impianto_picc.update_one({"id": scheda_id}, {"$set": data})
     updated = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
+    await refresh_statistics_rollup(scheda["ambulatorio"], [scheda.get("data_impianto"), updated.get("data_impianto")])
     return updated
 
 # ============== IMPLANT STATISTICS ==============
@@ -2289,49 +3800,16 @@ async def get_implant_statistics(
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Build date range query
-    if mese:
-        start_date = f"{anno}-{mese:02d}-01"
-        if mese == 12:
-            end_date = f"{anno + 1}-01-01"
-        else:
-            end_date = f"{anno}-{mese + 1:02d}-01"
-    else:
-        start_date = f"{anno}-01-01"
-        end_date = f"{anno + 1}-01-01"
-    
-    # Query implants
-    query = {
-        "ambulatorio": ambulatorio.value,
-        "data_impianto": {"$gte": start_date, "$lt": end_date}
-    }
-    
-    schede = await db.schede_impianto_picc.find(query, {"_id": 0}).to_list(1000)
-    
-    # Get list of existing patient IDs
-    existing_patients = await db.patients.distinct("id", {"ambulatorio": ambulatorio.value})
-    existing_patient_ids = set(existing_patients)
-    
-    # Count by type - only for existing patients
-    tipo_counts = {}
-    monthly_breakdown = {}
+    _, stats = await load_implant_statistics(ambulatorio, anno, mese)
+    return stats
+
+async def load_implant_statistics(ambulatorio: Ambulatorio, anno: int, mese: Optional[int]) -> tuple:
+    """Restituisce (documenti di rollup, statistiche impianti del periodo)"""
+    start_date, end_date = statistics_date_range(anno, mese)
     
-    for scheda in schede:
-        # Skip if patient no longer exists
-        patient_id = scheda.get("patient_id")
-        if patient_id and patient_id not in existing_patient_ids:
-            continue
-            
-        tipo = scheda.get("tipo_catetere", "altro")
-        tipo_counts[tipo] = tipo_counts.get(tipo, 0) + 1
-        
-        # Monthly breakdown
-        data_impianto = scheda.get("data_impianto", "")
-        if data_impianto:
-            month_key = data_impianto[:7]  # "YYYY-MM"
-            if month_key not in monthly_breakdown:
-                monthly_breakdown[month_key] = {}
-            monthly_breakdown[month_key][tipo] = monthly_breakdown[month_key].get(tipo, 0) + 1
+    # Count by type from the daily rollup
+    docs = await load_statistics_rollup(ambulatorio.value, start_date, end_date, IMPIANTI_ROLLUP_TIPO)
+    tipo_counts, monthly_breakdown = summarize_counter_rollup(docs, "impianti")
     
     # Labels for types
     tipo_labels = {
@@ -2343,8 +3821,8 @@ async def get_implant_statistics(
         "port": "PORT",
     }
     
-    return {
-        "totale_impianti": len(schede),
+    return docs, {
+        "totale_impianti": sum(tipo_counts.values()),
         "per_tipo": tipo_counts,
         "tipo_labels": tipo_labels,
         "dettaglio_mensile": monthly_breakdown
@@ -2361,49 +3839,12 @@ async def get_espianti_statistics(
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Build date range query
-    if mese:
-        start_date = f"{anno}-{mese:02d}-01"
-        if mese == 12:
-            end_date = f"{anno + 1}-01-01"
-        else:
-            end_date = f"{anno}-{mese + 1:02d}-01"
-    else:
-        start_date = f"{anno}-01-01"
-        end_date = f"{anno + 1}-01-01"
+    start_date, end_date = statistics_date_range(anno, mese)
     
-    # Query appointments with espianto prestazioni
-    espianto_types = ["espianto_picc", "espianto_picc_port", "espianto_midline"]
-    
-    query = {
-        "ambulatorio": ambulatorio.value,
-        "data": {"$gte": start_date, "$lt": end_date},
-        "prestazioni": {"$in": espianto_types}
-    }
-    
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(10000)
-    
-    # Count by type
-    tipo_counts = {
-        "espianto_picc": 0,
-        "espianto_picc_port": 0,
-        "espianto_midline": 0
-    }
-    monthly_breakdown = {}
-    
-    for apt in appointments:
-        prestazioni = apt.get("prestazioni", [])
-        data = apt.get("data", "")
-        month_key = data[:7] if data else ""
-        
-        for espianto_type in espianto_types:
-            if espianto_type in prestazioni:
-                tipo_counts[espianto_type] += 1
-                
-                if month_key:
-                    if month_key not in monthly_breakdown:
-                        monthly_breakdown[month_key] = {}
-                    monthly_breakdown[month_key][espianto_type] = monthly_breakdown[month_key].get(espianto_type, 0) + 1
+    # Count by type from the daily rollup
+    docs = await load_statistics_rollup(ambulatorio.value, start_date, end_date)
+    per_tipo, monthly_breakdown = summarize_counter_rollup(docs, "espianti")
+    tipo_counts = {espianto_type: per_tipo.get(espianto_type, 0) for espianto_type in ESPIANTO_TYPES}
     
     # Labels
     tipo_labels = {
@@ -2421,19 +3862,689 @@ async def get_espianti_statistics(
         "dettaglio_mensile": monthly_breakdown
     }
 
+# ============== RENDER POOL ==============
+# Il rendering ReportLab è CPU-bound: eseguito nell'event loop bloccherebbe tutte
+# le altre richieste (compreso /health). Gira quindi in un pool di processi con al
+# massimo RENDER_WORKERS documenti in esecuzione; le richieste interattive oltre
+# RENDER_QUEUE_LIMIT (interattive in esecuzione + in attesa) ricevono 429, i job in
+# background attendono il proprio turno e non contano per il limite: un'esportazione
+# in corso non deve far rifiutare i download degli altri utenti.
+# Ogni rendering ha un timeout di RENDER_TIMEOUT secondi.
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", min(2, os.cpu_count() or 1)))
+RENDER_QUEUE_LIMIT = int(os.environ.get("RENDER_QUEUE_LIMIT", RENDER_WORKERS * 4))
+RENDER_TIMEOUT = float(os.environ.get("RENDER_TIMEOUT", 60))
+
+_render_pool: Optional[ProcessPoolExecutor] = None
+_render_slots: Optional[asyncio.Semaphore] = None
+render_pool_stats = {
+    "running": 0,
+    "queued": 0,
+    "background_running": 0,
+    "background_queued": 0,
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "rejected": 0,
+    "timeouts": 0,
+}
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """Pool di processi per il rendering, creato al primo utilizzo.
+
+    I worker partono con "spawn": un fork dopo l'avvio di Motor copierebbe lock
+    e thread del driver in uno stato incoerente.
+    """
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _render_pool
+
+def get_render_slots() -> asyncio.Semaphore:
+    global _render_slots
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(RENDER_WORKERS)
+    return _render_slots
+
+def render_queue_depth(background: bool = False) -> int:
+    """Rendering interattivi (o in background) in esecuzione più quelli in attesa"""
+    prefix = "background_" if background else ""
+    return render_pool_stats[f"{prefix}running"] + render_pool_stats[f"{prefix}queued"]
+
+async def render_in_pool(fn, *args, background: bool = False):
+    """Esegue `fn(*args)` nel pool di processi.
+
+    Le richieste interattive vengono rifiutate con 429 se la coda è piena; con
+    background=True (job) si attende comunque uno slot libero. Allo scadere del
+    timeout il client riceve 504, ma lo slot resta occupato finché il worker non
+    termina: la capacità dichiarata corrisponde sempre ai processi realmente liberi.
+    """
+    global _render_pool
+    stats = render_pool_stats
+    if not background and render_queue_depth() >= RENDER_QUEUE_LIMIT:
+        stats["rejected"] += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Troppi documenti in generazione, riprova tra qualche secondo",
+            headers={"Retry-After": "5"}
+        )
+    
+    running = "background_running" if background else "running"
+    queued = "background_queued" if background else "queued"
+    slots = get_render_slots()
+    stats[queued] += 1
+    try:
+        await slots.acquire()
+    finally:
+        stats[queued] -= 1
+    stats[running] += 1
+    stats["submitted"] += 1
+    
+    def release(future):
+        stats[running] -= 1
+        slots.release()
+        if future.cancelled() or future.exception() is not None:
+            stats["failed"] += 1
+        else:
+            stats["completed"] += 1
+    
+    try:
+        future = asyncio.get_running_loop().run_in_executor(get_render_pool(), fn, *args)
+    except BaseException:
+        stats[running] -= 1
+        slots.release()
+        raise
+    future.add_done_callback(release)
+    
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), RENDER_TIMEOUT)
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        logger.warning(f"Rendering {fn.__name__} oltre {RENDER_TIMEOUT:.0f}s")
+        raise HTTPException(status_code=504, detail="La generazione del documento ha superato il tempo massimo")
+    except BrokenProcessPool:
+        # Un worker è terminato in modo anomalo (es. memoria esaurita): il pool va ricreato
+        logger.error("Pool di rendering interrotto, verrà ricreato")
+        _render_pool = None
+        raise HTTPException(status_code=503, detail="Generazione del documento non riuscita, riprova")
+
+@api_router.get("/system/render-pool")
+async def get_render_pool_stats(payload: dict = Depends(verify_token)):
+    """Metriche del pool di rendering: documenti in esecuzione, in coda e rifiutati"""
+    return {
+        "workers": RENDER_WORKERS,
+        "queue_limit": RENDER_QUEUE_LIMIT,
+        "timeout_seconds": RENDER_TIMEOUT,
+        "queue_depth": render_queue_depth(),
+        "background_depth": render_queue_depth(background=True),
+        **render_pool_stats,
+    }
+
+# ============== RENDER CACHE ==============
+# Cache su disco dei PDF/ZIP delle cartelle paziente. La chiave contiene un hash
+# del contenuto effettivamente renderizzato (paziente e schede), quindi qualsiasi
+# modifica a un documento collegato produce una chiave nuova: una voce in cache non
+# può mai essere obsoleta. Salvando una nuova versione si eliminano le precedenti
+# dello stesso documento; oltre RENDER_CACHE_MAX_BYTES si eliminano le voci usate
+# meno di recente (LRU sul tempo di ultimo accesso, aggiornato a ogni hit) e quelle
+# non lette da più di RENDER_CACHE_MAX_AGE_DAYS (versioni superate mai più richieste).
+# I documenti sono dati sanitari: directory 0700 e file 0600, e la cache viene
+# disattivata se la directory (di default nella temp condivisa) non è dell'utente
+# del processo.
+RENDER_CACHE_DIR = Path(os.environ.get("RENDER_CACHE_DIR", Path(tempfile.gettempdir()) / "ambulatorio-render-cache"))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_MB", 256)) * 1024 * 1024
+RENDER_CACHE_MAX_AGE = float(os.environ.get("RENDER_CACHE_MAX_AGE_DAYS", 7)) * 86400
+
+_render_cache_lock = threading.Lock()
+_render_cache_index: Optional[OrderedDict] = None  # percorso -> (dimensione, ultimo accesso), dal meno recente
+_render_cache_size = 0
+_render_cache_usable: Optional[bool] = None
+render_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def render_content_version(*parts) -> str:
+    """Versione del contenuto: hash dei documenti da cui dipende il rendering"""
+    payload = json.dumps([PDF_TEMPLATE_VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+def _render_cache_ready() -> bool:
+    """Crea la directory della cache (0700) e verifica che sia dell'utente del processo;
+    altrimenti la cache resta disattivata (da chiamare con il lock)"""
+    global _render_cache_usable
+    if _render_cache_usable is None:
+        try:
+            RENDER_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            stat = RENDER_CACHE_DIR.lstat()
+            if RENDER_CACHE_DIR.is_symlink() or (hasattr(os, "getuid") and stat.st_uid != os.getuid()):
+                raise PermissionError(f"{RENDER_CACHE_DIR} non appartiene all'utente del processo")
+            if stat.st_mode & 0o077:
+                RENDER_CACHE_DIR.chmod(0o700)
+            _render_cache_usable = True
+        except OSError as e:
+            logger.warning(f"Cache dei documenti disattivata: {e}")
+            _render_cache_usable = False
+    return _render_cache_usable
+
+def _render_cache_entries() -> OrderedDict:
+    """Indice delle voci su disco, ricostruito al primo accesso (da chiamare con il lock)"""
+    global _render_cache_index, _render_cache_size
+    if _render_cache_index is None:
+        files = []
+        for path in RENDER_CACHE_DIR.glob("*/*"):
+            stat = path.stat()
+            # Voci create prima dei permessi restrittivi
+            if stat.st_mode & 0o077:
+                path.chmod(0o600)
+                path.parent.chmod(0o700)
+            files.append((stat.st_mtime, path, stat.st_size))
+        files.sort(key=lambda f: f[0])
+        _render_cache_index = OrderedDict((path, (size, mtime)) for mtime, path, size in files)
+        _render_cache_size = sum(size for size, _ in _render_cache_index.values())
+        _render_cache_expire()
+    return _render_cache_index
+
+def _render_cache_remove(path: Path) -> None:
+    global _render_cache_size
+    size, _ = _render_cache_entries().pop(path, (0, 0))
+    _render_cache_size -= size
+    path.unlink(missing_ok=True)
+
+def _render_cache_expire() -> None:
+    """Elimina le voci non lette da più di RENDER_CACHE_MAX_AGE (le più vecchie sono in testa)"""
+    cutoff = time.time() - RENDER_CACHE_MAX_AGE
+    while _render_cache_index and next(iter(_render_cache_index.values()))[1] < cutoff:
+        _render_cache_remove(next(iter(_render_cache_index)))
+        render_cache_stats["evictions"] += 1
+
+def render_cache_get(patient_id: str, name: str, version: str) -> Optional[bytes]:
+    path = RENDER_CACHE_DIR / patient_id / f"{name}.{version}"
+    with _render_cache_lock:
+        if not _render_cache_ready():
+            render_cache_stats["misses"] += 1
+            return None
+        entries = _render_cache_entries()
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            entries.pop(path, None)
+            render_cache_stats["misses"] += 1
+            return None
+        os.utime(path)
+        entries[path] = (len(data), time.time())
+        entries.move_to_end(path)
+        render_cache_stats["hits"] += 1
+        return data
+
+def render_cache_put(patient_id: str, name: str, version: str, data: bytes) -> None:
+    global _render_cache_size
+    directory = RENDER_CACHE_DIR / patient_id
+    path = directory / f"{name}.{version}"
+    with _render_cache_lock:
+        if not _render_cache_ready():
+            return
+        entries = _render_cache_entries()
+        directory.mkdir(mode=0o700, exist_ok=True)
+        # Le versioni precedenti dello stesso documento non servono più
+        for old in directory.glob(f"{name}.*"):
+            if old != path:
+                _render_cache_remove(old)
+        tmp = path.with_suffix(".tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        tmp.replace(path)
+        _render_cache_size += len(data) - entries.get(path, (0, 0))[0]
+        entries[path] = (len(data), time.time())
+        entries.move_to_end(path)
+        _render_cache_expire()
+        while _render_cache_size > RENDER_CACHE_MAX_BYTES and len(entries) > 1:
+            _render_cache_remove(next(iter(entries)))
+            render_cache_stats["evictions"] += 1
+
+def render_cache_drop(patient_ids) -> None:
+    with _render_cache_lock:
+        if not _render_cache_ready():
+            return
+        for patient_id in patient_ids:
+            directory = RENDER_CACHE_DIR / patient_id
+            if not directory.exists():
+                continue
+            for path in directory.iterdir():
+                _render_cache_remove(path)
+            directory.rmdir()
+
+async def invalidate_render_cache(patient_ids) -> None:
+    """Rimuove dal disco i documenti in cache dei pazienti eliminati"""
+    await asyncio.to_thread(render_cache_drop, [p for p in patient_ids if p])
+
+async def cached_render(patient_id: str, name: str, version: str, fn, *args, background: bool = False) -> bytes:
+    """Restituisce il documento dalla cache o lo genera nel pool di rendering"""
+    data = await asyncio.to_thread(render_cache_get, patient_id, name, version)
+    if data is not None:
+        return data
+    data = await render_in_pool(fn, *args, background=background)
+    try:
+        await asyncio.to_thread(render_cache_put, patient_id, name, version, data)
+    except OSError as e:
+        logger.warning(f"Impossibile salvare in cache {name} del paziente {patient_id}: {e}")
+    return data
+
+async def render_patient_folder_pdf(patient: dict, section: str, schede: tuple, background: bool = False,
+                                    name: Optional[str] = None) -> bytes:
+    """PDF della cartella dalla cache; `name` distingue varianti (es. schede filtrate
+    per periodo) che non devono sostituire la versione completa in cache"""
+    version = render_content_version(patient, *schede)
+    return await cached_render(
+        patient["id"], name or f"pdf_{section}", version,
+        generate_patient_pdf_section, patient, *schede, section, background=background
+    )
+
+@api_router.get("/system/render-cache")
+async def get_render_cache_stats(payload: dict = Depends(verify_token)):
+    """Occupazione e hit rate della cache dei documenti generati"""
+    def snapshot():
+        with _render_cache_lock:
+            if not _render_cache_ready():
+                return 0, 0
+            return len(_render_cache_entries()), _render_cache_size
+    entries, size = await asyncio.to_thread(snapshot)
+    return {"entries": entries, "size_bytes": size, "max_bytes": RENDER_CACHE_MAX_BYTES, **render_cache_stats}
+
+# ============== STATISTICS PDF ==============
+# Report PDF delle statistiche (prestazioni, impianti, confronto tra periodi), gli
+# stessi link restituiti dall'assistente come pdf_endpoint. I numeri arrivano dal
+# rollup giornaliero; grafici e impaginazione sono generati nel pool di rendering.
+# La versione in cache è l'hash dei dati del report: finché le statistiche del
+# periodo non cambiano si riusa lo stesso PDF.
+STATISTICS_MONTHS = ["", "Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
+                     "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
+
+AMBULATORIO_LABELS = {
+    "pta_centro": "PTA Centro",
+    "villa_ginestre": "Villa delle Ginestre",
+}
+
+PRESTAZIONI_LABELS = {
+    "medicazione_semplice": "Medicazione semplice",
+    "irrigazione_catetere": "Irrigazione catetere",
+    "fasciatura_semplice": "Fasciatura semplice",
+    "iniezione_terapeutica": "Iniezione terapeutica",
+    "catetere_vescicale": "Catetere vescicale",
+    "espianto_picc": "Espianto PICC",
+    "espianto_picc_port": "Espianto PICC Port",
+    "espianto_midline": "Espianto Midline",
+}
+
+STATISTICS_CHART_COLORS = [colors.HexColor(c) for c in ("#1e40af", "#f59e0b", "#166534", "#dc2626", "#7c3aed", "#0891b2")]
+
+def parse_statistics_month(value: Optional[str]) -> Optional[int]:
+    """Mese opzionale da query string: i link dell'assistente passano mese vuoto per l'anno intero"""
+    if value in (None, "", "None", "null"):
+        return None
+    try:
+        mese = int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Mese non valido")
+    if not 1 <= mese <= 12:
+        raise HTTPException(status_code=400, detail="Mese non valido")
+    return mese
+
+def normalize_statistics_tipo(value: Optional[str]) -> Optional[str]:
+    """"tutti" (e i valori vuoti) significano nessun filtro per tipo"""
+    if value in (None, "", "None", "null", "tutti", "IMPIANTI"):
+        return None
+    return value
+
+def statistics_period_label(anno: int, mese: Optional[int]) -> str:
+    return f"{STATISTICS_MONTHS[mese]} {anno}" if mese else f"Anno {anno}"
+
+def statistics_trend(docs: List[dict], anno: int, mese: Optional[int], value) -> dict:
+    """Andamento nel periodo: per giorno se è un mese, per mese se è un anno"""
+    if mese:
+        start_date, end_date = statistics_date_range(anno, mese)
+        giorni = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days
+        labels = [str(d) for d in range(1, giorni + 1)]
+        bucket = lambda data: int(data[8:10]) - 1
+    else:
+        labels = [m[:3] for m in STATISTICS_MONTHS[1:]]
+        bucket = lambda data: int(data[5:7]) - 1
+    values = [0] * len(labels)
+    for doc in docs:
+        values[bucket(doc["data"])] += value(doc)
+    return {"per_giorno": bool(mese), "labels": labels, "values": values}
+
+def statistics_bar_chart(categories: List[str], series: List[List[int]], names: Optional[List[str]] = None,
+                         width: float = 17*cm, height: float = 7*cm) -> Drawing:
+    """Istogramma a barre verticali (una serie per periodo/grandezza)"""
+    # Etichette lunghe (nomi delle prestazioni) ruotate sotto l'asse
+    rotate = any(len(c) > 10 for c in categories)
+    bottom = 3*cm if rotate else 1*cm
+    top = 1.1*cm if names else 0.3*cm
+    drawing = Drawing(width, height + bottom)
+    chart = VerticalBarChart()
+    chart.x = 1.2*cm
+    chart.y = bottom
+    chart.width = width - 1.5*cm
+    chart.height = height - top
+    chart.data = [tuple(s) for s in series]
+    chart.categoryAxis.categoryNames = categories
+    chart.categoryAxis.labels.fontSize = 7
+    if rotate:
+        chart.categoryAxis.labels.angle = 30
+        chart.categoryAxis.labels.boxAnchor = 'ne'
+    # Scala intera: con pochi valori ReportLab sceglierebbe passi decimali
+    max_value = max([v for s in series for v in s] or [0])
+    step = max(1, -(-max_value // 5))
+    chart.valueAxis.valueMin = 0
+    chart.valueAxis.valueMax = step * max(1, -(-max_value // step))
+    chart.valueAxis.valueStep = step
+    chart.valueAxis.labels.fontSize = 7
+    chart.valueAxis.labelTextFormat = '%d'
+    chart.barSpacing = 1
+    chart.groupSpacing = 4 if len(categories) > 12 else 8
+    for i in range(len(series)):
+        chart.bars[i].fillColor = STATISTICS_CHART_COLORS[i % len(STATISTICS_CHART_COLORS)]
+        chart.bars[i].strokeColor = None
+    if len(categories) <= 12:
+        chart.barLabelFormat = '%d'
+        chart.barLabels.fontSize = 6
+        chart.barLabels.nudge = 5
+    drawing.add(chart)
+    if names:
+        legend = Legend()
+        legend.x = chart.x
+        legend.y = bottom + height - 0.2*cm
+        legend.alignment = 'right'
+        legend.columnMaximum = 1
+        legend.fontSize = 8
+        legend.boxAnchor = 'nw'
+        legend.deltax = 4*cm
+        legend.colorNamePairs = [(STATISTICS_CHART_COLORS[i % len(STATISTICS_CHART_COLORS)], n) for i, n in enumerate(names)]
+        drawing.add(legend)
+    return drawing
+
+def statistics_pie_chart(labels: List[str], values: List[int], width: float = 17*cm, height: float = 6*cm) -> Drawing:
+    """Torta con legenda a destra (etichetta, numero)"""
+    drawing = Drawing(width, height)
+    pie = Pie()
+    pie.x = 1*cm
+    pie.y = 0.3*cm
+    pie.width = pie.height = height - 0.6*cm
+    pie.data = values
+    pie.slices.strokeColor = colors.white
+    for i in range(len(values)):
+        pie.slices[i].fillColor = STATISTICS_CHART_COLORS[i % len(STATISTICS_CHART_COLORS)]
+    drawing.add(pie)
+    legend = Legend()
+    legend.x = pie.x + pie.width + 1.5*cm
+    legend.y = height / 2
+    legend.alignment = 'right'
+    legend.boxAnchor = 'w'
+    legend.fontSize = 9
+    legend.colorNamePairs = [
+        (STATISTICS_CHART_COLORS[i % len(STATISTICS_CHART_COLORS)], f"{label} ({value})")
+        for i, (label, value) in enumerate(zip(labels, values))
+    ]
+    drawing.add(legend)
+    return drawing
+
+def statistics_share_rows(counts: List[tuple]) -> List[list]:
+    """Righe (etichetta, numero, percentuale) ordinate per numero decrescente"""
+    totale = sum(c for _, c in counts) or 1
+    return [[label, count, f"{count / totale * 100:.1f}%"] for label, count in sorted(counts, key=lambda c: -c[1])]
+
+def statistics_report_header(story: list, title: str, subtitle: str) -> None:
+    story.append(Paragraph(title, PDF_STYLES["folder_title"]))
+    story.append(Paragraph(subtitle, PDF_STYLES["folder_normal"]))
+    story.append(Spacer(1, 12))
+
+def statistics_trend_section(story: list, trend: dict, what: str) -> None:
+    unita = "giornaliero" if trend["per_giorno"] else "mensile"
+    story.append(Paragraph(f"Andamento {unita} {what}", PDF_STYLES["folder_heading"]))
+    story.append(statistics_bar_chart(trend["labels"], [trend["values"]]))
+    story.append(Spacer(1, 12))
+
+def generate_statistics_pdf(report: dict) -> bytes:
+    """Report prestazioni di un periodo: riepilogo, prestazioni erogate e andamento degli accessi"""
+    stats = report["stats"]
+    heading_style = PDF_STYLES["folder_heading"]
+    normal_style = PDF_STYLES["folder_normal"]
+    story = []
+    
+    title = f"Report Prestazioni - {report['periodo']}"
+    statistics_report_header(story, title, f"<b>Ambulatorio:</b> {report['ambulatorio']} &nbsp;&nbsp; <b>Tipo:</b> {report['tipo'] or 'Tutti'}")
+    
+    prestazioni = [(PRESTAZIONI_LABELS.get(p, p), c) for p, c in stats["prestazioni"].items()]
+    story.append(Paragraph("Riepilogo", heading_style))
+    summary = Table([
+        ["Totale accessi:", stats["totale_accessi"]],
+        ["Pazienti unici:", stats["pazienti_unici"]],
+        ["Prestazioni erogate:", sum(c for _, c in prestazioni)],
+    ], colWidths=[5*cm, 11*cm])
+    summary.setStyle(PDF_TABLE_STYLES["label_value"])
+    story.append(summary)
+    story.append(Spacer(1, 12))
+    
+    story.append(Paragraph("Prestazioni", heading_style))
+    if prestazioni:
+        rows = statistics_share_rows(prestazioni)
+        table = Table([["Prestazione", "Numero", "%"]] + rows, colWidths=[9*cm, 3*cm, 3*cm])
+        table.setStyle(PDF_TABLE_STYLES["report_grid"])
+        story.append(table)
+        story.append(Spacer(1, 10))
+        story.append(statistics_bar_chart([r[0] for r in rows], [[r[1] for r in rows]]))
+    else:
+        story.append(Paragraph("Nessuna prestazione registrata nel periodo.", normal_style))
+    story.append(Spacer(1, 12))
+    
+    statistics_trend_section(story, report["andamento"], "degli accessi")
+    
+    # Per il report annuale anche il dettaglio numerico mese per mese
+    if stats["dettaglio_mensile"] and not stats["mese"]:
+        rows = [["Mese", "Accessi", "Pazienti unici", "Prestazioni"]]
+        for month, m in sorted(stats["dettaglio_mensile"].items()):
+            rows.append([STATISTICS_MONTHS[int(month[5:7])], m["accessi"], m["pazienti_unici"], sum(m["prestazioni"].values())])
+        table = Table(rows, colWidths=[6*cm, 3*cm, 3*cm, 3*cm])
+        table.setStyle(PDF_TABLE_STYLES["report_grid"])
+        story.append(table)
+    
+    return build_pdf(story, "folder", title=f"{title} - {report['ambulatorio']}")
+
+def generate_implant_statistics_pdf(report: dict) -> bytes:
+    """Report impianti di un periodo: totale, ripartizione per tipo e andamento"""
+    stats = report["stats"]
+    heading_style = PDF_STYLES["folder_heading"]
+    story = []
+    
+    tipo_label = stats["tipo_labels"].get(report["tipo"], report["tipo"]) if report["tipo"] else "Tutti"
+    title = f"Report Impianti - {report['periodo']}"
+    statistics_report_header(story, title, f"<b>Ambulatorio:</b> {report['ambulatorio']} &nbsp;&nbsp; <b>Tipo impianto:</b> {tipo_label}")
+    
+    story.append(Paragraph("Riepilogo", heading_style))
+    summary = Table([["Totale impianti:", stats["totale_impianti"]]], colWidths=[5*cm, 11*cm])
+    summary.setStyle(PDF_TABLE_STYLES["label_value"])
+    story.append(summary)
+    story.append(Spacer(1, 12))
+    
+    per_tipo = [(stats["tipo_labels"].get(t, t), c) for t, c in stats["per_tipo"].items() if c]
+    story.append(Paragraph("Impianti per tipo", heading_style))
+    if per_tipo:
+        rows = statistics_share_rows(per_tipo)
+        table = Table([["Tipo", "Numero", "%"]] + rows, colWidths=[9*cm, 3*cm, 3*cm])
+        table.setStyle(PDF_TABLE_STYLES["report_grid"])
+        story.append(table)
+        story.append(Spacer(1, 10))
+        story.append(statistics_pie_chart([r[0] for r in rows], [r[1] for r in rows]))
+    else:
+        story.append(Paragraph("Nessun impianto registrato nel periodo.", PDF_STYLES["folder_normal"]))
+    story.append(Spacer(1, 12))
+    
+    statistics_trend_section(story, report["andamento"], "degli impianti")
+    
+    return build_pdf(story, "folder", title=f"{title} - {report['ambulatorio']}")
+
+def generate_compare_statistics_pdf(report: dict) -> bytes:
+    """Confronto tra due periodi: accessi, pazienti, impianti e prestazioni con differenze"""
+    p1, p2 = report["periodo1"], report["periodo2"]
+    s1, s2 = report["stats1"], report["stats2"]
+    heading_style = PDF_STYLES["folder_heading"]
+    story = []
+    
+    def diff(a, b):
+        return f"{b - a:+d}" if b != a else "0"
+    
+    title = f"Confronto Statistiche - {p1} vs {p2}"
+    statistics_report_header(story, title, f"<b>Ambulatorio:</b> {report['ambulatorio']} &nbsp;&nbsp; <b>Tipo:</b> {report['tipo'] or 'Tutti'}")
+    
+    story.append(Paragraph("Riepilogo", heading_style))
+    metriche = [
+        ("Accessi", s1["totale_accessi"], s2["totale_accessi"]),
+        ("Pazienti unici", s1["pazienti_unici"], s2["pazienti_unici"]),
+        ("Impianti", report["impianti1"], report["impianti2"]),
+    ]
+    rows = [["Metrica", p1, p2, "Differenza"]] + [[label, a, b, diff(a, b)] for label, a, b in metriche]
+    table = Table(rows, colWidths=[6*cm, 3.5*cm, 3.5*cm, 3*cm])
+    table.setStyle(PDF_TABLE_STYLES["report_grid"])
+    story.append(table)
+    story.append(Spacer(1, 10))
+    story.append(statistics_bar_chart([m[0] for m in metriche], [[m[1] for m in metriche], [m[2] for m in metriche]], names=[p1, p2], height=6*cm))
+    story.append(Spacer(1, 12))
+    
+    story.append(Paragraph("Prestazioni", heading_style))
+    prestazioni = sorted(set(s1["prestazioni"]) | set(s2["prestazioni"]), key=lambda p: -(s1["prestazioni"].get(p, 0) + s2["prestazioni"].get(p, 0)))
+    if prestazioni:
+        rows = [["Prestazione", p1, p2, "Differenza"]]
+        for p in prestazioni:
+            a, b = s1["prestazioni"].get(p, 0), s2["prestazioni"].get(p, 0)
+            rows.append([PRESTAZIONI_LABELS.get(p, p), a, b, diff(a, b)])
+        table = Table(rows, colWidths=[6*cm, 3.5*cm, 3.5*cm, 3*cm])
+        table.setStyle(PDF_TABLE_STYLES["report_grid"])
+        story.append(table)
+        story.append(Spacer(1, 10))
+        story.append(statistics_bar_chart(
+            [r[0] for r in rows[1:]], [[r[1] for r in rows[1:]], [r[2] for r in rows[1:]]], names=[p1, p2]
+        ))
+    else:
+        story.append(Paragraph("Nessuna prestazione registrata nei due periodi.", PDF_STYLES["folder_normal"]))
+    
+    return build_pdf(story, "folder", title=f"{title} - {report['ambulatorio']}")
+
+async def render_statistics_pdf(ambulatorio: Ambulatorio, name: str, fn, report: dict) -> Response:
+    """Genera (o riprende dalla cache) il report e lo restituisce come allegato"""
+    pdf_bytes = await cached_render(
+        f"statistiche_{ambulatorio.value}", name, render_content_version(report), fn, report
+    )
+    return Response(
+        content=pdf_bytes,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename={name}.pdf"}
+    )
+
+@api_router.get("/statistics/pdf")
+async def download_statistics_pdf(
+    ambulatorio: Ambulatorio,
+    anno: int,
+    mese: Optional[str] = None,
+    tipo: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Report PDF delle prestazioni del mese (o dell'anno)"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    mese = parse_statistics_month(mese)
+    tipo = normalize_statistics_tipo(tipo)
+    docs, stats = await load_prestazioni_statistics(ambulatorio, anno, mese, tipo)
+    report = {
+        "ambulatorio": AMBULATORIO_LABELS.get(ambulatorio.value, ambulatorio.value),
+        "periodo": statistics_period_label(anno, mese),
+        "tipo": tipo,
+        "stats": stats,
+        "andamento": statistics_trend(docs, anno, mese, lambda d: d.get("accessi", 0)),
+    }
+    name = f"prestazioni_{anno}_{mese:02d}" if mese else f"prestazioni_{anno}"
+    return await render_statistics_pdf(ambulatorio, f"{name}_{tipo or 'tutti'}", generate_statistics_pdf, report)
+
+@api_router.get("/statistics/implants/pdf")
+async def download_implant_statistics_pdf(
+    ambulatorio: Ambulatorio,
+    anno: int,
+    mese: Optional[str] = None,
+    tipo: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Report PDF degli impianti del mese (o dell'anno), eventualmente di un solo tipo"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    mese = parse_statistics_month(mese)
+    tipo = normalize_statistics_tipo(tipo)
+    docs, stats = await load_implant_statistics(ambulatorio, anno, mese)
+    if tipo:
+        stats["per_tipo"] = {t: c for t, c in stats["per_tipo"].items() if t == tipo}
+        stats["totale_impianti"] = sum(stats["per_tipo"].values())
+    stats.pop("dettaglio_mensile")  # l'andamento è calcolato sotto, già filtrato per tipo
+    report = {
+        "ambulatorio": AMBULATORIO_LABELS.get(ambulatorio.value, ambulatorio.value),
+        "periodo": statistics_period_label(anno, mese),
+        "tipo": tipo,
+        "stats": stats,
+        "andamento": statistics_trend(
+            docs, anno, mese,
+            lambda d: sum(c for t, c in d.get("impianti", {}).items() if not tipo or t == tipo)
+        ),
+    }
+    name = f"impianti_{anno}_{mese:02d}" if mese else f"impianti_{anno}"
+    return await render_statistics_pdf(ambulatorio, f"{name}_{tipo or 'tutti'}", generate_implant_statistics_pdf, report)
+
+@api_router.get("/statistics/compare/pdf")
+async def download_compare_statistics_pdf(
+    ambulatorio: Ambulatorio,
+    anno1: int,
+    anno2: int,
+    mese1: Optional[str] = None,
+    mese2: Optional[str] = None,
+    tipo: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Report PDF del confronto tra due periodi"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    mese1 = parse_statistics_month(mese1)
+    mese2 = parse_statistics_month(mese2)
+    tipo = normalize_statistics_tipo(tipo)
+    (_, stats1), (_, stats2), (_, impianti1), (_, impianti2) = await asyncio.gather(
+        load_prestazioni_statistics(ambulatorio, anno1, mese1, tipo),
+        load_prestazioni_statistics(ambulatorio, anno2, mese2, tipo),
+        load_implant_statistics(ambulatorio, anno1, mese1),
+        load_implant_statistics(ambulatorio, anno2, mese2),
+    )
+    for stats in (stats1, stats2):
+        stats.pop("dettaglio_mensile")  # non usato nel confronto
+    report = {
+        "ambulatorio": AMBULATORIO_LABELS.get(ambulatorio.value, ambulatorio.value),
+        "periodo1": statistics_period_label(anno1, mese1),
+        "periodo2": statistics_period_label(anno2, mese2),
+        "tipo": tipo,
+        "stats1": stats1,
+        "stats2": stats2,
+        "impianti1": impianti1["totale_impianti"],
+        "impianti2": impianti2["totale_impianti"],
+    }
+    periodo1 = f"{anno1}_{mese1:02d}" if mese1 else str(anno1)
+    periodo2 = f"{anno2}_{mese2:02d}" if mese2 else str(anno2)
+    return await render_statistics_pdf(
+        ambulatorio, f"confronto_{periodo1}_{periodo2}_{tipo or 'tutti'}", generate_compare_statistics_pdf, report
+    )
+
 # ============== PATIENT FOLDER DOWNLOAD ==============
 
 def generate_patient_pdf_section(patient: dict, schede_med: list, schede_impianto: list, schede_gestione: list, section: str = "all") -> bytes:
     """Generate PDF for a specific section of the patient folder
     section: 'all', 'anagrafica', 'medicazione', 'impianto', 'gestione'
     """
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm, topMargin=2*cm, bottomMargin=2*cm)
-    
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=18, spaceAfter=30, alignment=TA_CENTER)
-    heading_style = ParagraphStyle('CustomHeading', parent=styles['Heading2'], fontSize=14, spaceAfter=12, textColor=colors.HexColor('#1e40af'))
-    normal_style = ParagraphStyle('CustomNormal', parent=styles['Normal'], fontSize=11, spaceAfter=6)
+    title_style = PDF_STYLES["folder_title"]
+    heading_style = PDF_STYLES["folder_heading"]
+    normal_style = PDF_STYLES["folder_normal"]
     
     story = []
     
@@ -2464,12 +4575,7 @@ def generate_patient_pdf_section(patient: dict, schede_med: list, schede_impiant
             ["Stato:", patient.get('status', '-')],
         ]
         table = Table(info_data, colWidths=[4*cm, 12*cm])
-        table.setStyle(TableStyle([
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-            ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ]))
+        table.setStyle(PDF_TABLE_STYLES["label_value"])
         story.append(table)
         story.append(Spacer(1, 20))
         
@@ -2511,7 +4617,6 @@ def generate_patient_pdf_section(patient: dict, schede_med: list, schede_impiant
             
             for idx, scheda in enumerate(schede_complete, 1):
                 if idx > 1:
-                    from reportlab.platypus import PageBreak
                     story.append(PageBreak())
                 
                 story.append(Paragraph(f"<b>Scheda Impianto #{idx}</b>", normal_style))
@@ -2662,18 +4767,7 @@ def generate_patient_pdf_section(patient: dict, schede_med: list, schede_impiant
                         
                         col_widths = [5*cm] + [1.2*cm] * len(chunk_dates)
                         table = Table(table_data, colWidths=col_widths)
-                        table.setStyle(TableStyle([
-                            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                            ('FONTNAME', (0, 1), (0, -1), 'Helvetica'),
-                            ('FONTSIZE', (0, 0), (-1, -1), 6),
-                            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#166534')),
-                            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                            ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
-                            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                            ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-                            ('TOPPADDING', (0, 0), (-1, -1), 2),
-                            ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f0f0f0')]),
-                        ]))
+                        table.setStyle(PDF_TABLE_STYLES["gestione_grid"])
                         story.append(table)
                         story.append(Spacer(1, 10))
                     
@@ -2684,25 +4778,20 @@ def generate_patient_pdf_section(patient: dict, schede_med: list, schede_impiant
                 
                 story.append(Spacer(1, 15))
     
-    doc.build(story)
-    buffer.seek(0)
-    return buffer.getvalue()
+    return build_pdf(story, "folder", title=title)
 
 
 def generate_patient_pdf(patient: dict, schede_med: list, schede_impianto: list, schede_gestione: list, photos: list) -> bytes:
     """Generate a PDF with patient data - NO allegati, NO foto in scheda MED, only COMPLETE scheda impianto"""
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm, topMargin=2*cm, bottomMargin=2*cm)
-    
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=18, spaceAfter=30, alignment=TA_CENTER)
-    heading_style = ParagraphStyle('CustomHeading', parent=styles['Heading2'], fontSize=14, spaceAfter=12, textColor=colors.HexColor('#1e40af'))
-    normal_style = ParagraphStyle('CustomNormal', parent=styles['Normal'], fontSize=11, spaceAfter=6)
+    title_style = PDF_STYLES["folder_title"]
+    heading_style = PDF_STYLES["folder_heading"]
+    normal_style = PDF_STYLES["folder_normal"]
     
     story = []
     
     # Title
-    story.append(Paragraph(f"Cartella Clinica - {patient.get('cognome', '')} {patient.get('nome', '')}", title_style))
+    title = f"Cartella Clinica - {patient.get('cognome', '')} {patient.get('nome', '')}"
+    story.append(Paragraph(title, title_style))
     story.append(Spacer(1, 20))
     
     # SEZIONE 1: Dati Anagrafici
@@ -2720,12 +4809,7 @@ def generate_patient_pdf(patient: dict, schede_med: list, schede_impianto: list,
         ["Stato:", patient.get('status', '-')],
     ]
     table = Table(info_data, colWidths=[4*cm, 12*cm])
-    table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-    ]))
+    table.setStyle(PDF_TABLE_STYLES["label_value"])
     story.append(table)
     story.append(Spacer(1, 20))
     
@@ -2933,18 +5017,7 @@ def generate_patient_pdf(patient: dict, schede_med: list, schede_impianto: list,
                     # Create table
                     col_widths = [5*cm] + [1.2*cm] * len(chunk_dates)
                     table = Table(table_data, colWidths=col_widths)
-                    table.setStyle(TableStyle([
-                        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                        ('FONTNAME', (0, 1), (0, -1), 'Helvetica'),
-                        ('FONTSIZE', (0, 0), (-1, -1), 6),
-                        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#166534')),
-                        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                        ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
-                        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-                        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-                        ('TOPPADDING', (0, 0), (-1, -1), 2),
-                        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f0f0f0')]),
-                    ]))
+                    table.setStyle(PDF_TABLE_STYLES["gestione_grid"])
                     story.append(table)
                     story.append(Spacer(1, 10))
                 
@@ -2959,78 +5032,181 @@ def generate_patient_pdf(patient: dict, schede_med: list, schede_impianto: list,
     # NOTE: Allegati section removed from PDF download as per user request
     # Gli allegati NON vengono scaricati con la cartella paziente
     
-    doc.build(story)
-    buffer.seek(0)
-    return buffer.getvalue()
+    return build_pdf(story, "folder", title=title)
 
 
-def generate_patient_zip(patient: dict, schede_med: list, schede_impianto: list, schede_gestione: list, photos: list) -> bytes:
-    """Generate a ZIP with patient data - NO allegati, only PDF cartella clinica"""
-    buffer = io.BytesIO()
+class ZipChunkSink(io.RawIOBase):
+    """Destinazione non seekable per zipfile: i byte scritti vengono accumulati e
+    consegnati a blocchi con drain(), così l'archivio non è mai intero in memoria.
+    Su uno stream non seekable zipfile scrive le dimensioni nei data descriptor."""
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+    
+    def writable(self) -> bool:
+        return True
     
-    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        # Add PDF summary (NO allegati, NO foto MED)
-        pdf_data = generate_patient_pdf(patient, schede_med, schede_impianto, schede_gestione, [])
-        zf.writestr(f"cartella_clinica_{patient.get('cognome', 'paziente')}_{patient.get('nome', '')}.pdf", pdf_data)
-        
-        # Add patient JSON data
-        import json
-        patient_json = json.dumps(patient, indent=2, ensure_ascii=False)
-        zf.writestr("dati_paziente.json", patient_json)
-        
-        # Add MED schede as JSON (without photos)
-        if schede_med:
-            med_json = json.dumps(schede_med, indent=2, ensure_ascii=False)
-            zf.writestr("schede_medicazione_med.json", med_json)
-        
-        # Add only COMPLETE PICC impianto schede as JSON (no semplificata)
-        schede_complete = [s for s in schede_impianto if s.get('scheda_type') != 'semplificata']
-        if schede_complete:
-            impianto_json = json.dumps(schede_complete, indent=2, ensure_ascii=False)
-            zf.writestr("schede_impianto_picc.json", impianto_json)
-        
-        # Add PICC gestione schede as JSON
-        if schede_gestione:
-            gestione_json = json.dumps(schede_gestione, indent=2, ensure_ascii=False)
-            zf.writestr("schede_gestione_picc.json", gestione_json)
-        
-        # NOTE: NO allegati nel ZIP - si scaricano singolarmente
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
     
-    buffer.seek(0)
-    return buffer.getvalue()
+    def tell(self) -> int:
+        return self._position
+    
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
 
+# Formati già compressi: nell'archivio vengono solo memorizzati
+ZIP_STORED_MIME_PREFIXES = ("image/jpeg", "image/png", "image/gif", "image/webp", "application/pdf", "application/zip", "video/")
 
-@api_router.get("/patients/{patient_id}/download/pdf")
-async def download_patient_pdf(patient_id: str, section: str = "all", payload: dict = Depends(verify_token)):
-    """Download patient folder as PDF - with optional section filter
-    section: 'all', 'anagrafica', 'medicazione', 'impianto', 'gestione'
+def patient_zip_documents(patient: dict, pdf_data: bytes, schede_med: list, schede_impianto: list, schede_gestione: list) -> List[tuple]:
+    """Membri dell'archivio della cartella: PDF riepilogativo e dati in JSON"""
+    documents = [
+        (f"cartella_clinica_{patient.get('cognome', 'paziente')}_{patient.get('nome', '')}.pdf", pdf_data),
+        ("dati_paziente.json", json.dumps(patient, indent=2, ensure_ascii=False, default=str)),
+    ]
+    # MED schede as JSON (without photos)
+    if schede_med:
+        documents.append(("schede_medicazione_med.json", json.dumps(schede_med, indent=2, ensure_ascii=False, default=str)))
+    # Only COMPLETE PICC impianto schede as JSON (no semplificata)
+    schede_complete = [s for s in schede_impianto if s.get('scheda_type') != 'semplificata']
+    if schede_complete:
+        documents.append(("schede_impianto_picc.json", json.dumps(schede_complete, indent=2, ensure_ascii=False, default=str)))
+    if schede_gestione:
+        documents.append(("schede_gestione_picc.json", json.dumps(schede_gestione, indent=2, ensure_ascii=False, default=str)))
+    return documents
+
+def attachment_archive_name(photo: dict, used: set) -> str:
+    """Nome univoco dell'allegato nella cartella allegati/ dell'archivio"""
+    original = (photo.get("original_name") or photo["id"]).replace("/", "_").replace("\\", "_")
+    if "." not in original and photo.get("mime_type"):
+        original += mimetypes.guess_extension(photo["mime_type"]) or ""
+    day = (photo.get("data") or "")[:10]
+    name = f"allegati/{day}_{original}" if day else f"allegati/{original}"
+    stem, dot, ext = name.rpartition(".")
+    candidate, n = name, 1
+    while candidate in used:
+        n += 1
+        candidate = f"{stem}_{n}.{ext}" if dot else f"{name}_{n}"
+    used.add(candidate)
+    return candidate
+
+async def open_attachment(photo: dict):
+    """Apre l'allegato (blob store o foto legacy) e restituisce un iteratore sui suoi
+    blocchi: un blob mancante o illeggibile emerge qui, prima di scrivere il membro"""
+    if photo.get("blob_id"):
+        stream = await blob_bucket.open_download_stream(photo["blob_id"])
+        async def chunks():
+            while True:
+                chunk = await stream.readchunk()
+                if not chunk:
+                    break
+                yield chunk
+        return chunks()
+    data = decode_legacy_image_data(photo["image_data"])
+    async def single():
+        yield data
+    return single()
+
+async def render_patient_zip_pdf(patient: dict, schede: tuple, background: bool = False) -> bytes:
+    """PDF riepilogativo incluso nell'archivio ZIP (generato o letto dalla cache)"""
+    return await cached_render(
+        patient["id"], "pdf_cartella", render_content_version(patient, *schede),
+        generate_patient_pdf, patient, *schede, [], background=background
+    )
+
+async def stream_patient_zip(patient: dict, schede: tuple, pdf_data: bytes, include_attachments: bool = False):
+    """Produce l'archivio ZIP della cartella a blocchi compressi, membro per membro.
+
+    Il PDF va generato dal chiamante prima di iniziare la risposta, così gli errori
+    di rendering (coda piena, timeout) arrivano come stato HTTP e non come archivio
+    vuoto. Gli allegati, se richiesti, vengono letti dal blob store un blocco alla
+    volta; quelli illeggibili vengono saltati ed elencati in allegati/non_inclusi.txt.
     """
+    sink = ZipChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in patient_zip_documents(patient, pdf_data, *schede):
+            zf.writestr(name, data)
+            yield sink.drain()
+        
+        if include_attachments:
+            used = set()
+            photos = db.photos.find(
+                {"patient_id": patient["id"]}, {"_id": 0, "variants": 0}
+            ).sort([("data", 1), ("id", 1)]).batch_size(20)
+            skipped = []
+            async for photo in photos:
+                if not photo.get("blob_id") and not photo.get("image_data"):
+                    continue
+                name = attachment_archive_name(photo, used)
+                try:
+                    chunks = await open_attachment(photo)
+                except Exception as e:
+                    logger.warning(f"Allegato {photo['id']} non incluso nello ZIP di {patient['id']}: {e}")
+                    skipped.append(f"{name}: allegato non leggibile")
+                    continue
+                info = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+                mime_type = photo.get("mime_type") or ""
+                info.compress_type = zipfile.ZIP_STORED if mime_type.startswith(ZIP_STORED_MIME_PREFIXES) else zipfile.ZIP_DEFLATED
+                with zf.open(info, "w", force_zip64=(photo.get("size") or 0) > 2**31) as member:
+                    try:
+                        async for chunk in chunks:
+                            member.write(chunk)
+                            data = sink.drain()
+                            if data:
+                                yield data
+                    except Exception as e:
+                        # Il membro è già in parte nell'archivio: lo si chiude e lo si segnala
+                        logger.warning(f"Lettura dell'allegato {photo['id']} interrotta: {e}")
+                        skipped.append(f"{name}: allegato incompleto")
+                yield sink.drain()
+            if skipped:
+                zf.writestr("allegati/non_inclusi.txt", "\n".join(skipped) + "\n")
+    yield sink.drain()
+
+PATIENT_FOLDER_SECTIONS = {"all": "completa", "anagrafica": "anagrafica", "medicazione": "medicazione", "impianto": "impianto", "gestione": "gestione_picc"}
+
+async def load_patient_schede(patient_id: str, section: str = "all") -> tuple:
+    """Schede MED, impianto e gestione del paziente che servono alla sezione richiesta"""
+    async def load(collection, sections):
+        if section not in sections:
+            return []
+        return await collection.find({"patient_id": patient_id}, {"_id": 0}).to_list(None)
+    
+    return tuple(await asyncio.gather(
+        load(db.schede_medicazione_med, ("all", "medicazione")),
+        load(db.schede_impianto_picc, ("all", "impianto")),
+        load(db.schede_gestione_picc, ("all", "gestione")),
+    ))
+
+def patient_folder_filename(patient: dict, section: Optional[str], extension: str) -> str:
+    name = f"{patient.get('cognome', 'paziente')}_{patient.get('nome', '')}"
+    if section is None:
+        return f"cartella_{name}.{extension}"
+    return f"cartella_{PATIENT_FOLDER_SECTIONS.get(section, section)}_{name}.{extension}"
+
+async def get_accessible_patient(patient_id: str, payload: dict) -> dict:
     patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
     if not patient:
         raise HTTPException(status_code=404, detail="Paziente non trovato")
     if patient["ambulatorio"] not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    return patient
+
+@api_router.get("/patients/{patient_id}/download/pdf")
+async def download_patient_pdf(patient_id: str, section: str = "all", payload: dict = Depends(verify_token)):
+    """Download patient folder as PDF - with optional section filter
+    section: 'all', 'anagrafica', 'medicazione', 'impianto', 'gestione'
+    """
+    patient = await get_accessible_patient(patient_id, payload)
+    schede = await load_patient_schede(patient_id, section)
     
-    # Fetch data based on section
-    schede_med = []
-    schede_impianto = []
-    schede_gestione = []
-    
-    if section in ["all", "medicazione"]:
-        schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-    
-    if section in ["all", "impianto"]:
-        schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-    
-    if section in ["all", "gestione"]:
-        schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-    
-    # Generate PDF with the appropriate section
-    pdf_data = generate_patient_pdf_section(patient, schede_med, schede_impianto, schede_gestione, section)
-    
-    section_names = {"all": "completa", "anagrafica": "anagrafica", "medicazione": "medicazione", "impianto": "impianto", "gestione": "gestione_picc"}
-    section_name = section_names.get(section, section)
-    filename = f"cartella_{section_name}_{patient.get('cognome', 'paziente')}_{patient.get('nome', '')}.pdf"
+    # Generate PDF with the appropriate section (or reuse the cached one)
+    pdf_data = await render_patient_folder_pdf(patient, section, schede)
+    filename = patient_folder_filename(patient, section, "pdf")
     
     return StreamingResponse(
         io.BytesIO(pdf_data),
@@ -3040,29 +5216,598 @@ async def download_patient_pdf(patient_id: str, section: str = "all", payload: d
 
 
 @api_router.get("/patients/{patient_id}/download/zip")
-async def download_patient_zip(patient_id: str, payload: dict = Depends(verify_token)):
-    """Download patient folder as ZIP - NO allegati (si scaricano singolarmente)"""
-    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
+async def download_patient_zip(patient_id: str, allegati: bool = False, payload: dict = Depends(verify_token)):
+    """Download patient folder as ZIP, streamed member by member.
+    allegati=true aggiunge foto e documenti allegati nella cartella allegati/
+    """
+    patient = await get_accessible_patient(patient_id, payload)
+    schede = await load_patient_schede(patient_id)
+    pdf_data = await render_patient_zip_pdf(patient, schede)
+    filename = patient_folder_filename(patient, None, "zip")
+    
+    return StreamingResponse(
+        (chunk async for chunk in stream_patient_zip(patient, schede, pdf_data, include_attachments=allegati) if chunk),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
+# ============== RENDER JOBS ==============
+# La generazione di PDF e ZIP (ReportLab, CPU-bound) può richiedere secondi:
+# con un job il client invia la richiesta, il rendering gira in un pool di processi
+# fuori dall'event loop e il client interroga lo stato (GET /jobs/{id}?wait=N
+# attende fino a N secondi il completamento). Il risultato resta nello store
+# degli artefatti per JOB_ARTIFACT_TTL, poi viene eliminato insieme al job.
+# Un job in esecuzione aggiorna updated_at ogni JOB_HEARTBEAT_INTERVAL secondi: se
+# il processo che lo esegue termina, dopo JOB_STALE_AFTER senza heartbeat il job
+# viene rimesso in coda da qualunque replica (al più JOB_MAX_ATTEMPTS volte, poi
+# va in errore). Un job che supera JOB_MAX_RUNTIME viene interrotto.
+JOB_ARTIFACT_TTL = timedelta(hours=2)
+JOB_MAINTENANCE_INTERVAL = 60
+JOB_HEARTBEAT_INTERVAL = 30
+JOB_STALE_AFTER = timedelta(minutes=3)
+JOB_MAX_ATTEMPTS = 3
+JOB_MAX_RUNTIME = float(os.environ.get("JOB_MAX_RUNTIME", 4 * 3600))
+JOB_MAX_WAIT = 30
+
+artifact_bucket = AsyncIOMotorGridFSBucket(db, bucket_name="render_artifacts")
+
+_job_tasks: set = set()
+
+class JobKind(str, Enum):
+    PATIENT_PDF = "patient_pdf"
+    PATIENT_ZIP = "patient_zip"
+    SCHEDA_IMPIANTO_PDF = "scheda_impianto_pdf"
+    AMBULATORIO_FOLDERS = "ambulatorio_folders"
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    ERROR = "error"
+
+class RenderJobCreate(BaseModel):
+    kind: JobKind
+    patient_id: Optional[str] = None
+    section: str = "all"
+    scheda_id: Optional[str] = None
+    ambulatorio: Optional[Ambulatorio] = None
+    status: Optional[PatientStatus] = None  # solo per ambulatorio_folders
+    data_from: Optional[str] = None  # periodo (YYYY-MM-DD), solo per ambulatorio_folders
+    data_to: Optional[str] = None
+    include_attachments: bool = False  # solo per patient_zip
+
+def job_view(job: dict) -> dict:
+    """Stato del job esposto al client (senza riferimenti interni)"""
+    view = {k: job.get(k) for k in (
+        "id", "kind", "status", "ambulatorio", "progress", "error", "filename",
+        "size", "created_at", "finished_at", "expires_at"
+    )}
+    view["download_url"] = f"/jobs/{job['id']}/download" if job.get("status") == JobStatus.DONE.value else None
+    return view
+
+async def store_artifact(job_id: str, filename: str, data, media_type: str) -> tuple:
+    """Salva il risultato di un job e restituisce (artifact_id, dimensione).
+
+    `data` può essere bytes oppure un generatore asincrono di blocchi, scritto in
+    GridFS man mano che viene prodotto (senza copie in memoria o file temporanei).
+    """
+    artifact_id = f"{job_id}/{filename}"
+    metadata = {"mime_type": media_type, "job_id": job_id}
+    # Un'esecuzione precedente interrotta può aver lasciato lo stesso id
+    await discard_artifact(artifact_id)
+    if isinstance(data, bytes):
+        await artifact_bucket.upload_from_stream_with_id(artifact_id, filename, data, metadata=metadata)
+        return artifact_id, len(data)
+    
+    grid_in = artifact_bucket.open_upload_stream_with_id(artifact_id, filename, metadata=metadata)
+    size = 0
+    try:
+        async for chunk in data:
+            if chunk:
+                await grid_in.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+    return artifact_id, size
+
+async def discard_artifact(artifact_id: str) -> None:
+    """Elimina un artefatto, compresi i chunk orfani di un upload interrotto.
+
+    GridFS scrive il documento .files solo a upload completato: dopo un riavvio
+    restano i chunk, e un nuovo upload con lo stesso id fallirebbe con FileExists.
+    """
+    await db["render_artifacts.files"].delete_one({"_id": artifact_id})
+    await db["render_artifacts.chunks"].delete_many({"files_id": artifact_id})
+
+async def delete_job_artifacts(job_id: str) -> None:
+    """Elimina il risultato di un job ed eventuali parti intermedie (anche incomplete)"""
+    files = await db["render_artifacts.files"].find({"metadata.job_id": job_id}, {"_id": 1}).to_list(None)
+    for f in files:
+        try:
+            await artifact_bucket.delete(f["_id"])
+        except Exception as e:
+            logger.warning(f"Impossibile eliminare l'artefatto {f['_id']}: {e}")
+    # Gli id degli artefatti iniziano con l'id del job: chunk rimasti senza documento .files
+    await db["render_artifacts.chunks"].delete_many({"files_id": {"$regex": f"^{re.escape(job_id)}/"}})
+
+async def update_job_progress(job_id: str, done: int, total: int) -> None:
+    await db.render_jobs.update_one(
+        {"id": job_id},
+        {"$set": {"progress": {"done": done, "total": total}, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def render_patient_pdf_job(job: dict) -> tuple:
+    params = job["params"]
+    patient = await db.patients.find_one({"id": params["patient_id"]}, {"_id": 0})
     if not patient:
-        raise HTTPException(status_code=404, detail="Paziente non trovato")
-    if patient["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+        raise ValueError("Paziente non trovato")
+    schede = await load_patient_schede(patient["id"], params["section"])
+    data = await render_patient_folder_pdf(patient, params["section"], schede, background=True)
+    return data, patient_folder_filename(patient, params["section"], "pdf"), "application/pdf"
+
+async def render_patient_zip_job(job: dict) -> tuple:
+    patient = await db.patients.find_one({"id": job["params"]["patient_id"]}, {"_id": 0})
+    if not patient:
+        raise ValueError("Paziente non trovato")
+    schede = await load_patient_schede(patient["id"])
+    pdf_data = await render_patient_zip_pdf(patient, schede, background=True)
+    stream = stream_patient_zip(
+        patient, schede, pdf_data, include_attachments=job["params"].get("include_attachments", False)
+    )
+    return stream, patient_folder_filename(patient, None, "zip"), "application/zip"
+
+async def render_scheda_impianto_job(job: dict) -> tuple:
+    scheda = await db.schede_impianto_picc.find_one({"id": job["params"]["scheda_id"]}, {"_id": 0})
+    if not scheda:
+        raise ValueError("Scheda non trovata")
+    patient = await db.patients.find_one({"id": scheda["patient_id"]}, {"_id": 0})
+    data = await render_in_pool(generate_scheda_impianto_pdf, scheda, patient, background=True)
+    data_file = scheda.get('data_posizionamento') or scheda.get('data_impianto') or 'nd'
+    return data, f"scheda_impianto_{data_file}.pdf", "application/pdf"
+
+# Esportazione di tutte le cartelle di un ambulatorio (audit, stampa di fine mese).
+# Le schede vengono lette a lotti con query $in, i PDF generati nel pool di
+# rendering (al più RENDER_WORKERS alla volta per job) e salvati come parti del
+# job man mano che sono pronti: se il job si interrompe (riavvio del pod) o
+# fallisce per alcuni pazienti, ripetendolo riprende dalle parti mancanti. L'archivio finale viene composto in
+# streaming dalle parti, insieme a un indice JSON.
+EXPORT_BATCH_SIZE = 25
+EXPORT_PERIOD_FIELDS = {
+    "appointments": "data",
+    "schede_medicazione_med": "data_compilazione",
+    "schede_impianto_picc": "data_impianto",
+    "schede_gestione_picc": "mese",
+}
+
+def export_period_filter(collection_name: str, data_from: Optional[str], data_to: Optional[str]) -> dict:
+    """Filtro sul periodo per la data caratteristica di ogni collection"""
+    if not data_from or not data_to:
+        return {}
+    field = EXPORT_PERIOD_FIELDS[collection_name]
+    if field == "mese":
+        return {field: {"$gte": data_from[:7], "$lte": data_to[:7]}}
+    # Limite superiore esclusivo: comprende anche le date con orario (YYYY-MM-DDTHH:MM)
+    end = (datetime.strptime(data_to, "%Y-%m-%d").date() + timedelta(days=1)).isoformat()
+    return {field: {"$gte": data_from, "$lt": end}}
+
+async def select_export_patients(ambulatorio: str, status: Optional[str], data_from: Optional[str], data_to: Optional[str]) -> List[dict]:
+    """Pazienti da esportare: con un periodo, solo quelli con attività nel periodo"""
+    query = {"ambulatorio": ambulatorio}
+    if status:
+        query["status"] = status
+    if data_from and data_to:
+        active = await asyncio.gather(*[
+            db[name].distinct("patient_id", {"ambulatorio": ambulatorio, **export_period_filter(name, data_from, data_to)})
+            for name in EXPORT_PERIOD_FIELDS
+        ])
+        query["id"] = {"$in": sorted({pid for ids in active for pid in ids if pid})}
+    return await db.patients.find(
+        query, {"_id": 0, **{f: 0 for f in PATIENT_SEARCH_FIELDS}}
+    ).sort(PATIENT_LIST_SORT).to_list(None)
+
+async def load_schede_for_patients(patient_ids: List[str], data_from: Optional[str], data_to: Optional[str]) -> Dict[str, tuple]:
+    """Schede MED, impianto e gestione di un lotto di pazienti: una query per collection"""
+    names = ("schede_medicazione_med", "schede_impianto_picc", "schede_gestione_picc")
+    results = await asyncio.gather(*[
+        db[name].find(
+            {"patient_id": {"$in": patient_ids}, **export_period_filter(name, data_from, data_to)}, {"_id": 0}
+        ).to_list(None)
+        for name in names
+    ])
+    schede = {pid: ([], [], []) for pid in patient_ids}
+    for position, docs in enumerate(results):
+        for doc in docs:
+            schede[doc["patient_id"]][position].append(doc)
+    return schede
+
+def export_part_id(job_id: str, patient_id: str) -> str:
+    return f"{job_id}/parts/{patient_id}.pdf"
+
+def export_member_name(patient: dict) -> str:
+    code = patient.get("codice_paziente") or patient["id"][:8]
+    return f"{code}_{patient_folder_filename(patient, None, 'pdf')}"
+
+async def stream_export_archive(job: dict, patients: List[dict]):
+    """Compone l'archivio finale dalle parti salvate, un PDF alla volta"""
+    params = job["params"]
+    sink = ZipChunkSink()
+    index = []
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for patient in patients:
+            name = export_member_name(patient)
+            stream = await artifact_bucket.open_download_stream(export_part_id(job["id"], patient["id"]))
+            with zf.open(name, "w") as member:
+                while True:
+                    chunk = await stream.readchunk()
+                    if not chunk:
+                        break
+                    member.write(chunk)
+                    yield sink.drain()
+            index.append({
+                "file": name,
+                "codice_paziente": patient.get("codice_paziente"),
+                "cognome": patient.get("cognome"),
+                "nome": patient.get("nome"),
+                "tipo": patient.get("tipo"),
+                "status": patient.get("status"),
+            })
+        zf.writestr("indice.json", json.dumps({
+            "ambulatorio": job["ambulatorio"],
+            "data_from": params.get("data_from"),
+            "data_to": params.get("data_to"),
+            "status": params.get("status"),
+            "generato_il": datetime.now(timezone.utc).isoformat(),
+            "pazienti": index,
+        }, indent=2, ensure_ascii=False, default=str))
+    yield sink.drain()
+    
+    # Archivio completo: le parti non servono più
+    for patient in patients:
+        try:
+            await artifact_bucket.delete(export_part_id(job["id"], patient["id"]))
+        except Exception:
+            pass
+
+async def render_ambulatorio_folders_job(job: dict) -> tuple:
+    """Archivio ZIP con la cartella PDF di ogni paziente dell'ambulatorio (ed eventuale periodo)"""
+    params = job["params"]
+    data_from, data_to = params.get("data_from"), params.get("data_to")
+    patients = await select_export_patients(job["ambulatorio"], params.get("status"), data_from, data_to)
     
-    # Fetch all related data - NO photos (allegati si scaricano separatamente)
-    schede_med = await db.schede_medicazione_med.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-    schede_impianto = await db.schede_impianto_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
-    schede_gestione = await db.schede_gestione_picc.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+    # Ripresa: le parti già salvate da un'esecuzione precedente non vengono rigenerate
+    stored = await db["render_artifacts.files"].find(
+        {"metadata.job_id": job["id"], "metadata.part": True}, {"_id": 1}
+    ).to_list(None)
+    stored = {f["_id"] for f in stored}
+    pending = [p for p in patients if export_part_id(job["id"], p["id"]) not in stored]
+    total = len(patients)
+    done = total - len(pending)
+    await update_job_progress(job["id"], done, total)
+    
+    # Al più RENDER_WORKERS rendering in corso per job: un intero lotto in coda nel
+    # pool farebbe attendere i download interattivi
+    slots = asyncio.Semaphore(RENDER_WORKERS)
+    # Con un periodo le schede sono filtrate: nome di cache distinto dalla cartella completa
+    cache_name = f"pdf_all_{data_from}_{data_to}" if data_from and data_to else None
+    async def export_part(patient: dict, patient_schede: tuple) -> None:
+        async with slots:
+            pdf_data = await render_patient_folder_pdf(patient, "all", patient_schede, background=True, name=cache_name)
+        part_id = export_part_id(job["id"], patient["id"])
+        await discard_artifact(part_id)
+        try:
+            await artifact_bucket.upload_from_stream_with_id(
+                part_id, export_member_name(patient), pdf_data,
+                metadata={"mime_type": "application/pdf", "job_id": job["id"], "part": True}
+            )
+        except FileExists:
+            pass  # parte già salvata
+    
+    failed = []
+    for start in range(0, len(pending), EXPORT_BATCH_SIZE):
+        batch = pending[start:start + EXPORT_BATCH_SIZE]
+        schede = await load_schede_for_patients([p["id"] for p in batch], data_from, data_to)
+        results = await asyncio.gather(*[export_part(p, schede[p["id"]]) for p in batch], return_exceptions=True)
+        for patient, result in zip(batch, results):
+            if isinstance(result, Exception):
+                detail = result.detail if isinstance(result, HTTPException) else (str(result) or result.__class__.__name__)
+                logger.error(f"Job {job['id']}: cartella di {patient['id']} non generata: {detail}")
+                failed.append(patient)
+            else:
+                done += 1
+        await update_job_progress(job["id"], done, total)
     
-    zip_data = generate_patient_zip(patient, schede_med, schede_impianto, schede_gestione, [])
+    if failed:
+        # Le parti salvate restano: ripetendo il job si generano solo quelle mancanti
+        raise ValueError(f"{len(failed)} cartelle su {total} non generate, ripetere il job per completare l'esportazione")
     
-    filename = f"cartella_{patient.get('cognome', 'paziente')}_{patient.get('nome', '')}.zip"
+    period_tag = f"{data_from}_{data_to}" if data_from and data_to else datetime.now(timezone.utc).strftime("%Y%m%d")
+    return stream_export_archive(job, patients), f"cartelle_{job['ambulatorio']}_{period_tag}.zip", "application/zip"
+
+JOB_RENDERERS = {
+    JobKind.PATIENT_PDF.value: render_patient_pdf_job,
+    JobKind.PATIENT_ZIP.value: render_patient_zip_job,
+    JobKind.SCHEDA_IMPIANTO_PDF.value: render_scheda_impianto_job,
+    JobKind.AMBULATORIO_FOLDERS.value: render_ambulatorio_folders_job,
+}
+
+async def job_heartbeat(job_id: str, runner: str) -> None:
+    """Segnala che il job è ancora in esecuzione in questo processo"""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        try:
+            await db.render_jobs.update_one(
+                {"id": job_id, "runner": runner, "status": JobStatus.RUNNING.value},
+                {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+            )
+        except Exception as e:
+            logger.warning(f"Heartbeat del job {job_id} non riuscito: {e}")
+
+async def execute_job_renderer(job: dict) -> tuple:
+    data, filename, media_type = await JOB_RENDERERS[job["kind"]](job)
+    artifact_id, size = await store_artifact(job["id"], filename, data, media_type)
+    return artifact_id, filename, media_type, size
+
+async def run_render_job(job_id: str) -> None:
+    """Esegue un job in coda; la transizione queued -> running è atomica, così un
+    job viene preso da un solo processo anche con più repliche dell'API.
+    Gli aggiornamenti successivi valgono solo per l'esecuzione corrente (runner):
+    se nel frattempo il job è stato ripreso altrove non vengono applicati."""
+    now = datetime.now(timezone.utc).isoformat()
+    runner = str(uuid.uuid4())
+    job = await db.render_jobs.find_one_and_update(
+        {"id": job_id, "status": JobStatus.QUEUED.value},
+        {
+            "$set": {"status": JobStatus.RUNNING.value, "runner": runner, "started_at": now, "updated_at": now},
+            "$inc": {"attempts": 1},
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not job:
+        return
     
-    return StreamingResponse(
-        io.BytesIO(zip_data),
-        media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    heartbeat = asyncio.create_task(job_heartbeat(job_id, runner))
+    try:
+        try:
+            artifact_id, filename, media_type, size = await asyncio.wait_for(execute_job_renderer(job), JOB_MAX_RUNTIME)
+        except asyncio.TimeoutError:
+            raise ValueError(f"Tempo massimo di esecuzione superato ({JOB_MAX_RUNTIME / 60:.0f} minuti)")
+        now = datetime.now(timezone.utc)
+        await db.render_jobs.update_one({"id": job_id, "runner": runner}, {"$set": {
+            "status": JobStatus.DONE.value,
+            "artifact_id": artifact_id,
+            "filename": filename,
+            "media_type": media_type,
+            "size": size,
+            "finished_at": now.isoformat(),
+            "updated_at": now.isoformat(),
+            "expires_at": (now + JOB_ARTIFACT_TTL).isoformat(),
+        }})
+    except Exception as e:
+        logger.error(f"Job {job_id} ({job['kind']}) non riuscito: {e}")
+        await fail_render_job(
+            {"id": job_id, "runner": runner},
+            e.detail if isinstance(e, HTTPException) else (str(e) or e.__class__.__name__)
+        )
+    finally:
+        heartbeat.cancel()
+
+async def fail_render_job(query: dict, error: str) -> bool:
+    """Porta in errore il job; il risultato parziale scade dopo JOB_ARTIFACT_TTL"""
+    now = datetime.now(timezone.utc)
+    result = await db.render_jobs.update_one(query, {"$set": {
+        "status": JobStatus.ERROR.value,
+        "error": error,
+        "finished_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+        "expires_at": (now + JOB_ARTIFACT_TTL).isoformat(),
+    }})
+    return result.modified_count > 0
+
+def schedule_render_job(job_id: str) -> None:
+    task = asyncio.create_task(run_render_job(job_id))
+    # Riferimento forte finché il task è in corso
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+
+async def resume_render_jobs(all_queued: bool = False) -> int:
+    """Riprende i job abbandonati: in esecuzione senza heartbeat (processo terminato)
+    o in coda senza che nessun processo li abbia presi. Con all_queued (all'avvio)
+    avvia anche i job in coda recenti. Restituisce il numero di job avviati."""
+    stale = (datetime.now(timezone.utc) - JOB_STALE_AFTER).isoformat()
+    abandoned = await db.render_jobs.find(
+        {"status": JobStatus.RUNNING.value, "updated_at": {"$lt": stale}},
+        {"_id": 0, "id": 1, "updated_at": 1, "attempts": 1}
+    ).to_list(None)
+    requeued = []
+    for job in abandoned:
+        # Condizione su updated_at: se il job ha ripreso l'heartbeat non lo si tocca
+        query = {"id": job["id"], "status": JobStatus.RUNNING.value, "updated_at": job["updated_at"]}
+        if (job.get("attempts") or 0) >= JOB_MAX_ATTEMPTS:
+            if await fail_render_job(query, "Job interrotto troppe volte"):
+                logger.error(f"Job {job['id']} abbandonato dopo {job.get('attempts')} tentativi")
+            continue
+        result = await db.render_jobs.update_one(query, {"$set": {
+            "status": JobStatus.QUEUED.value, "updated_at": datetime.now(timezone.utc).isoformat()
+        }})
+        if result.modified_count:
+            requeued.append(job["id"])
+    
+    query = {"status": JobStatus.QUEUED.value}
+    if not all_queued:
+        query["updated_at"] = {"$lt": stale}
+    queued = await db.render_jobs.find(query, {"_id": 0, "id": 1}).to_list(None)
+    ids = list(dict.fromkeys([job["id"] for job in queued] + requeued))
+    for job_id in ids:
+        # La transizione atomica queued -> running evita doppie esecuzioni
+        schedule_render_job(job_id)
+    return len(ids)
+
+async def cleanup_expired_jobs() -> int:
+    """Elimina i job scaduti e i relativi artefatti"""
+    now = datetime.now(timezone.utc).isoformat()
+    expired = await db.render_jobs.find({"expires_at": {"$lt": now}}, {"_id": 0, "id": 1}).to_list(None)
+    for job in expired:
+        await delete_job_artifacts(job["id"])
+    if expired:
+        await db.render_jobs.delete_many({"id": {"$in": [job["id"] for job in expired]}})
+    return len(expired)
+
+async def cleanup_expired_jobs_loop() -> None:
+    """Manutenzione periodica dei job: ripresa di quelli abbandonati e pulizia dei
+    job scaduti. Il primo giro (all'avvio) avvia anche i job rimasti in coda."""
+    startup = True
+    while True:
+        try:
+            resumed = await resume_render_jobs(all_queued=startup)
+            if resumed:
+                logger.info(f"{resumed} job di rendering rimessi in coda")
+            await cleanup_expired_jobs()
+            startup = False
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Manutenzione dei job di rendering non riuscita: {e}")
+        await asyncio.sleep(JOB_MAINTENANCE_INTERVAL)
+
+@api_router.post("/jobs", status_code=202)
+async def create_render_job(data: RenderJobCreate, payload: dict = Depends(verify_token)):
+    """Avvia la generazione in background di un PDF o ZIP e restituisce il job"""
+    params = {}
+    if data.kind in (JobKind.PATIENT_PDF, JobKind.PATIENT_ZIP):
+        if not data.patient_id:
+            raise HTTPException(status_code=400, detail="patient_id obbligatorio")
+        if data.section not in PATIENT_FOLDER_SECTIONS:
+            raise HTTPException(status_code=400, detail="Sezione non valida")
+        patient = await get_accessible_patient(data.patient_id, payload)
+        ambulatorio = patient["ambulatorio"]
+        params = {"patient_id": data.patient_id, "section": data.section, "include_attachments": data.include_attachments}
+    elif data.kind == JobKind.SCHEDA_IMPIANTO_PDF:
+        scheda = await db.schede_impianto_picc.find_one({"id": data.scheda_id}, {"_id": 0, "ambulatorio": 1})
+        if not scheda:
+            raise HTTPException(status_code=404, detail="Scheda non trovata")
+        ambulatorio = scheda["ambulatorio"]
+        params = {"scheda_id": data.scheda_id}
+    else:
+        if not data.ambulatorio:
+            raise HTTPException(status_code=400, detail="ambulatorio obbligatorio")
+        ambulatorio = data.ambulatorio.value
+        if bool(data.data_from) != bool(data.data_to):
+            raise HTTPException(status_code=400, detail="Indicare sia data_from sia data_to")
+        try:
+            if data.data_from and datetime.strptime(data.data_from, "%Y-%m-%d") > datetime.strptime(data.data_to, "%Y-%m-%d"):
+                raise HTTPException(status_code=400, detail="Periodo non valido")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Date non valide (formato YYYY-MM-DD)")
+        params = {
+            "status": data.status.value if data.status else None,
+            "data_from": data.data_from,
+            "data_to": data.data_to,
+        }
+    if ambulatorio not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        "id": str(uuid.uuid4()),
+        "kind": data.kind.value,
+        "status": JobStatus.QUEUED.value,
+        "ambulatorio": ambulatorio,
+        "user_id": payload.get("sub", ""),
+        "params": params,
+        "progress": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    await db.render_jobs.insert_one(job)
+    schedule_render_job(job["id"])
+    return job_view(job)
+
+@api_router.get("/jobs")
+async def list_render_jobs(
+    response: Response,
+    ambulatorio: Ambulatorio,
+    page: PageParams = Depends(),
+    payload: dict = Depends(verify_token)
+):
+    """Job dell'utente per un ambulatorio, dal più recente"""
+    if ambulatorio.value not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    query = {"ambulatorio": ambulatorio.value, "user_id": payload.get("sub", "")}
+    result = await fetch_page(db.render_jobs, query, [("created_at", -1), ("id", -1)], page, default_limit=50)
+    return page_response({**result, "items": [job_view(j) for j in result["items"]]}, page, response)
+
+@api_router.post("/jobs/{job_id}/retry", status_code=202)
+async def retry_render_job(job_id: str, payload: dict = Depends(verify_token)):
+    """Rimette in coda un job non riuscito; un'esportazione riparte dalle parti già salvate"""
+    await get_accessible_job(job_id, payload)
+    job = await db.render_jobs.find_one_and_update(
+        {"id": job_id, "status": JobStatus.ERROR.value},
+        {
+            "$set": {"status": JobStatus.QUEUED.value, "error": None, "attempts": 0, "updated_at": datetime.now(timezone.utc).isoformat()},
+            "$unset": {"finished_at": "", "expires_at": ""},
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
+    if not job:
+        raise HTTPException(status_code=409, detail="Solo i job non riusciti possono essere ripetuti")
+    schedule_render_job(job_id)
+    return job_view(job)
+
+async def get_accessible_job(job_id: str, payload: dict) -> dict:
+    job = await db.render_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job non trovato o scaduto")
+    if job["ambulatorio"] not in payload["ambulatori"]:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    return job
 
+@api_router.get("/jobs/{job_id}")
+async def get_render_job(
+    job_id: str,
+    wait: int = Query(0, ge=0, le=JOB_MAX_WAIT),
+    payload: dict = Depends(verify_token)
+):
+    """Stato di un job; con wait=N attende fino a N secondi che termini (long polling)"""
+    job = await get_accessible_job(job_id, payload)
+    deadline = asyncio.get_running_loop().time() + wait
+    while job["status"] in (JobStatus.QUEUED.value, JobStatus.RUNNING.value) and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.5)
+        job = await get_accessible_job(job_id, payload)
+    return job_view(job)
+
+@api_router.get("/jobs/{job_id}/download")
+async def download_render_job(job_id: str, payload: dict = Depends(verify_token)):
+    """Scarica il risultato di un job completato"""
+    job = await get_accessible_job(job_id, payload)
+    if job["status"] != JobStatus.DONE.value:
+        raise HTTPException(status_code=409, detail="Il job non è ancora completato")
+    try:
+        stream = await artifact_bucket.open_download_stream(job["artifact_id"])
+    except Exception:
+        raise HTTPException(status_code=404, detail="Risultato non più disponibile")
+    
+    async def chunks():
+        while True:
+            chunk = await stream.readchunk()
+            if not chunk:
+                break
+            yield chunk
+    
+    return StreamingResponse(
+        chunks(),
+        media_type=job["media_type"],
+        headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(job['filename'])}",
+            "Content-Length": str(stream.length),
+        }
+    )
 
 # ============== ROOT ==============
 @api_router.get("/")
@@ -3086,16 +5831,27 @@ class Prescrizione(BaseModel):
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+PRESCRIZIONE_PROJECTION = {
+    "_id": 1, "id": 1, "patient_id": 1, "ambulatorio": 1, "data_inizio": 1,
+    "durata_mesi": 1, "created_at": 1, "updated_at": 1,
+}
+
 @api_router.get("/prescrizioni")
 async def get_prescrizioni(
+    response: Response,
     ambulatorio: Ambulatorio,
+    page: PageParams = Depends(),
     current_user: dict = Depends(get_current_user)
 ):
     """Get all prescriptions for an ambulatorio"""
-    cursor = db.prescrizioni.find({"ambulatorio": ambulatorio})
-    prescrizioni = await cursor.to_list(length=1000)
+    # _id come chiave univoca: i documenti legacy possono non avere id, e nulla
+    # impedisce due prescrizioni per lo stesso paziente
+    page_data = await fetch_page(
+        db.prescrizioni, {"ambulatorio": ambulatorio.value},
+        [("patient_id", 1), ("_id", 1)], page, PRESCRIZIONE_PROJECTION
+    )
     result = []
-    for p in prescrizioni:
+    for p in page_data["items"]:
         item = {
             "id": p.get("id", str(p.get("_id", ""))),
             "patient_id": p.get("patient_id"),
@@ -3106,7 +5862,7 @@ async def get_prescrizioni(
             "updated_at": p.get("updated_at")
         }
         result.append(item)
-    return result
+    return page_response({**page_data, "items": result}, page, response)
 
 @api_router.post("/prescrizioni")
 async def create_or_update_prescrizione(
@@ -3161,7 +5917,6 @@ async def delete_prescrizione(
 
 # ============== AI ASSISTANT ==============
 from emergentintegrations.llm.chat import LlmChat, UserMessage
-import json
 import re
 
 # AI Chat history storage in MongoDB
@@ -3236,6 +5991,8 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
             # Annulla creazione = elimina paziente
             patient_id = undo_data.get("patient_id")
             await db.patients.delete_one({"id": patient_id})
+            invalidate_patient_directory(ambulatorio)
+            await invalidate_render_cache([patient_id])
             return {"success": True, "message": f"↩️ Annullato: Paziente eliminato"}
         
         elif action_type == "delete_patient":
@@ -3248,7 +6005,8 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
             prescrizioni = undo_data.get("prescrizioni", [])
             
             if patient_data:
-                await db.patients.insert_one(patient_data)
+                await db.patients.insert_one(with_search_fields(patient_data))
+                invalidate_patient_directory(ambulatorio)
             for apt in appointments:
                 await db.appointments.insert_one(apt)
             for s in schede_impianto:
@@ -3260,6 +6018,12 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
             for p in prescrizioni:
                 await db.prescrizioni.insert_one(p)
             
+            await refresh_slot_occupancy(ambulatorio, [apt.get("data") for apt in appointments])
+            await refresh_statistics_rollup(
+                ambulatorio,
+                [apt.get("data") for apt in appointments] + [s.get("data_impianto") for s in schede_impianto]
+            )
+            
             nome = f"{patient_data.get('cognome', '')} {patient_data.get('nome', '')}"
             return {"success": True, "message": f"↩️ Annullato: Paziente **{nome}** ripristinato con tutti i dati"}
         
@@ -3274,6 +6038,7 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
                 update_data["data_dimissione"] = previous_data["data_dimissione"]
             
             await db.patients.update_one({"id": patient_id}, {"$set": update_data})
+            invalidate_patient_directory(ambulatorio)
             
             patient = await db.patients.find_one({"id": patient_id})
             nome = f"{patient.get('cognome', '')} {patient.get('nome', '')}" if patient else "Paziente"
@@ -3282,7 +6047,11 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
         elif action_type == "create_appointment":
             # Annulla creazione appuntamento = elimina
             appointment_id = undo_data.get("appointment_id")
+            appointment = await db.appointments.find_one({"id": appointment_id}, {"_id": 0, "data": 1, "ora": 1, "tipo": 1})
             await db.appointments.delete_one({"id": appointment_id})
+            if appointment:
+                await release_slot(ambulatorio, appointment.get("data"), appointment.get("ora"), appointment.get("tipo"))
+                await refresh_statistics_rollup(ambulatorio, [appointment.get("data")])
             return {"success": True, "message": f"↩️ Annullato: Appuntamento eliminato"}
         
         elif action_type == "delete_appointment":
@@ -3290,12 +6059,17 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
             appointment_data = undo_data.get("appointment_data")
             if appointment_data:
                 await db.appointments.insert_one(appointment_data)
+                await refresh_slot_occupancy(ambulatorio, [appointment_data.get("data")])
+                await refresh_statistics_rollup(ambulatorio, [appointment_data.get("data")])
             return {"success": True, "message": f"↩️ Annullato: Appuntamento ripristinato"}
         
         elif action_type == "create_scheda_impianto":
             # Annulla creazione scheda = elimina
             scheda_id = undo_data.get("scheda_id")
+            scheda = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0, "data_impianto": 1})
             await db.schede_impianto_picc.delete_one({"id": scheda_id})
+            if scheda:
+                await refresh_statistics_rollup(ambulatorio, [scheda.get("data_impianto")])
             return {"success": True, "message": f"↩️ Annullato: Scheda impianto eliminata"}
         
         elif action_type == "copy_scheda_med":
@@ -3319,6 +6093,8 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
             patient_ids = undo_data.get("patient_ids", [])
             for pid in patient_ids:
                 await db.patients.delete_one({"id": pid})
+                invalidate_patient_directory(ambulatorio)
+            await invalidate_render_cache(patient_ids)
             return {"success": True, "message": f"↩️ Annullato: {len(patient_ids)} pazienti eliminati"}
         
         elif action_type == "suspend_multiple_patients":
@@ -3329,6 +6105,7 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
                     {"id": pd["patient_id"]},
                     {"$set": {"status": pd["previous_status"], "updated_at": datetime.now(timezone.utc).isoformat()}}
                 )
+                invalidate_patient_directory(ambulatorio)
             return {"success": True, "message": f"↩️ Annullato: {len(patients_data)} pazienti ripristinati allo stato precedente"}
         
         elif action_type == "resume_multiple_patients":
@@ -3339,6 +6116,7 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
                     {"id": pd["patient_id"]},
                     {"$set": {"status": pd["previous_status"], "updated_at": datetime.now(timezone.utc).isoformat()}}
                 )
+                invalidate_patient_directory(ambulatorio)
             return {"success": True, "message": f"↩️ Annullato: {len(patients_data)} pazienti ripristinati allo stato precedente"}
         
         elif action_type == "discharge_multiple_patients":
@@ -3349,16 +6127,19 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
                 if "data_dimissione" in pd.get("previous_data", {}):
                     update_data["data_dimissione"] = pd["previous_data"]["data_dimissione"]
                 await db.patients.update_one({"id": pd["patient_id"]}, {"$set": update_data})
+                invalidate_patient_directory(ambulatorio)
             return {"success": True, "message": f"↩️ Annullato: {len(patients_data)} pazienti ripristinati allo stato precedente"}
         
         elif action_type == "delete_multiple_patients":
             # Annulla eliminazione multipla = ricrea tutti i pazienti con i loro dati
             all_backup_data = undo_data.get("all_backup_data", [])
             restored_count = 0
+            statistics_dates = []
             for backup in all_backup_data:
                 patient_data = backup.get("patient_data")
                 if patient_data:
-                    await db.patients.insert_one(patient_data)
+                    await db.patients.insert_one(with_search_fields(patient_data))
+                    invalidate_patient_directory(ambulatorio)
                     restored_count += 1
                 for apt in backup.get("appointments", []):
                     await db.appointments.insert_one(apt)
@@ -3370,6 +6151,10 @@ async def execute_undo(action: dict, ambulatorio: str) -> dict:
                     await db.schede_medicazione_med.insert_one(s)
                 for p in backup.get("prescrizioni", []):
                     await db.prescrizioni.insert_one(p)
+                statistics_dates += [apt.get("data") for apt in backup.get("appointments", [])]
+                statistics_dates += [s.get("data_impianto") for s in backup.get("schede_impianto", [])]
+            await refresh_slot_occupancy(ambulatorio, statistics_dates)
+            await refresh_statistics_rollup(ambulatorio, statistics_dates)
             return {"success": True, "message": f"↩️ Annullato: {restored_count} pazienti ripristinati con tutti i loro dati"}
         
         return {"success": False, "message": "❌ Tipo di azione non supportato per l'annullamento"}
@@ -3556,80 +6341,22 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
     # Helper per trovare paziente
     async def find_patient(patient_name: str):
         """
-        Ricerca paziente migliorata con matching più preciso.
-        Priorità: match esatto cognome > match esatto nome > match parziale
+        Ricerca paziente con ranking: match esatto cognome nome > prefisso del nome
+        completo > parole esatte > prefissi di parola.
+        Il paziente trovato può essere modificato o eliminato dall'azione: i match
+        solo fuzzy (errori di battitura) e quelli ambigui, con un secondo paziente
+        allo stesso rank, non vengono accettati e restituiscono None.
         """
-        name_lower = patient_name.lower().strip()
-        parts = [p.strip() for p in name_lower.split() if len(p.strip()) > 1]
-        
-        if not parts:
+        results = await search_patients({"ambulatorio": ambulatorio}, patient_name, limit=2)
+        if not results:
             return None
-        
-        projection = {"_id": 0}  # Escludi sempre _id
-        
-        # 1. Prima prova match esatto su cognome (primo termine)
-        if len(parts) >= 1:
-            # Prova il primo termine come cognome esatto
-            exact_match = await db.patients.find_one({
-                "ambulatorio": ambulatorio,
-                "cognome": {"$regex": f"^{parts[0]}$", "$options": "i"}
-            }, projection)
-            if exact_match:
-                # Se c'è un secondo termine, verifica che corrisponda al nome
-                if len(parts) >= 2:
-                    nome_lower = exact_match.get("nome", "").lower()
-                    if parts[1] in nome_lower or nome_lower.startswith(parts[1]):
-                        return exact_match
-                else:
-                    return exact_match
-        
-        # 2. Prova match esatto cognome + nome insieme
-        if len(parts) >= 2:
-            # Cognome esatto + nome che inizia con
-            exact_match = await db.patients.find_one({
-                "ambulatorio": ambulatorio,
-                "cognome": {"$regex": f"^{parts[0]}$", "$options": "i"},
-                "nome": {"$regex": f"^{parts[1]}", "$options": "i"}
-            }, projection)
-            if exact_match:
-                return exact_match
-            
-            # Prova invertito (nome cognome invece di cognome nome)
-            exact_match = await db.patients.find_one({
-                "ambulatorio": ambulatorio,
-                "cognome": {"$regex": f"^{parts[1]}$", "$options": "i"},
-                "nome": {"$regex": f"^{parts[0]}", "$options": "i"}
-            }, projection)
-            if exact_match:
-                return exact_match
-        
-        # 3. Match parziale su cognome (per abbreviazioni)
-        partial_match = await db.patients.find_one({
-            "ambulatorio": ambulatorio,
-            "cognome": {"$regex": f"^{parts[0]}", "$options": "i"}
-        }, projection)
-        if partial_match:
-            return partial_match
-        
-        # 4. Ultima risorsa: cerca in tutti i campi ma con AND invece di OR
-        # Tutti i termini devono essere presenti nel cognome+nome combinato
-        pipeline = [
-            {"$match": {"ambulatorio": ambulatorio}},
-            {"$addFields": {
-                "full_name": {"$concat": [{"$toLower": "$cognome"}, " ", {"$toLower": "$nome"}]}
-            }},
-            {"$match": {
-                "$and": [{"full_name": {"$regex": part, "$options": "i"}} for part in parts]
-            }},
-            {"$project": {"_id": 0, "full_name": 0}},  # Escludi _id e campo temporaneo
-            {"$limit": 1}
-        ]
-        
-        results = await db.patients.aggregate(pipeline).to_list(1)
-        if results:
-            return results[0]
-        
-        return None
+        query = normalize_search_text(patient_name)
+        best_rank = rank_patient_match(results[0], query)[0]
+        if best_rank > PATIENT_SEARCH_MAX_EXACT_RANK:
+            return None
+        if len(results) > 1 and rank_patient_match(results[1], query)[0] == best_rank:
+            return None
+        return results[0]
     
     # Helper per trovare primo slot disponibile
     async def find_available_slot(data: str, tipo: str, turno: str = "primo_disponibile"):
@@ -3643,14 +6370,18 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
         else:
             slots = slots_mattina + slots_pomeriggio
         
+        counts = {
+            r["_id"]: r["count"]
+            for r in await db.appointments.aggregate([
+                {"$match": {"ambulatorio": ambulatorio, "data": data, "tipo": tipo}},
+                {"$group": {"_id": "$ora", "count": {"$sum": 1}}}
+            ]).to_list(None)
+        }
+        closures = await db.closed_slots.find(
+            {"ambulatorio": ambulatorio, "data": data}, {"_id": 0, "ora": 1, "tipo": 1}
+        ).to_list(None)
         for slot in slots:
-            count = await db.appointments.count_documents({
-                "ambulatorio": ambulatorio,
-                "data": data,
-                "ora": slot,
-                "tipo": tipo
-            })
-            if count < 2:
+            if counts.get(slot, 0) < SLOT_CAPACITY and not slot_is_closed(closures, slot, tipo):
                 return slot
         return None
     
@@ -3714,7 +6445,8 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 "created_at": datetime.now(timezone.utc).isoformat(),
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
-            await db.patients.insert_one(patient_data)
+            await db.patients.insert_one(with_search_fields(patient_data))
+            invalidate_patient_directory(ambulatorio)
             
             # Salva per undo
             await save_undo_action(
@@ -3731,8 +6463,11 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
         elif action_type == "search_patient":
             query = params.get("query", "").strip()
             
-            # Prova prima con find_patient che ha logica migliorata
-            patient = await find_patient(query)
+            # Risultati ordinati per pertinenza: un match esatto vale come risultato unico
+            patients = await search_patients({"ambulatorio": ambulatorio}, query, limit=10)
+            patient = patients[0] if patients else None
+            if patient and len(patients) > 1 and rank_patient_match(patient, normalize_search_text(query))[0] > 1:
+                patient = None
             if patient:
                 patient_info = {"id": patient["id"], "cognome": patient.get("cognome", ""), "nome": patient.get("nome", ""), "tipo": patient.get("tipo", "")}
                 return {"success": True, "patients": [patient], 
@@ -3740,24 +6475,6 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                         "action_type": "search_patient",
                         "message": f"🔍 Trovato: **{patient['cognome']} {patient['nome']}** ({patient['tipo']})\n\n💡 Cosa vuoi fare con questo paziente?"}
             
-            # Se non trova esatto, cerca parziale
-            query_lower = query.lower()
-            parts = [p.strip() for p in query_lower.split() if len(p.strip()) > 1]
-            
-            # Costruisci query che cerca tutte le parti
-            if parts:
-                or_conditions = []
-                for part in parts:
-                    or_conditions.append({"nome": {"$regex": part, "$options": "i"}})
-                    or_conditions.append({"cognome": {"$regex": part, "$options": "i"}})
-                
-                patients = await db.patients.find({
-                    "ambulatorio": ambulatorio,
-                    "$or": or_conditions
-                }, {"_id": 0}).to_list(10)
-            else:
-                patients = []
-            
             if patients:
                 names = [f"• {p['cognome']} {p['nome']} ({p['tipo']})" for p in patients]
                 if len(patients) == 1:
@@ -3794,20 +6511,19 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 if not ora:
                     turno_msg = f" del {turno}" if turno else ""
                     return {"success": False, "message": f"❌ Nessun orario disponibile{turno_msg} per il {data}. Vuoi provare un altro giorno?"}
-            else:
-                # L'utente ha specificato un orario - verifica disponibilità
-                existing = await db.appointments.count_documents({
-                    "ambulatorio": ambulatorio,
-                    "data": data,
-                    "ora": ora,
-                    "tipo": tipo
-                })
-                
-                if existing >= 2:
-                    # Slot pieno - chiedi all'utente cosa fare
-                    return {"success": False, 
-                            "message": f"⚠️ Orario **{ora}** già occupato (2 pazienti).\n\nVuoi scegliere un altro orario?",
+            
+            # Occupa il posto nello slot (verifica atomica di capienza e chiusura)
+            try:
+                reservation = await reserve_slot(ambulatorio, data, ora, tipo)
+            except HTTPException as e:
+                if e.detail == "Slot chiuso":
+                    return {"success": False,
+                            "message": f"⚠️ Orario **{ora}** chiuso il {data}.\n\nVuoi scegliere un altro orario?",
                             "suggested_data": data}
+                # Slot pieno - chiedi all'utente cosa fare
+                return {"success": False, 
+                        "message": f"⚠️ Orario **{ora}** già occupato ({SLOT_CAPACITY} pazienti).\n\nVuoi scegliere un altro orario?",
+                        "suggested_data": data}
             
             # Crea appuntamento
             prestazioni = params.get("prestazioni", [])
@@ -3830,7 +6546,13 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 "stato": "da_fare",
                 "created_at": datetime.now(timezone.utc).isoformat()
             }
-            await db.appointments.insert_one(appointment)
+            try:
+                await db.appointments.insert_one(appointment)
+            except Exception:
+                await cancel_slot(ambulatorio, data, ora, tipo, reservation)
+                raise
+            await confirm_slot(ambulatorio, data, ora, tipo, reservation)
+            await refresh_statistics_rollup(ambulatorio, [appointment["data"]])
             
             # Salva per undo
             await save_undo_action(
@@ -3882,6 +6604,8 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
             
             # Elimina
             await db.appointments.delete_one({"id": appointment["id"]})
+            await release_slot(ambulatorio, appointment.get("data"), appointment.get("ora"), appointment.get("tipo"))
+            await refresh_statistics_rollup(ambulatorio, [appointment.get("data")])
             return {"success": True, 
                     "message": f"✅ Appuntamento eliminato!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📅 {data} alle {appointment.get('ora', 'N/A')}\n\n💡 Puoi annullare dicendo 'annulla'",
                     "can_undo": True}
@@ -3891,18 +6615,12 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
             tipo = params.get("tipo", "tutti")
             stato = params.get("stato", "tutti")
             
-            query = {"ambulatorio": ambulatorio}
-            
-            # Filtra per tipo
-            if tipo and tipo != "tutti":
-                query["tipo"] = tipo
-            
-            # Filtra per stato
-            if stato and stato != "tutti":
-                query["status"] = stato
-            
-            # Conta pazienti
-            patients = await db.patients.find(query, {"_id": 0, "id": 1, "tipo": 1, "status": 1}).to_list(10000)
+            # Conta pazienti (dalla directory in memoria), filtrando per tipo e stato
+            patients = [
+                p for p in await get_patient_directory(ambulatorio)
+                if (not tipo or tipo == "tutti" or p.get("tipo") == tipo)
+                and (not stato or stato == "tutti" or p.get("status") == stato)
+            ]
             total = len(patients)
             
             # Conta per tipo
@@ -3957,31 +6675,15 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
             mese = params.get("mese")
             generate_pdf = params.get("generate_pdf", False)
             
-            # Build date range
-            if mese:
-                start_date = f"{anno}-{mese:02d}-01"
-                end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
-                periodo = f"{MESI[mese]} {anno}"
-            else:
-                start_date = f"{anno}-01-01"
-                end_date = f"{anno + 1}-01-01"
-                periodo = f"anno {anno}"
-            
-            query = {
-                "ambulatorio": ambulatorio,
-                "data_impianto": {"$gte": start_date, "$lt": end_date}
-            }
+            start_date, end_date = statistics_date_range(anno, mese)
+            periodo = f"{MESI[mese]} {anno}" if mese else f"anno {anno}"
             
+            # Conta per tipo dal rollup giornaliero
+            docs = await load_statistics_rollup(ambulatorio, start_date, end_date, IMPIANTI_ROLLUP_TIPO)
+            tipo_counts, _ = summarize_counter_rollup(docs, "impianti")
             if tipo_impianto and tipo_impianto != "tutti":
-                query["tipo_catetere"] = tipo_impianto
-            
-            schede = await db.schede_impianto_picc.find(query, {"_id": 0}).to_list(10000)
-            
-            # Conta per tipo
-            tipo_counts = {}
-            for s in schede:
-                t = s.get("tipo_catetere", "non_specificato")
-                tipo_counts[t] = tipo_counts.get(t, 0) + 1
+                tipo_counts = {t: c for t, c in tipo_counts.items() if t == tipo_impianto}
+            totale_impianti = sum(tipo_counts.values())
             
             tipo_labels = {
                 "picc": "PICC",
@@ -3997,7 +6699,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 msg += f"🔹 **{label}**: {count} impianti\n"
             else:
                 msg = f"📊 **Statistiche Impianti - {periodo}**\n\n"
-                msg += f"📈 Totale: **{len(schede)}** impianti\n\n"
+                msg += f"📈 Totale: **{totale_impianti}** impianti\n\n"
                 for t, c in tipo_counts.items():
                     label = tipo_labels.get(t, t)
                     msg += f"🔹 {label}: {c}\n"
@@ -4007,7 +6709,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
             else:
                 msg += "\n\nVuoi che generi il report PDF?"
             
-            result = {"success": True, "totale": len(schede), "per_tipo": tipo_counts, 
+            result = {"success": True, "totale": totale_impianti, "per_tipo": tipo_counts, 
                     "periodo": periodo, "message": msg, "offer_pdf": True}
             
             if generate_pdf:
@@ -4023,26 +6725,13 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
             mese = params.get("mese")
             generate_pdf = params.get("generate_pdf", False)
             
-            if mese:
-                start_date = f"{anno}-{mese:02d}-01"
-                end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
-                periodo = f"{MESI[mese]} {anno}"
-            else:
-                start_date = f"{anno}-01-01"
-                end_date = f"{anno + 1}-01-01"
-                periodo = f"anno {anno}"
-            
-            query = {
-                "ambulatorio": ambulatorio,
-                "data": {"$gte": start_date, "$lt": end_date},
-                "stato": {"$ne": "non_presentato"}
-            }
-            if tipo and tipo != "tutti":
-                query["tipo"] = tipo
+            start_date, end_date = statistics_date_range(anno, mese)
+            periodo = f"{MESI[mese]} {anno}" if mese else f"anno {anno}"
             
-            appointments = await db.appointments.find(query).to_list(10000)
+            # Il rollup esclude già gli appuntamenti "non_presentato"
+            docs = await load_statistics_rollup(ambulatorio, start_date, end_date, tipo if tipo and tipo != "tutti" else None)
+            totale_accessi, pazienti_unici, prestazioni_count, _ = summarize_appointment_rollup(docs)
             
-            prestazioni_count = {}
             prestazioni_labels = {
                 "medicazione_semplice": "Medicazione semplice",
                 "irrigazione_catetere": "Irrigazione catetere",
@@ -4051,13 +6740,9 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 "catetere_vescicale": "Catetere vescicale"
             }
             
-            for app in appointments:
-                for prest in app.get("prestazioni", []):
-                    prestazioni_count[prest] = prestazioni_count.get(prest, 0) + 1
-            
             msg = f"📊 **Statistiche Prestazioni - {periodo}**\n\n"
-            msg += f"📈 Totale accessi: **{len(appointments)}**\n"
-            msg += f"👥 Pazienti unici: **{len(set(a['patient_id'] for a in appointments))}**\n\n"
+            msg += f"📈 Totale accessi: **{totale_accessi}**\n"
+            msg += f"👥 Pazienti unici: **{pazienti_unici}**\n\n"
             
             if prestazioni_count:
                 msg += "**Dettaglio prestazioni:**\n"
@@ -4072,7 +6757,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
             else:
                 msg += "\nVuoi che generi il report PDF?"
             
-            result = {"success": True, "totale_accessi": len(appointments),
+            result = {"success": True, "totale_accessi": totale_accessi,
                     "prestazioni": prestazioni_count, "periodo": periodo, 
                     "message": msg, "offer_pdf": True}
             
@@ -4212,6 +6897,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
             await db.schede_impianto_picc.insert_one(scheda)
+            await refresh_statistics_rollup(ambulatorio, [data_impianto])
             
             # Salva per undo
             await save_undo_action(
@@ -4262,6 +6948,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 {"id": patient["id"]},
                 {"$set": {"status": "sospeso", "updated_at": datetime.now(timezone.utc).isoformat()}}
             )
+            invalidate_patient_directory(ambulatorio)
             
             return {"success": True, 
                     "message": f"✅ Paziente sospeso!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: Sospeso\n\nIl paziente è stato temporaneamente sospeso.\n\n💡 Puoi annullare dicendo 'annulla'",
@@ -4291,6 +6978,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 {"id": patient["id"]},
                 {"$set": {"status": "in_cura", "updated_at": datetime.now(timezone.utc).isoformat()}}
             )
+            invalidate_patient_directory(ambulatorio)
             
             return {"success": True, 
                     "message": f"✅ Paziente ripreso in cura!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: In cura\n\nIl paziente è stato ripreso in cura.\n\n💡 Puoi annullare dicendo 'annulla'",
@@ -4321,6 +7009,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 {"id": patient["id"]},
                 {"$set": {"status": "dimesso", "data_dimissione": datetime.now().strftime("%Y-%m-%d"), "updated_at": datetime.now(timezone.utc).isoformat()}}
             )
+            invalidate_patient_directory(ambulatorio)
             
             return {"success": True, 
                     "message": f"✅ Paziente dimesso!\n\n👤 **{patient['cognome']} {patient['nome']}**\n📋 Stato: Dimesso\n📅 Data dimissione: {datetime.now().strftime('%d/%m/%Y')}\n\nIl paziente è stato dimesso.\n\n💡 Puoi annullare dicendo 'annulla'",
@@ -4366,6 +7055,14 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
             await db.schede_medicazione_med.delete_many({"patient_id": patient_id})
             await db.prescrizioni.delete_many({"patient_id": patient_id})
             await db.patients.delete_one({"id": patient_id})
+            invalidate_patient_directory(ambulatorio)
+            await invalidate_render_cache([patient_id])
+            
+            await refresh_slot_occupancy(ambulatorio, [apt.get("data") for apt in appointments])
+            await refresh_statistics_rollup(
+                ambulatorio,
+                [apt.get("data") for apt in appointments] + [s.get("data_impianto") for s in schede_impianto]
+            )
             
             return {"success": True, 
                     "message": f"✅ Paziente eliminato definitivamente!\n\n👤 **{nome_completo}**\n\n⚠️ Tutti i dati del paziente sono stati eliminati.\n\n💡 **IMPORTANTE**: Puoi ancora annullare questa azione dicendo 'annulla'!",
@@ -4384,41 +7081,26 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
             mese2 = periodo2.get("mese")
             
             async def get_stats_for_period(anno, mese, tipo):
-                if mese:
-                    start_date = f"{anno}-{mese:02d}-01"
-                    end_date = f"{anno}-{mese + 1:02d}-01" if mese < 12 else f"{anno + 1}-01-01"
-                else:
-                    start_date = f"{anno}-01-01"
-                    end_date = f"{anno + 1}-01-01"
+                start_date, end_date = statistics_date_range(anno, mese)
+                docs = await load_statistics_rollup(ambulatorio, start_date, end_date)
                 
-                query = {
-                    "ambulatorio": ambulatorio,
-                    "data": {"$gte": start_date, "$lt": end_date},
-                    "stato": {"$ne": "non_presentato"}
-                }
+                appointment_docs = docs
                 if tipo and tipo not in ["tutti", "IMPIANTI"]:
-                    query["tipo"] = tipo
-                
-                appointments = await db.appointments.find(query).to_list(10000)
-                
-                # Impianti
-                imp_query = {"ambulatorio": ambulatorio, "data_impianto": {"$gte": start_date, "$lt": end_date}}
-                impianti = await db.schede_impianto_picc.find(imp_query).to_list(10000)
-                
-                prestazioni_count = {}
-                for app in appointments:
-                    for prest in app.get("prestazioni", []):
-                        prestazioni_count[prest] = prestazioni_count.get(prest, 0) + 1
+                    appointment_docs = [d for d in docs if d.get("tipo") == tipo]
+                accessi, pazienti_unici, prestazioni_count, _ = summarize_appointment_rollup(appointment_docs)
+                impianti, _ = summarize_counter_rollup(docs, "impianti")
                 
                 return {
-                    "accessi": len(appointments),
-                    "pazienti_unici": len(set(a["patient_id"] for a in appointments)),
+                    "accessi": accessi,
+                    "pazienti_unici": pazienti_unici,
                     "prestazioni": prestazioni_count,
-                    "impianti": len(impianti)
+                    "impianti": sum(impianti.values())
                 }
             
-            stats1 = await get_stats_for_period(anno1, mese1, tipo)
-            stats2 = await get_stats_for_period(anno2, mese2, tipo)
+            stats1, stats2 = await asyncio.gather(
+                get_stats_for_period(anno1, mese1, tipo),
+                get_stats_for_period(anno2, mese2, tipo)
+            )
             
             periodo1_label = f"{MESI[mese1]} {anno1}" if mese1 else f"Anno {anno1}"
             periodo2_label = f"{MESI[mese2]} {anno2}" if mese2 else f"Anno {anno2}"
@@ -4510,7 +7192,8 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                         "created_at": datetime.now(timezone.utc).isoformat(),
                         "updated_at": datetime.now(timezone.utc).isoformat()
                     }
-                    await db.patients.insert_one(patient_data)
+                    await db.patients.insert_one(with_search_fields(patient_data))
+                    invalidate_patient_directory(ambulatorio)
                     created.append(f"{p.get('cognome', '')} {p.get('nome', '')} ({p.get('tipo', 'PICC')})")
                     patient_ids.append(patient_data["id"])
                 except Exception as e:
@@ -4565,6 +7248,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                     {"id": patient["id"]},
                     {"$set": {"status": "sospeso", "updated_at": datetime.now(timezone.utc).isoformat()}}
                 )
+                invalidate_patient_directory(ambulatorio)
                 suspended.append(f"{patient['cognome']} {patient['nome']}")
             
             if suspended:
@@ -4615,6 +7299,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                     {"id": patient["id"]},
                     {"$set": {"status": "in_cura", "updated_at": datetime.now(timezone.utc).isoformat()}}
                 )
+                invalidate_patient_directory(ambulatorio)
                 resumed.append(f"{patient['cognome']} {patient['nome']}")
             
             if resumed:
@@ -4666,6 +7351,7 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                     {"id": patient["id"]},
                     {"$set": {"status": "dimesso", "data_dimissione": datetime.now().strftime("%Y-%m-%d"), "updated_at": datetime.now(timezone.utc).isoformat()}}
                 )
+                invalidate_patient_directory(ambulatorio)
                 discharged.append(f"{patient['cognome']} {patient['nome']}")
             
             if discharged:
@@ -4732,6 +7418,14 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                 await db.schede_medicazione_med.delete_many({"patient_id": patient_id})
                 await db.prescrizioni.delete_many({"patient_id": patient_id})
                 await db.patients.delete_one({"id": patient_id})
+                invalidate_patient_directory(ambulatorio)
+                await invalidate_render_cache([patient_id])
+                
+                await refresh_slot_occupancy(ambulatorio, [apt.get("data") for apt in appointments])
+                await refresh_statistics_rollup(
+                    ambulatorio,
+                    [apt.get("data") for apt in appointments] + [s.get("data_impianto") for s in schede_impianto]
+                )
                 
                 deleted.append(nome_completo)
             
@@ -4779,7 +7473,8 @@ async def execute_ai_action(action: dict, ambulatorio: str, user_id: str) -> dic
                         "created_at": datetime.now(timezone.utc).isoformat(),
                         "updated_at": datetime.now(timezone.utc).isoformat()
                     }
-                    await db.patients.insert_one(patient_data)
+                    await db.patients.insert_one(with_search_fields(patient_data))
+                    invalidate_patient_directory(ambulatorio)
                     created.append(f"{p.get('cognome', '')} {p.get('nome', '')} ({p.get('tipo', tipo_default)})")
                     patient_ids.append(patient_data["id"])
                 except Exception as e:
@@ -5017,11 +7712,17 @@ Se non riesci a identificare nomi, restituisci: {"patients": [], "error": "Nessu
 
 @api_router.get("/ai/history")
 async def get_ai_history(
+    response: Response,
     ambulatorio: Ambulatorio,
     session_id: Optional[str] = None,
+    page: PageParams = Depends(),
     payload: dict = Depends(verify_token)
 ):
-    """Get chat history"""
+    """Get chat history.
+
+    La paginazione scorre i messaggi dal più recente: una sessione può quindi
+    comparire su più pagine, ognuna con i soli messaggi di quella pagina.
+    """
     if ambulatorio.value not in payload["ambulatori"]:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
@@ -5031,17 +7732,19 @@ async def get_ai_history(
     if session_id:
         query["session_id"] = session_id
     
-    messages = await db.ai_chat_history.find(query, {"_id": 0}).sort("timestamp", -1).to_list(100)
+    page_data = await fetch_page(
+        db.ai_chat_history, query, [("timestamp", -1), ("id", -1)], page, default_limit=100
+    )
     
     # Group by session
     sessions = {}
-    for msg in messages:
+    for msg in page_data["items"]:
         sid = msg["session_id"]
         if sid not in sessions:
             sessions[sid] = {"session_id": sid, "messages": [], "last_message": msg["timestamp"]}
         sessions[sid]["messages"].append(msg)
     
-    return list(sessions.values())
+    return page_response({**page_data, "items": list(sessions.values())}, page, response)
 
 @api_router.get("/ai/sessions")
 async def get_ai_sessions(
@@ -5767,15 +8470,13 @@ async def sync_from_google_sheets(
         # Crea/trova pazienti
         created_patients = 0
         created_appointments = 0
+        synced_dates = set()
         skipped_appointments = len(all_appointments) - len(new_appointments_to_process)
         
         patient_id_map = {}
         
         # Prima carica TUTTI i pazienti esistenti nel DB per questo ambulatorio
-        existing_patients_in_db = await db.patients.find(
-            {"ambulatorio": data.ambulatorio.value},
-            {"id": 1, "cognome": 1, "nome": 1, "_id": 0}
-        ).to_list(None)
+        existing_patients_in_db = await get_patient_directory(data.ambulatorio.value)
         
         # Crea mappa per lookup veloce
         for p in existing_patients_in_db:
@@ -5857,9 +8558,6 @@ async def sync_from_google_sheets(
                 if action_for_name and action_for_name.get("action") in ["create_new", "selected"]:
                     # L'utente ha esplicitamente chiesto di creare questo paziente
                     new_patient_id = str(uuid.uuid4())
-                    codice_paziente = generate_patient_code(nome or "X", cognome)
-                    while await db.patients.find_one({"codice_paziente": codice_paziente}):
-                        codice_paziente = generate_patient_code(nome or "X", cognome)
                     
                     # Determina tipo paziente
                     patient_tipos = set()
@@ -5876,7 +8574,6 @@ async def sync_from_google_sheets(
                     
                     new_patient = {
                         "id": new_patient_id,
-                        "codice_paziente": codice_paziente,
                         "nome": nome or "",
                         "cognome": cognome,
                         "tipo": patient_tipo,
@@ -5888,7 +8585,7 @@ async def sync_from_google_sheets(
                         "created_at": datetime.now(timezone.utc).isoformat(),
                         "updated_at": datetime.now(timezone.utc).isoformat()
                     }
-                    await db.patients.insert_one(new_patient)
+                    await insert_patient_with_code(new_patient)
                     patient_id_map[(cognome, nome)] = new_patient_id
                     created_patients += 1
                     logger.info(f"Creato paziente (esplicito): {cognome} {nome}")
@@ -6008,6 +8705,7 @@ async def sync_from_google_sheets(
             }
             await db.appointments.insert_one(new_apt)
             created_appointments += 1
+            synced_dates.add(new_apt["data"])
             
             # NUOVO: Salva l'appuntamento come "analizzato" per non rianalizzarlo in futuro
             # IMPORTANTE: Normalizza il nome (strip + lower) per match consistente
@@ -6021,6 +8719,9 @@ async def sync_from_google_sheets(
             )
             await db.analyzed_appointments.insert_one(analyzed_apt.model_dump())
         
+        await refresh_slot_occupancy(data.ambulatorio.value, synced_dates)
+        await refresh_statistics_rollup(data.ambulatorio.value, synced_dates)
+        
         logger.info(f"Sincronizzazione completata: {created_patients} pazienti, {created_appointments} appuntamenti")
         logger.info(f"Skip dettagli: no_patient={skipped_no_patient}, existing={skipped_existing}")
         
@@ -6168,10 +8869,7 @@ async def analyze_google_sheets_sync(
         logger.info(f"Date revisionate trovate: {len(revised_dates_map)}")
         
         # STEP 1: Ottieni TUTTI i pazienti esistenti nel sistema
-        existing_patients_list = await db.patients.find(
-            {"ambulatorio": data.ambulatorio.value},
-            {"id": 1, "cognome": 1, "nome": 1, "_id": 0}
-        ).to_list(None)
+        existing_patients_list = await get_patient_directory(data.ambulatorio.value)
         
         # Crea dizionari per lookup veloce
         # existing_patients_by_fullname: "cognome nome" -> patient_id
@@ -6750,14 +9448,19 @@ async def rollback_sync(ambulatorio: str, payload: dict = Depends(verify_token))
     
     # Elimina pazienti e appuntamenti attuali
     await db.patients.delete_many({"ambulatorio": ambulatorio})
+    invalidate_patient_directory(ambulatorio)
     await db.appointments.delete_many({"ambulatorio": ambulatorio})
     
     # Ripristina dal backup
     if backup["patients"]:
-        await db.patients.insert_many(backup["patients"])
+        await db.patients.insert_many([with_search_fields(p) for p in backup["patients"]])
+        invalidate_patient_directory(ambulatorio)
     if backup["appointments"]:
         await db.appointments.insert_many(backup["appointments"])
     
+    await refresh_slot_occupancy(ambulatorio, await db.slot_occupancy.distinct("data", {"ambulatorio": ambulatorio}))
+    await rebuild_statistics_rollup(ambulatorio)
+    
     # Elimina il backup usato
     await db.sync_backups.delete_one({"id": backup["id"]})
     
@@ -6771,7 +9474,6 @@ async def rollback_sync(ambulatorio: str, payload: dict = Depends(verify_token))
 # ============== NUOVO SISTEMA SYNC BASATO SU SNAPSHOT TEMPORALI ==============
 import gspread
 from google.oauth2.service_account import Credentials as GoogleCredentials
-import hashlib
 
 GOOGLE_CREDENTIALS_PATH = "/app/backend/google_credentials.json"
 GOOGLE_SCOPES = [
@@ -6871,10 +9573,7 @@ async def sync_v2_analyze(data: GoogleSheetsSyncRequest, payload: dict = Depends
             }
         
         # Carica pazienti esistenti per verificare conflitti
-        existing_patients = await db.patients.find(
-            {"ambulatorio": data.ambulatorio.value},
-            {"id": 1, "cognome": 1, "nome": 1, "_id": 0}
-        ).to_list(None)
+        existing_patients = await get_patient_directory(data.ambulatorio.value)
         
         existing_patients_map = {}
         for p in existing_patients:
@@ -7142,10 +9841,7 @@ async def sync_v2_execute(data: dict, payload: dict = Depends(verify_token)):
         new_appointments = [current_hashes[h] for h in new_hashes]
         
         # Carica pazienti esistenti
-        existing_patients = await db.patients.find(
-            {"ambulatorio": ambulatorio},
-            {"id": 1, "cognome": 1, "nome": 1, "_id": 0}
-        ).to_list(None)
+        existing_patients = await get_patient_directory(ambulatorio)
         
         existing_patients_map = {}
         for p in existing_patients:
@@ -7157,6 +9853,7 @@ async def sync_v2_execute(data: dict, payload: dict = Depends(verify_token)):
         created_appointments = 0
         created_patients = 0
         skipped = 0
+        synced_dates = set()
         
         for apt in new_appointments:
             full_name = f"{apt['cognome']} {apt.get('nome', '')}".strip()
@@ -7184,7 +9881,8 @@ async def sync_v2_execute(data: dict, payload: dict = Depends(verify_token)):
                         "status": "in_cura",
                         "created_at": datetime.now(timezone.utc).isoformat()
                     }
-                    await db.patients.insert_one(new_patient)
+                    await db.patients.insert_one(with_search_fields(new_patient))
+                    invalidate_patient_directory(ambulatorio)
                     patient_id = new_patient["id"]
                     existing_patients_map[full_name_lower] = patient_id
                     created_patients += 1
@@ -7222,6 +9920,10 @@ async def sync_v2_execute(data: dict, payload: dict = Depends(verify_token)):
             if not existing:
                 await db.appointments.insert_one(new_apt)
                 created_appointments += 1
+                synced_dates.add(new_apt["data"])
+        
+        await refresh_slot_occupancy(ambulatorio, synced_dates)
+        await refresh_statistics_rollup(ambulatorio, synced_dates)
         
         # Salva snapshot con TUTTI gli hash attuali
         snapshot = {
@@ -7293,6 +9995,213 @@ async def sync_v2_reset(ambulatorio: str, payload: dict = Depends(verify_token))
         "message": "Snapshot eliminati. La prossima sincronizzazione analizzerà tutti gli appuntamenti."
     }
 
+# ============== DATABASE INDEXES ==============
+# Indici dichiarati per ogni collection interrogata dalle route.
+# Ogni voce è (nome, chiavi, opzioni); il nome esplicito permette di confrontare
+# quanto dichiarato con quanto presente sul server.
+MONGO_INDEXES: Dict[str, List[tuple]] = {
+    "patients": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("ambulatorio_status_cognome", [("ambulatorio", 1), ("status", 1), ("cognome", 1), ("nome", 1)], {}),
+        ("ambulatorio_tipo", [("ambulatorio", 1), ("tipo", 1)], {}),
+        ("ambulatorio_search_tokens", [("ambulatorio", 1), ("search_tokens", 1)], {}),
+        ("ambulatorio_search_trigrams", [("ambulatorio", 1), ("search_trigrams", 1)], {}),
+        # Solo i codici valorizzati: i pazienti creati senza codice restano ammessi
+        ("codice_paziente_unique", [("codice_paziente", 1)],
+         {"unique": True, "partialFilterExpression": {"codice_paziente": {"$gt": ""}}}),
+    ],
+    "appointments": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("ambulatorio_data_ora_tipo", [("ambulatorio", 1), ("data", 1), ("ora", 1), ("tipo", 1)], {}),
+        ("ambulatorio_data_ora_id", [("ambulatorio", 1), ("data", 1), ("ora", 1), ("id", 1)], {}),
+        ("patient_data", [("patient_id", 1), ("data", 1)], {}),
+    ],
+    "schede_medicazione_med": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("patient_ambulatorio_data_id", [("patient_id", 1), ("ambulatorio", 1), ("data_compilazione", -1), ("id", -1)], {}),
+    ],
+    "schede_impianto_picc": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("patient_ambulatorio_data_id", [("patient_id", 1), ("ambulatorio", 1), ("data_impianto", -1), ("id", -1)], {}),
+        ("ambulatorio_data_impianto", [("ambulatorio", 1), ("data_impianto", 1)], {}),
+    ],
+    "schede_gestione_picc": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("patient_ambulatorio_mese_id", [("patient_id", 1), ("ambulatorio", 1), ("mese", -1), ("id", -1)], {}),
+    ],
+    "photos": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("blob_id", [("blob_id", 1)], {}),
+        # Conteggio dei riferimenti in release_blobs (le varianti esistono solo per le immagini)
+        ("variants_thumb", [("variants.thumb", 1)], {"sparse": True}),
+        ("variants_medium", [("variants.medium", 1)], {"sparse": True}),
+        ("patient_ambulatorio_data_id", [("patient_id", 1), ("ambulatorio", 1), ("data", -1), ("id", -1)], {}),
+    ],
+    "closed_slots": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("ambulatorio_data_ora_id", [("ambulatorio", 1), ("data", 1), ("ora", 1), ("id", 1)], {}),
+    ],
+    "slot_occupancy": [
+        ("ambulatorio_data_ora_tipo", [("ambulatorio", 1), ("data", 1), ("ora", 1), ("tipo", 1)], {"unique": True}),
+    ],
+    "revisions": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("ambulatorio_active_dates", [("ambulatorio", 1), ("active", 1), ("start_date", 1), ("end_date", 1)], {}),
+    ],
+    "prescrizioni": [
+        ("patient_ambulatorio", [("patient_id", 1), ("ambulatorio", 1)], {}),
+        ("ambulatorio_patient_id", [("ambulatorio", 1), ("patient_id", 1), ("_id", 1)], {}),
+    ],
+    "analyzed_appointments": [
+        ("ambulatorio_name_date_ora_tipo", [("ambulatorio", 1), ("patient_name", 1), ("date", 1), ("ora", 1), ("tipo", 1)], {}),
+    ],
+    "manual_edits": [
+        ("id", [("id", 1)], {}),
+        ("ambulatorio_entity", [("ambulatorio", 1), ("entity_id", 1)], {}),
+        ("ambulatorio_entity_type", [("ambulatorio", 1), ("entity_type", 1)], {}),
+    ],
+    "sync_snapshots": [
+        ("ambulatorio_sync_at", [("ambulatorio", 1), ("sync_at", -1)], {}),
+    ],
+    "sync_timestamps": [
+        ("ambulatorio", [("ambulatorio", 1)], {}),
+    ],
+    "sync_backups": [
+        ("ambulatorio", [("ambulatorio", 1)], {}),
+    ],
+    "ignored_sync_names": [
+        ("ambulatorio_name", [("ambulatorio", 1), ("name", 1)], {}),
+    ],
+    "name_mappings": [
+        ("ambulatorio_sheet_name", [("ambulatorio", 1), ("sheet_name", 1)], {}),
+    ],
+    "statistics_daily": [
+        ("ambulatorio_data_tipo", [("ambulatorio", 1), ("data", 1), ("tipo", 1)], {"unique": True}),
+    ],
+    "statistics_rollup_state": [
+        ("ambulatorio", [("ambulatorio", 1)], {"unique": True}),
+    ],
+    "ai_chat_history": [
+        ("session_timestamp", [("session_id", 1), ("timestamp", 1)], {}),
+        ("user_ambulatorio_timestamp_id", [("user_id", 1), ("ambulatorio", 1), ("timestamp", -1), ("id", -1)], {}),
+    ],
+    "render_jobs": [
+        ("id_unique", [("id", 1)], {"unique": True}),
+        ("ambulatorio_user_created", [("ambulatorio", 1), ("user_id", 1), ("created_at", -1), ("id", -1)], {}),
+        ("status_updated", [("status", 1), ("updated_at", 1)], {}),
+        ("expires_at", [("expires_at", 1)], {}),
+    ],
+    "render_artifacts.files": [
+        ("metadata_job_id", [("metadata.job_id", 1)], {}),
+    ],
+    "ai_undo_history": [
+        ("id", [("id", 1)], {}),
+        ("user_ambulatorio_timestamp", [("user_id", 1), ("ambulatorio", 1), ("timestamp", -1)], {}),
+    ],
+}
+
+async def find_duplicate_patient_codes() -> List[str]:
+    """Codici paziente assegnati a più pazienti (impediscono l'indice unique)"""
+    duplicates = await db.patients.aggregate([
+        {"$match": {"codice_paziente": {"$gt": ""}}},
+        {"$group": {"_id": "$codice_paziente", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$sort": {"_id": 1}},
+    ]).to_list(None)
+    return [d["_id"] for d in duplicates]
+
+async def check_patient_codes_unique() -> Optional[str]:
+    duplicates = await find_duplicate_patient_codes()
+    if not duplicates:
+        return None
+    return (f"{len(duplicates)} codici paziente duplicati ({', '.join(duplicates[:20])}): "
+            "assegnare un nuovo codice ai pazienti interessati e riavviare")
+
+# Controlli eseguiti prima di creare un indice: se restituiscono un messaggio
+# l'indice non viene creato
+MONGO_INDEX_PRECHECKS = {
+    ("patients", "codice_paziente_unique"): check_patient_codes_unique,
+}
+
+async def ensure_indexes() -> Dict[str, Any]:
+    """Crea gli indici dichiarati in MONGO_INDEXES (operazione idempotente).
+
+    Gli indici sono creati uno alla volta: un errore (es. duplicati che impediscono
+    un indice unique) riguarda solo quell'indice, viene loggato e riportato in
+    errors come "collection.indice" e non blocca l'avvio dell'applicazione.
+    """
+    global _patient_code_index_ready
+    from pymongo import IndexModel
+
+    # Un errore qui (database non raggiungibile) interrompe tutto e si riprova
+    await db.command("ping")
+    created = {}
+    errors = {}
+    for collection_name, specs in MONGO_INDEXES.items():
+        collection = db[collection_name]
+        created[collection_name] = []
+        for name, keys, options in specs:
+            try:
+                precheck = MONGO_INDEX_PRECHECKS.get((collection_name, name))
+                problem = await precheck() if precheck else None
+                if problem:
+                    errors[f"{collection_name}.{name}"] = problem
+                    logger.critical(f"Indice {name} su {collection_name} non creato: {problem}")
+                    continue
+                created[collection_name].extend(await collection.create_indexes([IndexModel(keys, name=name, **options)]))
+            except Exception as e:
+                errors[f"{collection_name}.{name}"] = str(e)
+                logger.error(f"Impossibile creare l'indice {name} su {collection_name}: {e}")
+    _patient_code_index_ready = "codice_paziente_unique" in await db.patients.index_information()
+    return {"created": created, "errors": errors}
+
+async def verify_indexes() -> Dict[str, Any]:
+    """Confronta gli indici dichiarati con quelli presenti sul server.
+
+    Per ogni collection riporta gli indici mancanti (o con chiavi diverse),
+    quelli presenti ma non dichiarati e quelli mai usati dall'ultimo riavvio
+    del server MongoDB (secondo $indexStats, se disponibile).
+    """
+    report = {}
+    for collection_name, specs in MONGO_INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        declared = {name: [(k, d) for k, d in keys] for name, keys, _ in specs}
+
+        missing = []
+        for name, keys in declared.items():
+            info = existing.get(name)
+            if not info or [(k, d) for k, d in info["key"]] != keys:
+                missing.append(name)
+
+        undeclared = [name for name in existing if name != "_id_" and name not in declared]
+
+        unused = []
+        try:
+            stats = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+            for stat in stats:
+                if stat["name"] != "_id_" and stat.get("accesses", {}).get("ops", 0) == 0:
+                    unused.append(stat["name"])
+        except Exception as e:
+            # $indexStats non è disponibile su tutti i deployment
+            logger.debug(f"$indexStats non disponibile per {collection_name}: {e}")
+
+        report[collection_name] = {
+            "missing": missing,
+            "undeclared": undeclared,
+            "unused": sorted(unused),
+        }
+    return report
+
+@api_router.get("/system/indexes")
+async def get_indexes_report(payload: dict = Depends(verify_token)):
+    """Stato degli indici MongoDB: mancanti, non dichiarati e non utilizzati"""
+    report = await verify_indexes()
+    return {
+        "ok": all(not r["missing"] for r in report.values()),
+        "collections": report
+    }
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -7302,6 +10211,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Has-More", "X-Next-Cursor"],
 )
 
 # Configure logging
@@ -7311,6 +10221,72 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Attesa (secondi) tra i tentativi delle attività di avvio che usano il database
+STARTUP_RETRY_DELAYS = (5, 15, 30, 60)
+
+async def retry_startup_step(description: str, step):
+    """Esegue un passo di avvio che dipende dal database, riprovando finché riesce"""
+    attempt = 0
+    while True:
+        try:
+            return await step()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            delay = STARTUP_RETRY_DELAYS[min(attempt, len(STARTUP_RETRY_DELAYS) - 1)]
+            logger.error(f"{description} non riuscita: {e} (nuovo tentativo tra {delay}s)")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+async def run_migration_once(name: str, migration) -> Optional[Any]:
+    """Esegue una migrazione dei dati una sola volta (marcatore nella collection migrations)"""
+    if await db.migrations.find_one({"_id": name}, {"_id": 1}):
+        return None
+    result = await migration()
+    await db.migrations.update_one(
+        {"_id": name},
+        {"$set": {"completed_at": datetime.now(timezone.utc).isoformat(), "result": result}},
+        upsert=True
+    )
+    return result
+
+async def prepare_database() -> None:
+    result = await retry_startup_step("Creazione indici", ensure_indexes)
+    report = await retry_startup_step("Verifica indici", verify_indexes)
+    for collection_name, r in report.items():
+        if r["missing"]:
+            logger.warning(f"Indici mancanti su {collection_name}: {', '.join(r['missing'])}")
+        if r["undeclared"]:
+            logger.info(f"Indici non dichiarati su {collection_name}: {', '.join(r['undeclared'])}")
+    logger.info(f"Indici verificati su {len(report)} collection ({len(result['errors'])} errori)")
+    
+    backfilled = await retry_startup_step("Calcolo chiavi di ricerca", backfill_patient_search_fields)
+    if backfilled:
+        logger.info(f"Chiavi di ricerca calcolate per {backfilled} pazienti")
+    await retry_startup_step(
+        "Migrazione nomi appuntamenti",
+        lambda: run_migration_once("appointment_patient_names", backfill_appointment_patient_names)
+    )
+
+# Ogni attività di avvio è indipendente: se il database non è raggiungibile l'app
+# parte comunque e ciascuna riprova per conto suo
+STARTUP_TASKS = {
+    "db_setup": prepare_database,
+    "patient_directory_watcher": watch_patient_changes,
+    "job_cleanup": cleanup_expired_jobs_loop,
+}
+
+@app.on_event("startup")
+async def startup_db_indexes():
+    for task_name, task in STARTUP_TASKS.items():
+        setattr(app.state, task_name, asyncio.create_task(task()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task_name in STARTUP_TASKS:
+        task = getattr(app.state, task_name, None)
+        if task:
+            task.cancel()
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
     client.close()
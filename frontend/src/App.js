@@ -57,6 +57,11 @@ apiClient.interceptors.request.use((config) => {
   return config;
 });
 
+// URL assoluto per file serviti dall'API (es. photo.urls.thumb), utilizzabile in <img src> e link.
+// Le URL restituite dal backend sono già firmate e valide solo per quel file:
+// il token di sessione non finisce mai nella query string.
+export const fileUrl = (path) => `${API}${path}`;
+
 apiClient.interceptors.response.use(
   (response) => response,
   (error) => {
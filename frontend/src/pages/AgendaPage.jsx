@@ -133,6 +133,7 @@ export default function AgendaPage() {
   
   // Timer per gestire click singolo vs doppio click
   const clickTimerRef = useRef(null);
+  const agendaVersionRef = useRef(null);
   
   // New patient form state
   const [newPatientNome, setNewPatientNome] = useState("");
@@ -167,19 +168,8 @@ export default function AgendaPage() {
 
   const isVillaGinestre = ambulatorio === "villa_ginestre";
 
-  // Carica revisioni attive per la data corrente
-  const loadRevisions = async () => {
-    try {
-      const dateStr = format(currentDate, "yyyy-MM-dd");
-      const response = await apiClient.get(`/revisions/check`, {
-        params: { ambulatorio, dates: dateStr }
-      });
-      const revisionsForDate = response.data.revised_dates?.[dateStr] || [];
-      setActiveRevisions(revisionsForDate);
-    } catch (error) {
-      console.error("Errore caricamento revisioni:", error);
-    }
-  };
+  // Le revisioni attive arrivano con i dati dell'agenda (GET /agenda)
+  const loadRevisions = () => fetchData();
 
   // Crea una revisione
   const createRevision = async () => {
@@ -209,14 +199,12 @@ export default function AgendaPage() {
     }
   };
 
-  useEffect(() => {
-    loadRevisions();
-  }, [currentDate, ambulatorio]);
-
   // Carica tutti i pazienti per la ricerca
   const loadAllPatients = async () => {
     try {
-      const response = await apiClient.get(`/patients?ambulatorio=${ambulatorio}`);
+      const response = await apiClient.get("/patients/directory", {
+        params: { ambulatorio },
+      });
       setAllPatients(response.data || []);
     } catch (error) {
       console.error("Error loading patients:", error);
@@ -350,6 +338,7 @@ export default function AgendaPage() {
         );
         // Ricarica i dati e resetta tutto
         fetchData();
+        loadPatients();
         setSyncDialogOpen(false);
         setSyncStep("initial");
         setSyncConflicts([]);
@@ -457,6 +446,7 @@ export default function AgendaPage() {
         );
         // Ricarica i dati e resetta tutto
         fetchData();
+        loadPatients();
         setSyncDialogOpen(false);
         setSyncStep("initial");
         setSyncConflicts([]);
@@ -512,33 +502,50 @@ export default function AgendaPage() {
     }
   };
 
+  const loadPatients = useCallback(async () => {
+    try {
+      const response = await apiClient.get("/patients/directory", {
+        params: { ambulatorio, status: "in_cura" },
+      });
+      setPatients(response.data);
+    } catch (error) {
+      console.error("Error loading patients:", error);
+    }
+  }, [ambulatorio]);
+
+  useEffect(() => {
+    loadPatients();
+  }, [loadPatients]);
+
   const fetchData = useCallback(async () => {
     setLoading(true);
     try {
       const dateStr = format(currentDate, "yyyy-MM-dd");
-      const [appointmentsRes, patientsRes, holidaysRes, closedSlotsRes] = await Promise.all([
-        apiClient.get("/appointments", {
-          params: { ambulatorio, data: dateStr },
-        }),
-        apiClient.get("/patients", {
-          params: { ambulatorio, status: "in_cura" },
-        }),
-        apiClient.get("/calendar/holidays", {
-          params: { anno: currentDate.getFullYear() },
-        }),
-        apiClient.get("/closed-slots", {
-          params: { ambulatorio, data: dateStr },
-        }),
-      ]);
-
-      setAppointments(appointmentsRes.data);
-      setPatients(patientsRes.data);
-      setHolidays(holidaysRes.data);
-      setClosedSlots(closedSlotsRes.data || []);
+      const agendaKey = `${ambulatorio}|${dateStr}`;
+      const cached = agendaVersionRef.current;
+      // Un'unica richiesta: se i dati non sono cambiati il server risponde 304
+      const response = await apiClient.get("/agenda", {
+        params: {
+          ambulatorio,
+          data_from: dateStr,
+          version: cached?.key === agendaKey ? cached.version : undefined,
+        },
+        validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+      });
+      if (response.status === 304) {
+        return;
+      }
+
+      const agenda = response.data;
+      agendaVersionRef.current = { key: agendaKey, version: agenda.version };
+      setAppointments(agenda.appointments);
+      setHolidays(agenda.holidays);
+      setClosedSlots(agenda.closed_slots || []);
+      setActiveRevisions(agenda.revised_dates?.[dateStr] || []);
       
       // Set initial working day after holidays are loaded
       if (!initialLoadDone) {
-        const workingDay = getNextWorkingDay(new Date(), holidaysRes.data);
+        const workingDay = getNextWorkingDay(new Date(), agenda.holidays);
         if (format(workingDay, "yyyy-MM-dd") !== format(currentDate, "yyyy-MM-dd")) {
           setCurrentDate(workingDay);
         }
@@ -875,7 +882,7 @@ export default function AgendaPage() {
       setNewPatientCognome("");
       
       // Refresh patients and select the new one
-      await fetchData();
+      await loadPatients();
       setSelectedPatient(response.data);
       setSearchQuery(`${response.data.cognome} ${response.data.nome}`);
     } catch (error) {
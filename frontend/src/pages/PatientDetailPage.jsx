@@ -1,6 +1,6 @@
 import { useState, useEffect, useCallback, useRef } from "react";
 import { useParams, useNavigate } from "react-router-dom";
-import { useAmbulatorio, apiClient, API } from "@/App";
+import { useAmbulatorio, apiClient, API, fileUrl } from "@/App";
 import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
 import { Label } from "@/components/ui/label";
@@ -149,6 +149,21 @@ export default function PatientDetailPage() {
     }
   }, [patientId, navigate]);
 
+  // Generazione in background: invia il job, attende che termini e scarica il risultato
+  const downloadJobResult = async (body) => {
+    const { data: job } = await apiClient.post("/jobs", body);
+    let current = job;
+    while (current.status === "queued" || current.status === "running") {
+      const res = await apiClient.get(`/jobs/${job.id}`, { params: { wait: 20 } });
+      current = res.data;
+    }
+    if (current.status !== "done") {
+      throw new Error(current.error || "Generazione non riuscita");
+    }
+    const response = await apiClient.get(`/jobs/${job.id}/download`, { responseType: 'blob' });
+    return response.data;
+  };
+
   // Download patient folder as PDF
   const handleDownloadPDF = async (section = "all") => {
     try {
@@ -159,11 +174,8 @@ export default function PatientDetailPage() {
         impianto: "impianto"
       };
       toast.info(`Generazione PDF ${sectionNames[section]} in corso...`);
-      const response = await apiClient.get(`/patients/${patientId}/download/pdf`, {
-        params: { section },
-        responseType: 'blob'
-      });
-      const blob = new Blob([response.data], { type: 'application/pdf' });
+      const data = await downloadJobResult({ kind: "patient_pdf", patient_id: patientId, section });
+      const blob = new Blob([data], { type: 'application/pdf' });
       const url = window.URL.createObjectURL(blob);
       const link = document.createElement('a');
       link.href = url;
@@ -180,13 +192,15 @@ export default function PatientDetailPage() {
   };
 
   // Download patient folder as ZIP
-  const handleDownloadZIP = async () => {
+  const handleDownloadZIP = async (includeAttachments = false) => {
     try {
       toast.info("Generazione ZIP in corso...");
-      const response = await apiClient.get(`/patients/${patientId}/download/zip`, {
-        responseType: 'blob'
+      const data = await downloadJobResult({
+        kind: "patient_zip",
+        patient_id: patientId,
+        include_attachments: includeAttachments
       });
-      const blob = new Blob([response.data], { type: 'application/zip' });
+      const blob = new Blob([data], { type: 'application/zip' });
       const url = window.URL.createObjectURL(blob);
       const link = document.createElement('a');
       link.href = url;
@@ -400,9 +414,13 @@ export default function PatientDetailPage() {
                 <FileSpreadsheet className="w-4 h-4 mr-2 text-purple-500" />
                 Solo Schede Impianto (Complete)
               </DropdownMenuItem>
-              <DropdownMenuItem onClick={handleDownloadZIP} data-testid="download-zip-btn">
+              <DropdownMenuItem onClick={() => handleDownloadZIP(false)} data-testid="download-zip-btn">
+                <FileArchive className="w-4 h-4 mr-2 text-amber-500" />
+                Scarica ZIP
+              </DropdownMenuItem>
+              <DropdownMenuItem onClick={() => handleDownloadZIP(true)} data-testid="download-zip-allegati-btn">
                 <FileArchive className="w-4 h-4 mr-2 text-amber-500" />
-                Scarica ZIP (con foto)
+                Scarica ZIP con allegati
               </DropdownMenuItem>
             </DropdownMenuContent>
           </DropdownMenu>
@@ -927,13 +945,8 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
     if (fileType === 'image') {
       setSelectedPhoto(photo);
     } else {
-      // For documents, open in new tab or download
-      const blob = new Blob(
-        [Uint8Array.from(atob(photo.image_data), c => c.charCodeAt(0))],
-        { type: photo.mime_type || 'application/pdf' }
-      );
-      const url = URL.createObjectURL(blob);
-      window.open(url, '_blank');
+      // For documents, open in new tab
+      window.open(fileUrl(photo.urls.original), '_blank');
     }
   };
 
@@ -1061,8 +1074,9 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                       onClick={() => setSelectedPhoto(photo)}
                     >
                       <img
-                        src={`data:image/jpeg;base64,${photo.image_data}`}
+                        src={fileUrl(photo.urls.thumb || photo.urls.original)}
                         alt={photo.original_name || "Foto paziente"}
+                        loading="lazy"
                         className="w-full h-full object-cover"
                       />
                     </div>
@@ -1080,7 +1094,7 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                             e.stopPropagation();
                             // Download as PDF
                             const link = document.createElement('a');
-                            link.href = `data:image/jpeg;base64,${photo.image_data}`;
+                            link.href = fileUrl(photo.urls.original);
                             link.download = `${photo.original_name || 'foto'}.jpg`;
                             link.click();
                           }}
@@ -1099,7 +1113,7 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                             printWindow.document.write(`
                               <html><head><title>${photo.original_name || 'Foto'}</title></head>
                               <body style="margin:0;display:flex;justify-content:center;align-items:center;min-height:100vh;">
-                              <img src="data:image/jpeg;base64,${photo.image_data}" style="max-width:100%;max-height:100vh;"/>
+                              <img src="${fileUrl(photo.urls.original)}" style="max-width:100%;max-height:100vh;"/>
                               </body></html>
                             `);
                             printWindow.document.close();
@@ -1155,16 +1169,10 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                           onClick={(e) => {
                             e.stopPropagation();
                             // Download document
-                            const blob = new Blob(
-                              [Uint8Array.from(atob(doc.image_data), c => c.charCodeAt(0))],
-                              { type: doc.mime_type || 'application/pdf' }
-                            );
-                            const url = URL.createObjectURL(blob);
                             const link = document.createElement('a');
-                            link.href = url;
+                            link.href = fileUrl(doc.urls.original);
                             link.download = doc.original_name || 'documento';
                             link.click();
-                            URL.revokeObjectURL(url);
                           }}
                         >
                           <Download className="w-4 h-4 mr-1" />
@@ -1176,12 +1184,7 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                           onClick={(e) => {
                             e.stopPropagation();
                             // Print document
-                            const blob = new Blob(
-                              [Uint8Array.from(atob(doc.image_data), c => c.charCodeAt(0))],
-                              { type: doc.mime_type || 'application/pdf' }
-                            );
-                            const url = URL.createObjectURL(blob);
-                            const printWindow = window.open(url, '_blank');
+                            const printWindow = window.open(fileUrl(doc.urls.original), '_blank');
                             printWindow.onload = () => printWindow.print();
                           }}
                         >
@@ -1272,7 +1275,7 @@ function AllegatiGallery({ patientId, ambulatorio, patientTipo, photos, onRefres
                 style={{ maxHeight: '60vh', maxWidth: '100%' }}
               >
                 <img
-                  src={`data:image/jpeg;base64,${selectedPhoto.image_data}`}
+                  src={fileUrl(photoZoom > 1 ? selectedPhoto.urls.original : (selectedPhoto.urls.medium || selectedPhoto.urls.original))}
                   alt="Foto ingrandita"
                   className="transition-transform duration-200"
                   style={{ 
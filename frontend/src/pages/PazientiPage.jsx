@@ -246,16 +246,32 @@ export default function PazientiPage() {
   const fetchAllPatients = useCallback(async () => {
     setLoading(true);
     try {
-      const [inCuraRes, dimessiRes, sospesiRes] = await Promise.all([
-        apiClient.get("/patients", { params: { ambulatorio, status: "in_cura" } }),
-        apiClient.get("/patients", { params: { ambulatorio, status: "dimesso" } }),
-        apiClient.get("/patients", { params: { ambulatorio, status: "sospeso" } }),
-      ]);
+      // Una sola richiesta per tutti gli stati; i gruppi più grandi del limite
+      // vengono completati pagina per pagina
+      const pageSize = 1000;
+      const response = await apiClient.get("/patients", {
+        params: { ambulatorio, grouped: true, limit: pageSize },
+      });
+      const buckets = response.data.buckets;
+      const grouped = {};
+      await Promise.all(Object.entries(buckets).map(async ([status, bucket]) => {
+        const patients = [...bucket.patients];
+        let hasMore = bucket.has_more;
+        while (hasMore) {
+          const page = await apiClient.get("/patients", {
+            params: { ambulatorio, grouped: true, status, limit: pageSize, offset: patients.length },
+          });
+          const next = page.data.buckets[status];
+          patients.push(...next.patients);
+          hasMore = next.has_more && next.patients.length > 0;
+        }
+        grouped[status] = patients;
+      }));
       
       setAllPatients({
-        in_cura: inCuraRes.data,
-        dimesso: dimessiRes.data,
-        sospeso: sospesiRes.data,
+        in_cura: grouped.in_cura || [],
+        dimesso: grouped.dimesso || [],
+        sospeso: grouped.sospeso || [],
       });
     } catch (error) {
       console.error("Error fetching patients:", error);
@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+# Come benchmark_pdf.py: server.py legge la configurazione all'import, ma non si
+# collega a MongoDB finché non esegue una query
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_ambulatorio")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
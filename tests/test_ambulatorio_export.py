@@ -0,0 +1,18 @@
+import server
+
+
+# ============== ESPORTAZIONI ==============
+def test_export_period_filter_includes_the_whole_last_day():
+    assert server.export_period_filter("schede_impianto_picc", "2026-01-01", "2026-01-31") == {
+        "data_impianto": {"$gte": "2026-01-01", "$lt": "2026-02-01"}
+    }
+    assert server.export_period_filter("appointments", "2026-12-01", "2026-12-31") == {
+        "data": {"$gte": "2026-12-01", "$lt": "2027-01-01"}
+    }
+
+
+def test_export_period_filter_monthly_collection_and_open_period():
+    assert server.export_period_filter("schede_gestione_picc", "2026-01-15", "2026-03-02") == {
+        "mese": {"$gte": "2026-01", "$lte": "2026-03"}
+    }
+    assert server.export_period_filter("appointments", None, "2026-01-31") == {}
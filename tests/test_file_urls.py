@@ -0,0 +1,57 @@
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+
+def verify(url):
+    """verify_token_or_signature per una richiesta senza header Authorization"""
+    parts = urlsplit(url)
+    params = parse_qs(parts.query)
+    request = Request({
+        "type": "http", "method": "GET", "headers": [],
+        "path": server.api_router.prefix + parts.path, "query_string": parts.query.encode(),
+    })
+    return server.verify_token_or_signature(
+        request, None, int(params["expires"][0]) if "expires" in params else None, params.get("signature", [None])[0]
+    )
+
+
+# ============== URL FIRMATE ==============
+def test_signed_url_is_accepted():
+    assert verify(server.sign_file_url("/photos/p1/raw"))["signed"] is True
+    assert verify(server.sign_file_url("/photos/p1/raw", "variant=thumb"))["ambulatori"] == []
+
+
+@pytest.mark.parametrize("edit", [
+    lambda url: url.replace("/p1/", "/p2/"),
+    lambda url: url.replace("variant=thumb", "variant=medium"),
+    lambda url: url.replace("variant=thumb&", ""),
+    lambda url: url + "&download=1",
+])
+def test_signature_covers_path_and_query(edit):
+    url = server.sign_file_url("/photos/p1/raw", "variant=thumb")
+    with pytest.raises(HTTPException) as exc:
+        verify(edit(url))
+    assert (exc.value.status_code, exc.value.detail) == (401, "Firma non valida")
+
+
+def test_signature_ignores_parameter_order():
+    url = server.sign_file_url("/photos/p1/raw", "variant=thumb&download=1")
+    path, _, query = url.partition("?")
+    params = query.split("&")
+    assert verify(f"{path}?{'&'.join([params[1], params[0], *params[2:]])}")["signed"] is True
+
+
+def test_expired_or_missing_signature_is_refused(monkeypatch):
+    url = server.sign_file_url("/photos/p1/raw")
+    monkeypatch.setattr(server.time, "time", lambda: 10 ** 12)
+    with pytest.raises(HTTPException) as exc:
+        verify(url)
+    assert exc.value.detail == "Link scaduto"
+    with pytest.raises(HTTPException) as exc:
+        verify("/photos/p1/raw")
+    assert exc.value.detail == "Token mancante"
@@ -0,0 +1,78 @@
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+import server
+
+
+# ============== PAGINAZIONE ==============
+SORT = [("data", -1), ("id", -1)]
+
+
+def matches(doc, query):
+    """Sottoinsieme degli operatori di MongoDB usati da keyset_filter"""
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+            continue
+        value = doc.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, arg in condition.items():
+            if op == "$ne" and value == arg:
+                return False
+            if op == "$gt" and (value is None or not value > arg):
+                return False
+            if op == "$not" and matches(doc, {key: arg}):
+                return False
+            if op == "$gte" and (value is None or not value >= arg):
+                return False
+            if op == "$exists" and (key in doc) != arg:
+                return False
+    return True
+
+
+def mongo_sorted(docs, sort):
+    # null viene prima di ogni valore in ordine crescente (e dopo in decrescente)
+    for key, direction in reversed(sort):
+        docs = sorted(docs, key=lambda d: (d.get(key) is not None, d.get(key) or ""), reverse=direction < 0)
+    return docs
+
+
+def test_keyset_pagination_walks_every_document_once():
+    docs = [{"id": f"{i:02d}", "data": data} for i, data in enumerate(
+        ["2026-01-02", "2026-01-01", "2026-01-02", None, "2026-01-03", "2026-01-01", None]
+    )]
+    expected = mongo_sorted(docs, SORT)
+    seen, cursor = [], None
+    while True:
+        query = server.keyset_filter(SORT, server.decode_cursor(cursor, SORT)) if cursor else {}
+        page = [d for d in expected if matches(d, query)][:2]
+        if not page:
+            break
+        seen.extend(page)
+        cursor = server.encode_cursor(page[-1], SORT)
+    assert seen == expected
+
+
+def test_keyset_filter_after_last_null_in_descending_order_is_empty():
+    assert server.keyset_filter([("data", -1)], [None]) == {"_id": {"$exists": False}}
+
+
+@pytest.mark.parametrize("cursor", ["non-base64!", server.encode_cursor({"data": "2026-01-01"}, [("data", -1)])])
+def test_decode_cursor_rejects_malformed_or_mismatched_cursors(cursor):
+    with pytest.raises(HTTPException) as exc:
+        server.decode_cursor(cursor, SORT)
+    assert exc.value.status_code == 400
+
+
+def test_cursor_keeps_object_ids():
+    sort = [("patient_id", 1), ("_id", 1)]
+    oid = ObjectId()
+    values = server.decode_cursor(server.encode_cursor({"patient_id": "p1", "_id": oid}, sort), sort)
+    assert values == ["p1", oid] and isinstance(values[1], ObjectId)
+    with pytest.raises(HTTPException):
+        server.decode_cursor(server.encode_cursor({"patient_id": "p1", "_id": {"$oid": "non-valido"}}, sort), sort)
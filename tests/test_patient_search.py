@@ -0,0 +1,37 @@
+import server
+
+
+# ============== RICERCA PAZIENTI ==============
+def patient(cognome, nome):
+    return server.with_search_fields({"cognome": cognome, "nome": nome})
+
+
+def ranked(patients, text):
+    query = server.normalize_search_text(text)
+    return [f"{p['cognome']} {p['nome']}" for p in sorted(patients, key=lambda p: server.rank_patient_match(p, query))]
+
+
+def test_search_ranking_exact_before_prefix_before_fuzzy():
+    patients = [
+        patient("Rossini", "Mario"),
+        patient("Russo", "Maria"),
+        patient("Rossi", "Mario"),
+        patient("Rossi", "Marianna"),
+    ]
+    # Esatto, prefisso di ogni parola, poi fuzzy per similarità decrescente
+    assert ranked(patients, "rossi mario") == ["Rossi Mario", "Rossini Mario", "Rossi Marianna", "Russo Maria"]
+    # A parità di rango: cognome e nome
+    assert ranked(patients, "rossi mari")[:2] == ["Rossi Marianna", "Rossi Mario"]
+
+
+def test_search_ranking_ignores_accents_case_and_word_order():
+    patients = [patient("Niccolò", "D'Amico"), patient("Nicolosi", "Anna")]
+    assert server.rank_patient_match(patients[0], server.normalize_search_text("d amico NICCOLO"))[0] == 0
+    assert ranked(patients, "niccolo")[0] == "Niccolò D'Amico"
+
+
+def test_search_ranking_typo_matches_by_trigrams():
+    patients = [patient("Bianchi", "Luca"), patient("Verdi", "Luca")]
+    rank, similarity, *_ = server.rank_patient_match(patients[0], "bianci")
+    assert rank == 5 and -similarity > 0
+    assert ranked(patients, "bianci luca")[0] == "Bianchi Luca"
@@ -0,0 +1,34 @@
+import io
+import zipfile
+
+import server
+
+
+# ============== ALLEGATI NELLO ZIP ==============
+def test_attachment_archive_name_is_unique_and_safe():
+    used = set()
+    photos = [
+        {"id": "0", "original_name": "../../etc\\passwd"},
+        {"id": "1", "original_name": "foto.jpg", "data": "2026-01-05T10:00"},
+        {"id": "2", "original_name": "foto.jpg", "data": "2026-01-05"},
+        {"id": "3", "original_name": "referti/esame", "mime_type": "application/pdf"},
+        {"id": "4", "mime_type": "image/png", "data": "2026-01-06"},
+        {"id": "5", "original_name": "nota", "data": "2026-01-07"},
+        {"id": "6", "original_name": "nota", "data": "2026-01-07"},
+    ]
+    names = [server.attachment_archive_name(p, used) for p in photos]
+    assert names == [
+        "allegati/.._.._etc_passwd",
+        "allegati/2026-01-05_foto.jpg",
+        "allegati/2026-01-05_foto_2.jpg",
+        "allegati/referti_esame.pdf",
+        "allegati/2026-01-06_4.png",
+        "allegati/2026-01-07_nota",
+        "allegati/2026-01-07_nota_2",
+    ]
+    # Nessun nome esce dalla cartella allegati/ una volta estratto
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for name in names:
+            zf.writestr(name, b"")
+    assert all(n.startswith("allegati/") and "/" not in n[len("allegati/"):] for n in zipfile.ZipFile(buffer).namelist())
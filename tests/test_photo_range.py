@@ -0,0 +1,29 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+# ============== RANGE ==============
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-200", (800, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    (None, None),
+    ("items=0-1", None),
+    ("bytes=0-1,5-6", None),
+    ("bytes=a-b", None),
+    ("bytes=-", None),
+])
+def test_parse_range_header(header, expected):
+    assert server.parse_range_header(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=500-100"])
+def test_parse_range_header_unsatisfiable(header):
+    with pytest.raises(HTTPException) as exc:
+        server.parse_range_header(header, 1000)
+    assert exc.value.status_code == 416
+    assert exc.value.headers["Content-Range"] == "bytes */1000"
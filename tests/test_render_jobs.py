@@ -0,0 +1,246 @@
+import asyncio
+import copy
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+# ============== COLLEZIONE IN MEMORIA ==============
+class UpdateResult:
+    def __init__(self, modified_count):
+        self.modified_count = modified_count
+
+
+class Cursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+def matches(doc, query):
+    """Sottoinsieme degli operatori di MongoDB usati dalla gestione dei job"""
+    for key, condition in query.items():
+        value = doc.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, arg in condition.items():
+            if op == "$lt" and (value is None or not value < arg):
+                return False
+            if op == "$in" and value not in arg:
+                return False
+    return True
+
+
+class RenderJobs:
+    def __init__(self, *jobs):
+        self.docs = [dict(job) for job in jobs]
+
+    def get(self, job_id):
+        return next(doc for doc in self.docs if doc["id"] == job_id)
+
+    def _apply(self, doc, update):
+        doc.update(update.get("$set", {}))
+        for key, amount in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + amount
+        for key in update.get("$unset", {}):
+            doc.pop(key, None)
+
+    async def find_one(self, query, projection=None):
+        doc = next((d for d in self.docs if matches(d, query)), None)
+        return copy.deepcopy(doc)
+
+    async def find_one_and_update(self, query, update, projection=None, return_document=None):
+        doc = next((d for d in self.docs if matches(d, query)), None)
+        if doc is None:
+            return None
+        self._apply(doc, update)
+        return copy.deepcopy(doc)
+
+    async def update_one(self, query, update):
+        doc = next((d for d in self.docs if matches(d, query)), None)
+        if doc is None:
+            return UpdateResult(0)
+        self._apply(doc, update)
+        return UpdateResult(1)
+
+    def find(self, query, projection=None):
+        return Cursor([copy.deepcopy(d) for d in self.docs if matches(d, query)])
+
+
+class FakeDb:
+    def __init__(self, render_jobs):
+        self.render_jobs = render_jobs
+
+
+def iso(delta=timedelta()):
+    return (datetime.now(timezone.utc) + delta).isoformat()
+
+
+def queued_job(job_id="job-1", **fields):
+    return {
+        "id": job_id, "kind": "patient_pdf", "status": "queued", "ambulatorio": "pta_centro",
+        "created_at": iso(), "updated_at": iso(), **fields,
+    }
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    collection = RenderJobs()
+    monkeypatch.setattr(server, "db", FakeDb(collection))
+    stored = {}
+
+    async def store_artifact(job_id, filename, data, media_type):
+        stored[job_id] = data
+        return f"{job_id}/{filename}", len(data)
+
+    monkeypatch.setattr(server, "store_artifact", store_artifact)
+    collection.stored = stored
+    return collection
+
+
+def use_renderer(monkeypatch, renderer):
+    monkeypatch.setitem(server.JOB_RENDERERS, "patient_pdf", renderer)
+
+
+# ============== TRANSIZIONI DI STATO ==============
+@pytest.mark.anyio
+async def test_job_goes_from_queued_to_done(jobs, monkeypatch):
+    states = []
+
+    async def renderer(job):
+        states.append(jobs.get(job["id"])["status"])
+        return b"%PDF", "cartella.pdf", "application/pdf"
+
+    use_renderer(monkeypatch, renderer)
+    jobs.docs.append(queued_job())
+    await server.run_render_job("job-1")
+
+    job = jobs.get("job-1")
+    assert states == ["running"]
+    assert job["status"] == "done"
+    assert job["attempts"] == 1
+    assert (job["artifact_id"], job["filename"], job["size"]) == ("job-1/cartella.pdf", "cartella.pdf", 4)
+    assert job["expires_at"] > job["finished_at"]
+    assert jobs.stored == {"job-1": b"%PDF"}
+
+
+@pytest.mark.anyio
+async def test_failed_job_goes_to_error_and_expires(jobs, monkeypatch):
+    async def renderer(job):
+        raise HTTPException(status_code=404, detail="Paziente non trovato")
+
+    use_renderer(monkeypatch, renderer)
+    jobs.docs.append(queued_job())
+    await server.run_render_job("job-1")
+
+    job = jobs.get("job-1")
+    assert job["status"] == "error"
+    assert job["error"] == "Paziente non trovato"
+    assert job["expires_at"] > job["finished_at"]
+
+
+@pytest.mark.anyio
+async def test_job_over_max_runtime_is_interrupted(jobs, monkeypatch):
+    async def renderer(job):
+        await asyncio.sleep(10)
+
+    use_renderer(monkeypatch, renderer)
+    monkeypatch.setattr(server, "JOB_MAX_RUNTIME", 0.01)
+    jobs.docs.append(queued_job())
+    await server.run_render_job("job-1")
+
+    job = jobs.get("job-1")
+    assert job["status"] == "error"
+    assert job["error"].startswith("Tempo massimo di esecuzione superato")
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("status", ["running", "done", "error"])
+async def test_run_render_job_only_takes_queued_jobs(jobs, monkeypatch, status):
+    async def renderer(job):
+        raise AssertionError("il job non doveva essere eseguito")
+
+    use_renderer(monkeypatch, renderer)
+    jobs.docs.append(queued_job(status=status))
+    await server.run_render_job("job-1")
+    assert jobs.get("job-1")["status"] == status
+
+
+@pytest.mark.anyio
+async def test_result_of_a_superseded_run_is_discarded(jobs, monkeypatch):
+    async def renderer(job):
+        # Nel frattempo il job è stato ripreso da un altro processo
+        jobs.get(job["id"])["runner"] = "altro-processo"
+        return b"%PDF", "cartella.pdf", "application/pdf"
+
+    use_renderer(monkeypatch, renderer)
+    jobs.docs.append(queued_job())
+    await server.run_render_job("job-1")
+    assert jobs.get("job-1")["status"] == "running"
+
+
+# ============== RIPRESA DEI JOB ABBANDONATI ==============
+@pytest.fixture
+def scheduled(monkeypatch):
+    ids = []
+    monkeypatch.setattr(server, "schedule_render_job", ids.append)
+    return ids
+
+
+@pytest.mark.anyio
+async def test_resume_requeues_stale_jobs_and_fails_them_at_max_attempts(jobs, scheduled):
+    stale = iso(-server.JOB_STALE_AFTER - timedelta(minutes=1))
+    jobs.docs += [
+        queued_job("stale", status="running", attempts=1, updated_at=stale),
+        queued_job("exhausted", status="running", attempts=server.JOB_MAX_ATTEMPTS, updated_at=stale),
+        queued_job("alive", status="running", attempts=1),
+        queued_job("waiting", updated_at=stale),
+        queued_job("fresh"),
+    ]
+    assert await server.resume_render_jobs() == 2
+
+    assert sorted(scheduled) == ["stale", "waiting"]
+    assert jobs.get("stale")["status"] == "queued"
+    assert jobs.get("exhausted")["status"] == "error"
+    assert jobs.get("exhausted")["error"] == "Job interrotto troppe volte"
+    assert jobs.get("alive")["status"] == "running"
+    assert jobs.get("fresh")["status"] == "queued"
+
+
+@pytest.mark.anyio
+async def test_resume_at_startup_starts_every_queued_job(jobs, scheduled):
+    jobs.docs += [queued_job("fresh"), queued_job("done", status="done")]
+    assert await server.resume_render_jobs(all_queued=True) == 1
+    assert scheduled == ["fresh"]
+
+
+@pytest.mark.anyio
+async def test_retry_requeues_only_failed_jobs(jobs, scheduled):
+    payload = {"ambulatori": ["pta_centro"]}
+    jobs.docs += [
+        queued_job("failed", status="error", error="Errore", attempts=server.JOB_MAX_ATTEMPTS, finished_at=iso(), expires_at=iso()),
+        queued_job("done", status="done"),
+    ]
+    view = await server.retry_render_job("failed", payload)
+
+    job = jobs.get("failed")
+    assert view["status"] == job["status"] == "queued"
+    assert job["error"] is None and job["attempts"] == 0
+    assert "expires_at" not in job and "finished_at" not in job
+    assert scheduled == ["failed"]
+
+    with pytest.raises(HTTPException) as exc:
+        await server.retry_render_job("done", payload)
+    assert exc.value.status_code == 409
@@ -0,0 +1,293 @@
+import copy
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+import server
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+# ============== COLLEZIONI IN MEMORIA ==============
+class UpdateResult:
+    def __init__(self, matched_count, modified_count):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+
+
+class Cursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+def evaluate(expr, doc):
+    """Sottoinsieme delle espressioni di aggregazione usate nel $expr di reserve_slot"""
+    if isinstance(expr, str) and expr.startswith("$"):
+        return doc.get(expr[1:])
+    if isinstance(expr, dict):
+        (op, args), = expr.items()
+        if op == "$add":
+            return sum(evaluate(a, doc) for a in args)
+        if op == "$size":
+            return len(evaluate(args, doc))
+        if op == "$ifNull":
+            return next((v for v in (evaluate(a, doc) for a in args) if v is not None), None)
+        if op == "$lt":
+            left, right = (evaluate(a, doc) for a in args)
+            return left < right
+        raise NotImplementedError(op)
+    return expr
+
+
+def matches(doc, query):
+    """Sottoinsieme degli operatori di MongoDB usati dall'occupazione degli slot"""
+    for key, condition in query.items():
+        if key == "$expr":
+            if not evaluate(condition, doc):
+                return False
+            continue
+        if "." in key:
+            field, sub = key.split(".", 1)
+            if not any(matches(item, {sub: condition}) for item in doc.get(field) or []):
+                return False
+            continue
+        value = doc.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, arg in condition.items():
+            if op == "$exists" and (key in doc) != arg:
+                return False
+            if op == "$ne" and value == arg:
+                return False
+            if op == "$gt" and (value is None or not value > arg):
+                return False
+            if op == "$lt" and (value is None or not value < arg):
+                return False
+    return True
+
+
+class Collection:
+    def __init__(self, *docs, unique=None):
+        self.docs = [dict(doc) for doc in docs]
+        self.unique = unique
+
+    def _first(self, query):
+        return next((d for d in self.docs if matches(d, query)), None)
+
+    def _apply(self, doc, update):
+        doc.update(update.get("$set", {}))
+        for key, amount in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + amount
+        for key, item in update.get("$push", {}).items():
+            doc.setdefault(key, []).append(item)
+        for key, condition in update.get("$pull", {}).items():
+            doc[key] = [item for item in doc.get(key) or [] if not matches(item, condition)]
+        for key in update.get("$unset", {}):
+            doc.pop(key, None)
+
+    async def find_one(self, query, projection=None):
+        return copy.deepcopy(self._first(query))
+
+    def find(self, query, projection=None):
+        return Cursor([copy.deepcopy(d) for d in self.docs if matches(d, query)])
+
+    async def count_documents(self, query):
+        return sum(1 for d in self.docs if matches(d, query))
+
+    async def insert_one(self, doc):
+        if self.unique and any(all(d.get(k) == doc.get(k) for k in self.unique) for d in self.docs):
+            raise DuplicateKeyError("E11000 duplicate key error")
+        self.docs.append(copy.deepcopy(doc))
+
+    async def update_one(self, query, update):
+        doc = self._first(query)
+        if doc is None:
+            return UpdateResult(0, 0)
+        before = copy.deepcopy(doc)
+        self._apply(doc, update)
+        return UpdateResult(1, int(doc != before))
+
+
+class FakeDb:
+    def __init__(self):
+        self.appointments = Collection()
+        self.closed_slots = Collection()
+        self.slot_occupancy = Collection(unique=("ambulatorio", "data", "ora", "tipo"))
+        self.manual_edits = Collection()
+
+
+AMB, DATA = "pta_centro", "2026-03-02"
+
+
+def iso(delta=timedelta()):
+    return (datetime.now(timezone.utc) + delta).isoformat()
+
+
+def appointment(appointment_id, ora="09:00", tipo="PICC"):
+    return {
+        "id": appointment_id, "ambulatorio": AMB, "data": DATA, "ora": ora, "tipo": tipo,
+        "patient_id": f"p-{appointment_id}", "patient_nome": "Mario", "patient_cognome": "Rossi",
+    }
+
+
+def occupancy(ora="09:00", tipo="PICC", confirmed=0, pending=(), version=0):
+    return {**server.slot_key(AMB, DATA, ora, tipo), "confirmed": confirmed, "pending": list(pending),
+            "closed": False, "version": version}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDb()
+    monkeypatch.setattr(server, "db", fake)
+
+    async def refresh_statistics_rollup(ambulatorio, dates):
+        pass
+
+    monkeypatch.setattr(server, "refresh_statistics_rollup", refresh_statistics_rollup)
+    return fake
+
+
+def slot(db, ora="09:00", tipo="PICC"):
+    return next(d for d in db.slot_occupancy.docs if (d["ora"], d["tipo"]) == (ora, tipo))
+
+
+# ============== PRENOTAZIONE ==============
+@pytest.mark.anyio
+async def test_reserve_and_confirm_the_last_place(db):
+    db.appointments.docs.append(appointment("a1"))
+    reservation = await server.reserve_slot(AMB, DATA, "09:00", "PICC")
+    # Il documento di occupazione nasce dai dati reali, con il posto già occupato
+    assert slot(db)["confirmed"] == 1
+    assert [r["id"] for r in slot(db)["pending"]] == [reservation]
+
+    db.appointments.docs.append(appointment("a2"))
+    await server.confirm_slot(AMB, DATA, "09:00", "PICC", reservation)
+    assert (slot(db)["confirmed"], slot(db)["pending"]) == (2, [])
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("confirmed, pending", [(2, []), (1, [{"id": "r1", "at": iso()}])])
+async def test_full_slot_is_refused(db, confirmed, pending):
+    db.slot_occupancy.docs.append(occupancy(confirmed=confirmed, pending=pending))
+    with pytest.raises(HTTPException) as exc:
+        await server.reserve_slot(AMB, DATA, "09:00", "PICC")
+    assert exc.value.status_code == 400
+    assert exc.value.detail == f"Slot pieno (max {server.SLOT_CAPACITY} pazienti)"
+    assert (slot(db)["confirmed"], len(slot(db)["pending"])) == (confirmed, len(pending))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("closure", [{"ora": None, "tipo": None}, {"ora": "09:00", "tipo": "PICC"}])
+async def test_closed_slot_is_refused(db, closure):
+    db.closed_slots.docs.append({"id": "c1", "ambulatorio": AMB, "data": DATA, **closure})
+    with pytest.raises(HTTPException) as exc:
+        await server.reserve_slot(AMB, DATA, "09:00", "PICC")
+    assert exc.value.status_code == 400
+    assert exc.value.detail == "Slot chiuso"
+    # La chiusura riguarda solo gli slot di quel giorno
+    await server.reserve_slot(AMB, "2026-03-03", "09:00", "PICC")
+
+
+@pytest.mark.anyio
+async def test_expired_pending_reservation_frees_its_place(db):
+    expired = iso(-server.SLOT_PENDING_TIMEOUT - timedelta(minutes=1))
+    db.slot_occupancy.docs.append(occupancy(confirmed=1, pending=[{"id": "old", "at": expired}]))
+    reservation = await server.reserve_slot(AMB, DATA, "09:00", "PICC")
+    assert [r["id"] for r in slot(db)["pending"]] == [reservation]
+
+    # La prenotazione scaduta non si può più confermare: si riparte dai dati reali
+    db.appointments.docs.append(appointment("a1"))
+    await server.confirm_slot(AMB, DATA, "09:00", "PICC", "old")
+    assert slot(db)["confirmed"] == 1
+    assert [r["id"] for r in slot(db)["pending"]] == [reservation]
+
+
+@pytest.mark.anyio
+async def test_cancel_and_release_free_the_place(db):
+    db.slot_occupancy.docs.append(occupancy(confirmed=1, pending=[{"id": "r1", "at": iso()}]))
+    await server.cancel_slot(AMB, DATA, "09:00", "PICC", "r1")
+    assert slot(db)["pending"] == []
+    await server.release_slot(AMB, DATA, "09:00", "PICC")
+    await server.release_slot(AMB, DATA, "09:00", "PICC")
+    assert slot(db)["confirmed"] == 0
+
+
+# ============== RICALCOLO ==============
+@pytest.mark.anyio
+async def test_recount_keeps_pending_reservations(db):
+    expired = iso(-server.SLOT_PENDING_TIMEOUT - timedelta(minutes=1))
+    db.slot_occupancy.docs.append(occupancy(confirmed=0, version=3, pending=[
+        {"id": "live", "at": iso()}, {"id": "old", "at": expired},
+    ]))
+    db.appointments.docs += [appointment("a1"), appointment("a2", tipo="MED")]
+    db.closed_slots.docs.append({"id": "c1", "ambulatorio": AMB, "data": DATA, "ora": "09:00", "tipo": None})
+
+    await server.recount_slot_occupancy(AMB, DATA, "09:00", "PICC")
+    doc = slot(db)
+    assert (doc["confirmed"], doc["closed"], doc["version"]) == (1, True, 4)
+    assert [r["id"] for r in doc["pending"]] == ["live"]
+
+
+@pytest.mark.anyio
+async def test_recount_retries_when_confirmed_changes_meanwhile(db, monkeypatch):
+    db.slot_occupancy.docs.append(occupancy(confirmed=0))
+    db.appointments.docs.append(appointment("a1"))
+    count_documents = db.appointments.count_documents
+    counts = []
+
+    async def racing_count(query):
+        count = await count_documents(query)
+        if not counts:
+            # Un appuntamento confermato tra la lettura di version e il conteggio
+            db.appointments.docs.append(appointment("a2"))
+            await server.db.slot_occupancy.update_one(query, {"$inc": {"confirmed": 1, "version": 1}})
+        counts.append(count)
+        return count
+
+    monkeypatch.setattr(db.appointments, "count_documents", racing_count)
+    await server.recount_slot_occupancy(AMB, DATA, "09:00", "PICC")
+    # Il primo conteggio (1) è superato: il compare-and-set fallisce e si ricalcola
+    assert counts == [1, 2]
+    assert (slot(db)["confirmed"], slot(db)["version"]) == (2, 2)
+
+
+# ============== SPOSTAMENTO ==============
+PAYLOAD = {"sub": "Domenico", "ambulatori": [AMB]}
+
+
+@pytest.mark.anyio
+async def test_move_into_full_slot_is_refused(db):
+    db.appointments.docs += [appointment("a1"), appointment("b1", ora="10:00"), appointment("b2", ora="10:00")]
+    await server.recount_slot_occupancy(AMB, DATA, "09:00", "PICC")
+
+    with pytest.raises(HTTPException) as exc:
+        await server.update_appointment("a1", {"ora": "10:00"}, PAYLOAD)
+    assert exc.value.status_code == 400
+    assert db.appointments._first({"id": "a1"})["ora"] == "09:00"
+    assert slot(db)["confirmed"] == 1
+    assert (slot(db, "10:00")["confirmed"], slot(db, "10:00")["pending"]) == (2, [])
+
+
+@pytest.mark.anyio
+async def test_move_takes_the_place_and_releases_the_old_one(db):
+    db.appointments.docs += [appointment("a1"), appointment("b1", ora="10:00")]
+    await server.recount_slot_occupancy(AMB, DATA, "09:00", "PICC")
+
+    updated = await server.update_appointment("a1", {"ora": "10:00"}, PAYLOAD)
+    assert updated["ora"] == "10:00"
+    assert slot(db)["confirmed"] == 0
+    assert (slot(db, "10:00")["confirmed"], slot(db, "10:00")["pending"]) == (2, [])
+
+    # Nessuno spostamento di slot: nessuna prenotazione
+    await server.update_appointment("a1", {"note": "controllo"}, PAYLOAD)
+    assert slot(db, "10:00")["confirmed"] == 2
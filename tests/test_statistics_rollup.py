@@ -0,0 +1,24 @@
+import server
+
+
+# ============== STATISTICHE ==============
+def test_summarize_appointment_rollup_merges_days_and_months():
+    docs = [
+        {"data": "2026-02-01", "tipo": "MED", "accessi": 2, "pazienti": ["a", "b"], "prestazioni": {"medicazione_semplice": 2}},
+        {"data": "2026-01-15", "tipo": "PICC", "accessi": 1, "pazienti": ["a"], "prestazioni": {"espianto_picc": 1}},
+        {"data": "2026-01-15", "tipo": "MED", "accessi": 1, "pazienti": ["c"], "prestazioni": {"medicazione_semplice": 1}},
+        # Documento con soli impianti: non conta come accesso
+        {"data": "2026-01-20", "tipo": "PICC", "accessi": 0, "pazienti": [], "prestazioni": {}, "impianti": {"picc": 1}},
+    ]
+    total, unique, prestazioni, monthly = server.summarize_appointment_rollup(docs)
+    assert total == 4
+    assert unique == 3
+    assert prestazioni == {"medicazione_semplice": 3, "espianto_picc": 1}
+    assert monthly == {
+        "2026-01": {"accessi": 2, "prestazioni": {"espianto_picc": 1, "medicazione_semplice": 1}, "pazienti_unici": 2},
+        "2026-02": {"accessi": 2, "prestazioni": {"medicazione_semplice": 2}, "pazienti_unici": 2},
+    }
+
+
+def test_summarize_appointment_rollup_empty():
+    assert server.summarize_appointment_rollup([]) == (0, 0, {}, {})